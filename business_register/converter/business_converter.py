@@ -6,7 +6,46 @@ logger.setLevel(logging.INFO)
 from business_register.models.kved_models import Kved
 from business_register.models.company_models import Company
 from data_ocean.converter import Converter
+from data_ocean.dimension_cache import get_dimension_cache
 from data_ocean.models import Authority, Status, TaxpayerType
+from data_ocean.record_schema import RecordField, RecordSchema
+from data_ocean.utils import format_date_to_yymmdd
+
+
+def to_date(value):
+    return format_date_to_yymmdd(value) or None
+
+
+# ACTIVITY_KINDS/ACTIVITY_KIND of EDR records of companies and FOPs
+KVED_SCHEMA = RecordSchema(
+    RecordField('CODE', 'code'),
+    RecordField('NAME', 'name', required=True),
+    RecordField('PRIMARY', 'is_primary', lambda value: value == 'так'),
+)
+
+# EXCHANGE_DATA/EXCHANGE_ANSWER of EDR records of companies and FOPs
+EXCHANGE_DATA_SCHEMA = RecordSchema(
+    RecordField('AUTHORITY_NAME', 'authority'),
+    RecordField('TAX_PAYER_TYPE', 'taxpayer_type'),
+    RecordField('START_DATE', 'start_date', to_date),
+    RecordField('START_NUM', 'start_number'),
+    RecordField('END_DATE', 'end_date', to_date),
+    RecordField('END_NUM', 'end_number'),
+)
+
+
+_all_kveds_dict = {}
+
+
+def get_all_kveds_dict():
+    """kveds are loaded once for the run and shared by all converters of the process"""
+    if not _all_kveds_dict:
+        _all_kveds_dict.update((kved.code + kved.name, kved) for kved in Kved.objects.all())
+    return _all_kveds_dict
+
+
+def clear_all_kveds_dict():
+    _all_kveds_dict.clear()
 
 
 def find_company_by_edrpou(edprou):
@@ -27,63 +66,82 @@ class BusinessConverter(Converter):
 
     def __init__(self):
         """
-        declaring as class fields for global access and initializing dictionaries with all kveds, /
+        declaring as class fields for global access process-wide caches of
         statuses, authorities and taxpayer_types from DB
         """
-        self.all_kveds_dict = self.put_all_kveds_to_dict()
-        self.all_statuses_dict = self.put_objects_to_dict("name", "data_ocean", "Status")
-        self.all_authorities_dict = self.put_objects_to_dict("name", "data_ocean", "Authority")
-        self.all_taxpayer_types_dict = self.put_objects_to_dict("name", "data_ocean", "TaxpayerType")
+        self.statuses = get_dimension_cache(Status)
+        self.authorities = get_dimension_cache(Authority)
+        self.taxpayer_types = get_dimension_cache(TaxpayerType)
         super().__init__()
 
+    def clear_caches(self):
+        super().clear_caches()
+        clear_all_kveds_dict()
+
+    def prefetch_dimensions(self, records_data):
+        """
+        Stores new statuses, authorities and taxpayer_types of the chunk with one query for each table
+        """
+        statuses = set()
+        authorities = set()
+        taxpayer_types = set()
+        for data in records_data:
+            if data.get('status'):
+                statuses.add(data['status'].lower())
+            if data.get('authority'):
+                authorities.add(data['authority'].lower())
+            for answer in data.get('exchange_data') or ():
+                if answer['authority']:
+                    authorities.add(answer['authority'].lower())
+                if answer['taxpayer_type']:
+                    taxpayer_types.add(answer['taxpayer_type'].lower())
+        self.statuses.resolve(statuses)
+        self.authorities.resolve(authorities)
+        self.taxpayer_types.resolve(taxpayer_types)
+        self.time_it('prefetch dimensions\t')
+
+    def get_stored_objects(self, queryset, field_name, keys):
+        """
+        Returns dict with the first stored object for each key from the chunk of records.
+        All keys are resolved with one `field = ANY(...)` query instead of a query for each record.
+        """
+        stored_objects = {}
+        for obj in queryset.filter(**{f'{field_name}__any': list(set(keys))}).order_by('pk'):
+            stored_objects.setdefault(getattr(obj, field_name), obj)
+        self.time_it('get stored objects\t')
+        return stored_objects
+
     def find_edrpou(self, string_to_check):
         return len(string_to_check) == 8 and string_to_check.isdigit()
 
-    def put_all_kveds_to_dict(self):
-        return {kved.code+kved.name: kved for kved in Kved.objects.all()}
-
     def get_kved_from_DB(self, kved_code_from_record, kved_name_from_record):
         """
         retreiving kved from DB
         """
+        all_kveds_dict = get_all_kveds_dict()
         kved_key = kved_code_from_record + kved_name_from_record.lower()
-        if kved_key in self.all_kveds_dict:
-            return self.all_kveds_dict[kved_key]
+        if kved_key in all_kveds_dict:
+            return all_kveds_dict[kved_key]
         logger.info('Kved name is not valid: ' + kved_name_from_record)
-        return self.all_kveds_dict['not_validnot_valid']
+        return all_kveds_dict['not_validnot_valid']
 
     def save_or_get_status(self, status_from_record):
         """
         retreiving status from DB or storing the new one
         """
-        status = status_from_record.lower()
-        if status not in self.all_statuses_dict:
-            new_status = Status.objects.create(name=status)
-            self.all_statuses_dict[status] = new_status
-            return new_status
-        return self.all_statuses_dict[status]
+        return self.statuses.get(status_from_record.lower())
 
     def save_or_get_authority(self, authority_from_record):
         """
         retreiving authority from DB or storing the new one
         """
-        authority = authority_from_record.lower()
-        if authority not in self.all_authorities_dict:
-            new_authority = Authority.objects.create(name=authority)
-            self.all_authorities_dict[authority] = new_authority
-            return new_authority
-        return self.all_authorities_dict[authority]
+        return self.authorities.get(authority_from_record.lower())
 
     def save_or_get_taxpayer_type(self, taxpayer_type_from_record):
         """
         retreiving taxpayer_type from DB or storing the new one
         """
-        taxpayer_type = taxpayer_type_from_record.lower()
-        if taxpayer_type not in self.all_taxpayer_types_dict:
-            new_taxpayer_type = TaxpayerType.objects.create(name=taxpayer_type)
-            self.all_taxpayer_types_dict[taxpayer_type] = new_taxpayer_type
-            return new_taxpayer_type
-        return self.all_taxpayer_types_dict[taxpayer_type]
+        return self.taxpayer_types.get(taxpayer_type_from_record.lower())
 
     def extract_kved(self, kved_data):
         kved_info = kved_data.split(' ', 1)
@@ -1,6 +1,7 @@
 from business_register.converter.business_converter import BusinessConverter
-from business_register.models.company_models import CompanyType
+from business_register.models.company_models import Bylaw, CompanyType
 from business_register.emails import send_new_company_type_message
+from data_ocean.dimension_cache import get_dimension_cache
 
 
 class CompanyConverter(BusinessConverter):
@@ -141,8 +142,17 @@ class CompanyConverter(BusinessConverter):
         self.all_eng_company_type_dict = self.put_objects_to_dict('name_eng',
                                                                       "business_register",
                                                                       "CompanyType")
+        self.bylaws = get_dimension_cache(Bylaw)
         super().__init__()
 
+    def prefetch_dimensions(self, records_data):
+        records_data = list(records_data)
+        super().prefetch_dimensions(records_data)
+        self.bylaws.resolve({data['bylaw'] for data in records_data if data.get('bylaw')})
+
+    def save_or_get_bylaw(self, bylaw_from_record):
+        return self.bylaws.get(bylaw_from_record)
+
     def translate_company_type_name_eng(self, name_eng):
         for key, value in self.COMPANY_TYPES_UK_EN.items():
             if value == name_eng:
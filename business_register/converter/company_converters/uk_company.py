@@ -1,13 +1,19 @@
+import csv
 import logging
-from csv import DictReader
+import os
+import traceback
+from operator import itemgetter
 
 import requests
 from django.conf import settings
+from django.db import IntegrityError, connections, transaction
 from django.utils import timezone
 from lxml import html
+from simple_history.utils import bulk_update_with_history
 
 from business_register.converter.company_converters.company import CompanyConverter
-from business_register.models.company_models import Company
+from business_register.models.company_models import Company, CompanyType
+from data_ocean.converter import CopyBulkCreateManager
 from data_ocean.downloader import Downloader
 from data_ocean.utils import format_date_to_yymmdd, to_lower_string_if_exists
 
@@ -19,75 +25,208 @@ logger.setLevel(logging.DEBUG)
 
 
 class UkCompanyConverter(CompanyConverter):
+    """
+    Saves companies of BasicCompanyData CSV of Company House. With WORKERS > 1 the file is split
+    into byte ranges, and every range is saved by its own worker process with its own DB connection.
+    Rows of a chunk are saved in bulk: stored companies are got with one query, new ones are copied
+    with COPY together with their history, changed ones are updated with bulk_update together with their history.
+    """
+    # columns of the CSV that are saved, names in the header can have leading spaces
+    COLUMNS = (
+        'CompanyName', 'CompanyNumber', 'RegAddress.CareOf', 'RegAddress.POBox', 'RegAddress.AddressLine1',
+        'RegAddress.AddressLine2', 'RegAddress.PostTown', 'RegAddress.County', 'RegAddress.Country',
+        'RegAddress.PostCode', 'CompanyCategory', 'CompanyStatus', 'CountryOfOrigin', 'IncorporationDate',
+    )
+    UPDATE_FIELDS = ['name', 'company_type', 'address', 'country', 'status', 'registration_date', 'code']
+    ENCODING = 'utf-8'
+    BLOCK_SIZE = 16 * 1024 * 1024  # bytes read at once when quotes are counted for get_partitions
+
+    def __init__(self):
+        self.CHUNK_SIZE = settings.CHUNK_SIZE_UK_COMPANY
+        self.WORKERS = settings.WORKERS_UK_COMPANY
+        super().__init__()
+        self.bulk_manager = CopyBulkCreateManager()
+        self.get_columns = None
+
+    def read_header(self, file):
+        with open(file, newline='', encoding=self.ENCODING) as csvfile:
+            header = [column.strip() for column in next(csv.reader(csvfile))]
+        self.get_columns = itemgetter(*[header.index(column) for column in self.COLUMNS])
+
+    @classmethod
+    def get_partitions(cls, file, parts):
+        """
+        Splits the file into byte ranges of about the same size. Ranges end at line ends outside
+        quoted fields, so a row with line breaks in its quoted fields is never split between ranges.
+        Quotes before every bound are counted block by block, escaped quotes are doubled and keep the count even.
+        """
+        size = os.path.getsize(file)
+        bounds = [0]
+        quotes_count = position = 0
+        with open(file, 'rb') as f:
+            for i in range(1, parts):
+                target = size * i // parts
+                while position < target:
+                    block = f.read(min(cls.BLOCK_SIZE, target - position))
+                    quotes_count += block.count(b'"')
+                    position += len(block)
+                while True:
+                    line = f.readline()
+                    quotes_count += line.count(b'"')
+                    position += len(line)
+                    if not line or not quotes_count % 2:
+                        break
+                bounds.append(position)
+        bounds.append(size)
+        return list(zip(bounds, bounds[1:]))
+
+    def read_lines(self, file, start, end):
+        """
+        Yields lines of the file that start in the byte range [start, end), the header is skipped.
+        The line that starts before the range and ends in it belongs to the previous range.
+        A row with line breaks in quoted fields is read by csv.reader from several lines,
+        get_partitions never puts them into different ranges.
+        """
+        with open(file, 'rb') as f:
+            if start:
+                f.seek(start - 1)
+            f.readline()
+            position = f.tell()
+            while position < end:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                yield line.decode(self.ENCODING)
+
+    def save_partition(self, file, start, end):
+        """Saves rows of the byte range of the file chunk by chunk, returns the number of rows"""
+        if not self.get_columns:
+            self.read_header(file)
+        rows_count = 0
+        rows = []
+        for row in csv.reader(self.read_lines(file, start, end)):
+            rows.append(row)
+            if len(rows) >= self.CHUNK_SIZE:
+                self.save_rows(rows)
+                rows_count += len(rows)
+                rows = []
+        if rows:
+            self.save_rows(rows)
+            rows_count += len(rows)
+        return rows_count
+
+    def run_worker(self, index, file, start, end, results_queue):
+        # every worker must have its own DB connection, never the one inherited from the parent
+        connections.close_all()
+        try:
+            rows_count = self.save_partition(file, start, end)
+            results_queue.put((index, None, rows_count))
+        except Exception as e:
+            traceback.print_exc()
+            results_queue.put((index, f'{e}', 0))
+        finally:
+            connections.close_all()
+
+    def save_in_parallel(self, file, workers):
+        self.read_header(file)
+        processes, results_queue = self.start_workers(
+            self.run_worker, [(file, start, end) for start, end in self.get_partitions(file, workers)]
+        )
+        errors = []
+        for index, error, rows_count in self.get_worker_results(results_queue, processes):
+            if error:
+                errors.append(f'worker {index}: {error}')
+                logger.error(f'!!! Worker {index} failed. Error: {error}')
+                continue
+            logger.info(f'{self.__class__.__name__}: worker {index} saved {rows_count} rows')
+        if errors:
+            raise Exception(f'Saving UK companies failed, {"; ".join(errors)}')
 
     def save_to_db(self, file):
-        with open(file, newline='') as csvfile:
-            index = 0
-
-            for row in DictReader(csvfile):
-                name = row['CompanyName'].lower()
-                # number is unique identifier in Company House
-                number = row[' CompanyNumber']
-                code = name + number
-                country = self.save_or_get_country(row['CountryOfOrigin'])
-                address = (
-                    f"{row['RegAddress.Country']} {row['RegAddress.PostCode']} "
-                    f"{row['RegAddress.County']} {row['RegAddress.PostTown']} "
-                    f"{row[' RegAddress.AddressLine2']} {row['RegAddress.AddressLine1']} "
-                    f"{row['RegAddress.POBox']} {row['RegAddress.CareOf']}"
-                )
-                company_type = self.save_or_get_company_type(row['CompanyCategory'], 'en')
-                status = self.save_or_get_status(row['CompanyStatus'])
-                if len(row['IncorporationDate']) == 10:
-                    registration_date = format_date_to_yymmdd(row['IncorporationDate'])
-                else:
-                    registration_date = None
-                source = Company.GREAT_BRITAIN_REGISTER
-                company = Company.objects.filter(edrpou=number, source=Company.GREAT_BRITAIN_REGISTER).first()
-                if not company:
-                    company = Company(
-                        name=name,
-                        company_type=company_type,
-                        edrpou=number,
-                        address=address,
-                        country=country,
-                        status=status,
-                        registration_date=registration_date,
-                        code=code,
-                        source=source
-                    )
-                    company.save()
-                else:
-                    update_fields = []
-                    if company.name != name:
-                        company.name = name
-                        update_fields.append('name')
-                    if company.company_type_id != company_type.id:
-                        company.company_type = company_type
-                        update_fields.append('company_type')
-                    if company.address != address:
-                        company.address = address
-                        update_fields.append('address')
-                    if company.country_id != country.id:
-                        company.country = country
-                        update_fields.append('country')
-                    if company.status_id != status.id:
-                        company.status = status
-                        update_fields.append('status')
-                    if to_lower_string_if_exists(company.registration_date) != registration_date:
-                        company.registration_date = registration_date
-                        update_fields.append('registration_date')
-                    if company.code != code:
-                        company.code = code
-                        update_fields.append('code')
-                    if company.source != source:
-                        company.source = source
-                        update_fields.append('source')
-                    if update_fields:
-                        update_fields.append('updated_at')
-                        company.save(update_fields=update_fields)
-
-            print('All companies from UK register were saved')
+        if self.WORKERS > 1:
+            self.save_in_parallel(file, self.WORKERS)
+        else:
+            self.save_partition(file, 0, os.path.getsize(file))
+        print('All companies from UK register were saved')
+
+    def get_company_data(self, row):
+        (name, number, care_of, po_box, address_line_1, address_line_2, post_town, county, address_country,
+         post_code, category, status, country, incorporation_date) = self.get_columns(row)
+        name = name.lower()
+        return {
+            'name': name,
+            'edrpou': number,
+            'code': name + number,
+            'address': (
+                f"{address_country} {post_code} {county} {post_town} "
+                f"{address_line_2} {address_line_1} {po_box} {care_of}"
+            ),
+            'company_type': category.lower(),
+            'status': status.lower(),
+            'country': country.lower(),
+            'registration_date': (format_date_to_yymmdd(incorporation_date)
+                                  if len(incorporation_date) == 10 else None),
+        }
+
+    def prefetch_company_types(self, names_eng):
+        for name_eng in names_eng:
+            if name_eng and name_eng not in self.all_eng_company_type_dict:
+                try:
+                    with transaction.atomic():
+                        self.create_company_type(self.translate_company_type_name_eng(name_eng), name_eng)
+                except IntegrityError:
+                    # stored by another worker
+                    self.all_eng_company_type_dict[name_eng] = CompanyType.objects.get(name_eng=name_eng)
+
+    def save_rows(self, rows):
+        source = Company.GREAT_BRITAIN_REGISTER
+        companies_data = {}
+        for row in rows:
+            company_data = self.get_company_data(row)
+            # number is unique identifier in Company House, the last row of the number is saved
+            companies_data[company_data['edrpou']] = company_data
+        self.countries.resolve({data['country'] for data in companies_data.values()})
+        self.statuses.resolve({data['status'] for data in companies_data.values()})
+        self.prefetch_company_types({data['company_type'] for data in companies_data.values()})
+        self.time_it('prefetch dimensions\t')
+        stored_companies = self.get_stored_objects(
+            Company.objects.filter(source=source),
+            'edrpou',
+            list(companies_data)
+        )
+        now = timezone.now()
+        changed_companies = []
+        for number, company_data in companies_data.items():
+            company_data['company_type'] = self.all_eng_company_type_dict.get(company_data['company_type'])
+            company_data['status'] = self.statuses.get(company_data['status'])
+            company_data['country'] = self.countries.get(company_data['country'])
+            company = stored_companies.get(number)
+            if not company:
+                self.bulk_manager.add(Company(source=source, **company_data))
+                continue
+            changed = False
+            for field_name in ('name', 'address', 'code'):
+                if getattr(company, field_name) != company_data[field_name]:
+                    setattr(company, field_name, company_data[field_name])
+                    changed = True
+            for field_name in ('company_type', 'country', 'status'):
+                related_object = company_data[field_name]
+                if getattr(company, f'{field_name}_id') != (related_object.id if related_object else None):
+                    setattr(company, field_name, related_object)
+                    changed = True
+            if to_lower_string_if_exists(company.registration_date) != company_data['registration_date']:
+                company.registration_date = company_data['registration_date']
+                changed = True
+            if changed:
+                company.updated_at = now
+                changed_companies.append(company)
+        self.bulk_manager.commit_with_history(Company)
+        self.bulk_manager.queues['business_register.Company'] = []
+        self.time_it('save companies\t')
+        if changed_companies:
+            bulk_update_with_history(changed_companies, Company, self.UPDATE_FIELDS + ['updated_at'])
+        self.time_it('update companies\t')
 
 
 class UkCompanyDownloader(Downloader):
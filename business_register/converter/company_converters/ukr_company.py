@@ -8,12 +8,13 @@ from django.utils import timezone
 
 from business_register.converter.company_converters.company import CompanyConverter
 from business_register.models.company_models import (
-    Assignee, BancruptcyReadjustment, Bylaw, Company, CompanyDetail, CompanyToKved,
+    Assignee, BancruptcyReadjustment, Company, CompanyDetail, CompanyToKved,
     CompanyToPredecessor, ExchangeDataCompany, Founder, Predecessor,
     Signer, TerminationStarted
 )
 from data_ocean.converter import BulkCreateManager
 from data_ocean.downloader import Downloader
+from data_ocean.record_schema import RecordField, RecordSchema
 from data_ocean.utils import (cut_first_word, format_date_to_yymmdd, get_first_word,
                               to_lower_string_if_exists)
 from location_register.converter.address import AddressConverter
@@ -24,6 +25,32 @@ logger.setLevel(logging.INFO)
 
 
 class UkrCompanyConverter(CompanyConverter):
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('NAME', 'name', str.lower, required=True),
+        RecordField('SHORT_NAME', 'short_name', str.lower),
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('ADDRESS', 'address'),
+        RecordField('STAN', 'status'),
+        RecordField('BOSS', 'boss', str.lower),
+        RecordField('KVED', 'kved'),
+        RecordField('FOUNDERS', 'founders', many=True),
+        RecordField('BENEFICIARIES', 'beneficiaries', many=True),
+    )
+    DETAILED_RECORD_SCHEMA = RecordSchema(
+        RecordField('NAME', 'name', str.lower),
+        RecordField('SHORT_NAME', 'short_name', str.lower),
+        RecordField('OPF', 'company_type'),
+        RecordField('EDRPOU', 'edrpou'),
+        RecordField('ADDRESS', 'address'),
+        RecordField('STAN', 'status'),
+        RecordField('AUTHORIZED_CAPITAL', 'authorized_capital',
+                    lambda value: float(value.replace(',', '.'))),
+        RecordField('STATUTE', 'bylaw'),
+        RecordField('REGISTRATION', 'registration'),
+        RecordField('CONTACTS', 'contact_info'),
+        RecordField('CURRENT_AUTHORITY', 'authority'),
+        RecordField('FOUNDERS', 'founders', many=True),
+    )
 
     def __init__(self):
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO
@@ -32,7 +59,6 @@ class UkrCompanyConverter(CompanyConverter):
         self.RECORD_TAG = 'RECORD'
         self.bulk_manager = BulkCreateManager()
         self.branch_bulk_manager = BulkCreateManager()
-        self.all_bylaw_dict = self.put_objects_to_dict("name", "business_register", "Bylaw")
         self.all_predecessors_dict = self.put_objects_to_dict("name", "business_register",
                                                                   "Predecessor")
         self.all_companies_dict = {}
@@ -40,13 +66,6 @@ class UkrCompanyConverter(CompanyConverter):
         self.all_company_founders = []
         super().__init__()
 
-    def save_or_get_bylaw(self, bylaw_from_record):
-        if bylaw_from_record not in self.all_bylaw_dict:
-            new_bylaw = Bylaw.objects.create(name=bylaw_from_record)
-            self.all_bylaw_dict[bylaw_from_record] = new_bylaw
-            return new_bylaw
-        return self.all_bylaw_dict[bylaw_from_record]
-
     def save_or_get_predecessor(self, item):
         if item.xpath('NAME')[0].text not in self.all_predecessors_dict:
             new_predecessor = Predecessor.objects.create(
@@ -115,17 +134,16 @@ class UkrCompanyConverter(CompanyConverter):
 
     def save_or_update_founders(self, founders_from_record, company):
         already_stored_founders = list(Founder.objects.filter(company=company))
-        for item in founders_from_record:
-            info = item.text
+        for info in founders_from_record:
             # checking if field contains data
             if not info or info.endswith('ВІДСУТНІЙ'):
                 continue
             # checking if there is additional data except name
-            if ',' in item.text:
-                name, is_beneficiary, address, equity = self.extract_founder_data(item.text)
+            if ',' in info:
+                name, is_beneficiary, address, equity = self.extract_founder_data(info)
                 name = name.lower()
             else:
-                name = item.text.lower()
+                name = info.lower()
                 equity, address = None, None
                 is_beneficiary = False
             already_stored = False
@@ -180,8 +198,7 @@ class UkrCompanyConverter(CompanyConverter):
 
     def save_or_update_beneficiaries(self, beneficiares_from_record, company):
         already_stored_founders = list(Founder.objects.filter(company=company))
-        for item in beneficiares_from_record:
-            info = item.text
+        for info in beneficiares_from_record:
             name, edrpou, address = self.extract_beneficiary_data(info)
             name = name.lower()
             already_stored = False
@@ -417,70 +434,31 @@ class UkrCompanyConverter(CompanyConverter):
     # ] = self.create_hash_code(record.xpath('NAME')[0].text, edrpou)
 
     def save_detail_company_to_db(self, records):
-        for record in records:
-            name = record.xpath('NAME')[0].text.lower()
-            short_name = record.xpath('SHORT_NAME')[0].text
-            if short_name:
-                short_name = short_name.lower()
-            company_type = record.xpath('OPF')[0].text
-            if company_type:
-                company_type = self.save_or_get_company_type(company_type, 'uk')
-            edrpou = record.xpath('EDRPOU')[0].text
+        records = [self.DETAILED_RECORD_SCHEMA.extract(record) for record in records]
+        self.prefetch_dimensions(records)
+        for data in records:
+            name = data['name']
+            edrpou = data['edrpou']
             if not edrpou:
                 self.report.invalid_data += 1
                 continue
+            company_type = data['company_type']
+            if company_type:
+                company_type = self.save_or_get_company_type(company_type, 'uk')
             code = name + edrpou
-            address = record.xpath('ADDRESS')[0].text
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            founding_document_number = record.xpath('FOUNDING_DOCUMENT_NUM')[0].text
-            executive_power = record.xpath('EXECUTIVE_POWER')[0].text
-            if executive_power:
-                executive_power = executive_power.lower()
-            # if len(record.xpath('ACTIVITY_KINDS')[0]):
-            #     self.add_company_to_kved(record.xpath('ACTIVITY_KINDS')[0], code)
-            superior_management = record.xpath('SUPERIOR_MANAGEMENT')[0].text
-            if superior_management:
-                superior_management = superior_management.lower()
-            # if len(record.xpath('SIGNERS')[0]):
-            #     self.add_signers(record.xpath('SIGNERS')[0], code)
-            authorized_capital = record.xpath('AUTHORIZED_CAPITAL')[0].text
-            if authorized_capital:
-                authorized_capital = authorized_capital.replace(',', '.')
-                authorized_capital = float(authorized_capital)
-            bylaw = self.save_or_get_bylaw(record.xpath('STATUTE')[0].text)
+            address = data['address']
+            status = self.save_or_get_status(data['status'])
+            short_name = data['short_name']
+            authorized_capital = data['authorized_capital']
+            bylaw = self.save_or_get_bylaw(data['bylaw'])
             registration_date = None
             registration_info = None
-            registration = record.xpath('REGISTRATION')[0].text
+            registration = data['registration']
             if registration:
                 registration_date = format_date_to_yymmdd(get_first_word(registration))
                 registration_info = cut_first_word(registration)
-            managing_paper = record.xpath('MANAGING_PAPER')[0].text
-            if managing_paper:
-                managing_paper = managing_paper.lower()
-            # TODO: refactor branches storing
-            # if len(record.xpath('BRANCHES')[0]):
-            #     self.add_branches(record.xpath('BRANCHES')[0], code)
-            # if record.xpath('TERMINATION_STARTED_INFO/OP_DATE'):
-            #     self.add_termination_started(record, code)
-            # if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE'):
-            #     self.add_bancruptcy_readjustment(record, code)
-            # if len(record.xpath('PREDECESSORS')[0]):
-            #     self.add_company_to_predecessors(record.xpath('PREDECESSORS')[0], code)
-            # if len(record.xpath('ASSIGNEES')[0]):
-            #     self.add_assignees(record.xpath('ASSIGNEES')[0], code)
-            terminated_info = record.xpath('TERMINATED_INFO')[0].text
-            if terminated_info:
-                terminated_info = terminated_info.lower()
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
-            if termination_cancel_info:
-                termination_cancel_info = termination_cancel_info.lower()
-            contact_info = record.xpath('CONTACTS')[0].text
-            # if record.xpath('EXCHANGE_DATA')[0]:
-            #     self.add_exchange_data(record.xpath('EXCHANGE_DATA')[0], code)
-            vp_dates = record.xpath('VP_DATES')[0].text
-            authority = self.save_or_get_authority(record.xpath('CURRENT_AUTHORITY')[0].text)
-            # self.add_company_detail(founding_document_number, executive_power, superior_management, managing_paper,
-            #                         terminated_info, termination_cancel_info, vp_dates, code)
+            contact_info = data['contact_info']
+            authority = self.save_or_get_authority(data['authority'])
             # ToDo: resolve the problem of having records with the same company name amd edrpou
             # that results in the same code
             company = Company.objects.filter(code=code).first()
@@ -540,8 +518,8 @@ class UkrCompanyConverter(CompanyConverter):
                     update_fields.append('updated_at')
                     company.save(update_fields=update_fields)
                     # self.bulk_manager.add_update(company)
-            if len(record.xpath('FOUNDERS')[0]):
-                self.save_or_update_founders(record.xpath('FOUNDERS')[0], company)
+            if data['founders']:
+                self.save_or_update_founders(data['founders'], company)
         # if len(self.bulk_manager.update_queues['business_register.Company']):
         #     self.bulk_manager.commit_update(Company, ['name', 'short_name', 'company_type',
         #                                               'authorized_capital', 'address', 'status',
@@ -680,22 +658,20 @@ class UkrCompanyConverter(CompanyConverter):
 
     def save_to_db(self, records):
         country = AddressConverter().save_or_get_country('Ukraine')
-        for record in records:
+        records = [self.RECORD_SCHEMA.extract(record) for record in records]
+        self.prefetch_dimensions(data for data in records if data)
+        for data in records:
             # omitting records without company name or edrpou
-            if not record.xpath('NAME')[0].text or not record.xpath('EDRPOU')[0].text:
+            if not data:
                 self.report.invalid_data += 1
                 continue
-            name = record.xpath('NAME')[0].text.lower()
-            short_name = record.xpath('SHORT_NAME')[0].text
-            if short_name:
-                short_name = short_name.lower()
-            edrpou = record.xpath('EDRPOU')[0].text
+            name = data['name']
+            short_name = data['short_name']
+            edrpou = data['edrpou']
             code = name + edrpou
-            address = record.xpath('ADDRESS')[0].text
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            boss = record.xpath('BOSS')[0].text
-            if boss:
-                boss = boss.lower()
+            address = data['address']
+            status = self.save_or_get_status(data['status'])
+            boss = data['boss']
             # ToDo: resolve the problem of having records with the same company name amd edrpou
             company = (Company.objects
                        # ToDo: use source after storing source in the server DB
@@ -741,14 +717,14 @@ class UkrCompanyConverter(CompanyConverter):
                 if update_fields:
                     update_fields.append('updated_at')
                     company.save(update_fields=update_fields)
-            kved_data = record.xpath('KVED')[0].text
+            kved_data = data['kved']
             if kved_data and ' ' in kved_data:
                 kved = self.extract_kved(kved_data)
                 self.save_or_update_kved(kved, company)
-            if len(record.xpath('FOUNDERS')[0]):
-                self.save_or_update_founders(record.xpath('FOUNDERS')[0], company)
-            if len(record.xpath('BENEFICIARIES')[0]):
-                self.save_or_update_beneficiaries(record.xpath('BENEFICIARIES')[0], company)
+            if data['founders']:
+                self.save_or_update_founders(data['founders'], company)
+            if data['beneficiaries']:
+                self.save_or_update_beneficiaries(data['beneficiaries'], company)
 
 
 class UkrCompanyDownloader(Downloader):
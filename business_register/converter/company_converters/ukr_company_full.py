@@ -4,16 +4,19 @@ import requests
 from time import sleep
 
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 
+from business_register.converter.business_converter import EXCHANGE_DATA_SCHEMA, KVED_SCHEMA, to_date
 from business_register.converter.company_converters.company import CompanyConverter
 from business_register.models.company_models import (
-    Assignee, BancruptcyReadjustment, Bylaw, Company, CompanyDetail, CompanyToKved,
+    Assignee, BancruptcyReadjustment, Company, CompanyDetail, CompanyToKved,
     CompanyToPredecessor, ExchangeDataCompany, Founder, Predecessor,
     Signer, TerminationStarted
 )
-from data_ocean.converter import BulkCreateManager
+from data_ocean.converter import ChildrenUpdater, CopyBulkCreateManager, IdTracker
 from data_ocean.downloader import Downloader
+from data_ocean.record_schema import RecordField, RecordSchema
 from data_ocean.utils import (cut_first_word, format_date_to_yymmdd, get_first_word,
                               to_lower_string_if_exists, log_records)
 from location_register.converter.address import AddressConverter
@@ -22,21 +25,103 @@ from stats.tasks import endpoints_cache_warm_up
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# PREDECESSORS/PREDECESSOR and ASSIGNEES/ASSIGNEE
+RELATED_COMPANY_SCHEMA = RecordSchema(
+    RecordField('NAME', 'name'),
+    RecordField('CODE', 'code'),
+)
+
+TERMINATION_STARTED_SCHEMA = RecordSchema(
+    RecordField('OP_DATE', 'op_date', to_date),
+    RecordField('REASON', 'reason', str.lower),
+    RecordField('SBJ_STATE', 'sbj_state', str.lower),
+    RecordField('SIGNER_NAME', 'signer_name', str.lower),
+    RecordField('CREDITOR_REQ_END_DATE', 'creditor_reg_end_date', to_date),
+)
+
+BANKRUPTCY_READJUSTMENT_SCHEMA = RecordSchema(
+    RecordField('OP_DATE', 'op_date', to_date),
+    RecordField('REASON', 'reason', str.lower),
+    RecordField('SBJ_STATE', 'sbj_state', str.lower),
+    RecordField('BANKRUPTCY_READJUSTMENT_HEAD_NAME', 'head_name', str.lower),
+)
+
 
 class UkrCompanyFullConverter(CompanyConverter):
     """
     Uncomment for switch Timer ON.
     """
     # timing = True
+    # fields of the company from the record, that are updated in the staging merge mode
+    MERGE_FIELDS = ('name', 'short_name', 'company_type', 'authorized_capital', 'address', 'status', 'bylaw',
+                    'registration_date', 'registration_info', 'contact_info', 'authority', 'country')
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('NAME', 'name', str.lower, required=True),
+        RecordField('SHORT_NAME', 'short_name', str.lower),
+        RecordField('OPF', 'company_type'),
+        RecordField('ADDRESS', 'address'),
+        RecordField('AUTHORIZED_CAPITAL', 'authorized_capital', lambda value: float(value.replace(',', '.'))),
+        RecordField('STAN', 'status'),
+        RecordField('STATUTE', 'bylaw'),
+        RecordField('REGISTRATION', 'registration'),
+        RecordField('CONTACTS', 'contact_info'),
+        RecordField('CURRENT_AUTHORITY', 'authority'),
+        RecordField('FOUNDING_DOCUMENT_NUM', 'founding_document_number'),
+        RecordField('EXECUTIVE_POWER', 'executive_power', str.lower),
+        RecordField('SUPERIOR_MANAGEMENT', 'superior_management', str.lower),
+        RecordField('MANAGING_PAPER', 'managing_paper', str.lower),
+        RecordField('TERMINATED_INFO', 'terminated_info', str.lower),
+        RecordField('TERMINATION_CANCEL_INFO', 'termination_cancel_info', str.lower),
+        RecordField('VP_DATES', 'vp_dates'),
+        RecordField('FOUNDERS', 'founders', many=True),
+        RecordField('BENEFICIARIES', 'beneficiaries', many=True),
+        RecordField('SIGNERS', 'signers', many=True),
+        RecordField('ACTIVITY_KINDS', 'kveds', schema=KVED_SCHEMA, many=True),
+        RecordField('PREDECESSORS', 'predecessors', schema=RELATED_COMPANY_SCHEMA, many=True),
+        RecordField('ASSIGNEES', 'assignees', schema=RELATED_COMPANY_SCHEMA, many=True),
+        RecordField('EXCHANGE_DATA', 'exchange_data', schema=EXCHANGE_DATA_SCHEMA, many=True),
+        RecordField('TERMINATION_STARTED_INFO', 'termination_started', schema=TERMINATION_STARTED_SCHEMA),
+        RecordField('BANKRUPTCY_READJUSTMENT_INFO', 'bancruptcy_readjustment',
+                    schema=BANKRUPTCY_READJUSTMENT_SCHEMA),
+    )
+    DETAIL_FIELDS = ('founding_document_number', 'executive_power', 'superior_management', 'managing_paper',
+                     'terminated_info', 'termination_cancel_info', 'vp_dates')
+    TERMINATION_STARTED_FIELDS = ('op_date', 'reason', 'sbj_state', 'signer_name', 'creditor_reg_end_date')
+    BANCRUPTCY_READJUSTMENT_FIELDS = ('op_date', 'reason', 'sbj_state', 'head_name')
 
     def __init__(self):
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_FULL
         self.LOCAL_FOLDER = settings.LOCAL_FOLDER
         self.CHUNK_SIZE = settings.CHUNK_SIZE_UO_FULL
+        self.WORKERS = settings.WORKERS_UO_FULL
         self.RECORD_TAG = 'SUBJECT'
-        self.bulk_manager = BulkCreateManager()
-        self.branch_bulk_manager = BulkCreateManager()
-        self.all_bylaw_dict = self.put_objects_to_dict("name", "business_register", "Bylaw")
+        self.PARTITION_TAG = 'EDRPOU'
+        self.STAGING_MERGE = settings.STAGING_MERGE_UO_FULL
+        self.bulk_manager = CopyBulkCreateManager()
+        self.branch_bulk_manager = CopyBulkCreateManager()
+        self.founders_updater = ChildrenUpdater(
+            Founder, 'company', ('name',),
+            ('info', 'info_beneficiary', 'edrpou', 'address', 'equity', 'country', 'is_beneficiary', 'is_founder'),
+            self.bulk_manager
+        )
+        self.signers_updater = ChildrenUpdater(Signer, 'company', ('name',), (), self.bulk_manager)
+        self.assignees_updater = ChildrenUpdater(Assignee, 'company', ('name', 'edrpou'), (), self.bulk_manager)
+        self.company_to_kved_updater = ChildrenUpdater(
+            CompanyToKved, 'company', ('kved',), ('primary_kved',), self.bulk_manager
+        )
+        self.exchange_data_updater = ChildrenUpdater(
+            ExchangeDataCompany, 'company', ('authority', 'start_date'),
+            ('taxpayer_type', 'start_number', 'end_date', 'end_number'),
+            self.bulk_manager
+        )
+        self.company_to_predecessor_updater = ChildrenUpdater(
+            CompanyToPredecessor, 'company', ('predecessor',), (), self.bulk_manager
+        )
+        self.children_updaters = (
+            self.founders_updater, self.signers_updater, self.assignees_updater, self.company_to_kved_updater,
+            self.exchange_data_updater, self.company_to_predecessor_updater
+        )
         self.all_predecessors_dict = self.put_objects_to_dict("name", "business_register", "Predecessor")
         self.all_companies_dict = {}
         self.branch_to_parent = {}
@@ -52,30 +137,17 @@ class UkrCompanyFullConverter(CompanyConverter):
         self.exchange_data_to_dict = {}
         self.company_country = AddressConverter().save_or_get_country('Ukraine')
         self.source = Company.UKRAINE_REGISTER
-        self.already_stored_companies =\
-            list(Company.objects.filter(source=Company.UKRAINE_REGISTER).values_list('id', flat=True))
-        self.uptodated_companies = []
+        self.companies_tracker = IdTracker(
+            Company.objects.filter(source=Company.UKRAINE_REGISTER).values_list('id', flat=True).iterator()
+        )
         self.invalid_data_counter = 0
+        self.skipped_records_counter = 0
         super().__init__()
 
-    def save_or_get_bylaw(self, bylaw_from_record):
-        if bylaw_from_record not in self.all_bylaw_dict:
-            new_bylaw = Bylaw.objects.create(name=bylaw_from_record)
-            self.all_bylaw_dict[bylaw_from_record] = new_bylaw
-            return new_bylaw
-        return self.all_bylaw_dict[bylaw_from_record]
-
-    def save_or_get_predecessor(self, item):
-        if item.xpath('NAME')[0].text not in self.all_predecessors_dict or \
-                (hasattr(self.all_predecessors_dict, item.xpath('NAME')[0].text) and item.xpath('CODE')[0].text != \
-                 self.all_predecessors_dict[item.xpath('NAME')[0].text].code):
-            new_predecessor = Predecessor.objects.create(
-                name=item.xpath('NAME')[0].text.lower(),
-                edrpou=item.xpath('CODE')[0].text
-            )
-            self.all_predecessors_dict[item.xpath('NAME')[0].text] = new_predecessor
-            return new_predecessor
-        return self.all_predecessors_dict[item.xpath('NAME')[0].text]
+    def save_or_get_predecessor(self, name, edrpou):
+        if name not in self.all_predecessors_dict:
+            self.all_predecessors_dict[name] = Predecessor.objects.create(name=name.lower(), edrpou=edrpou)
+        return self.all_predecessors_dict[name]
 
     def extract_detail_founder_data(self, founder_info):
         info_to_list = founder_info.split(',')
@@ -148,27 +220,27 @@ class UkrCompanyFullConverter(CompanyConverter):
 
     def add_founders(self, founders_from_record, beneficiaries_from_record, code):
         self.founder_to_dict[code] = []
-        for item in founders_from_record:
-            info = item.text
+        beneficiaries_from_record = [beneficiary for beneficiary in beneficiaries_from_record if beneficiary]
+        for info in founders_from_record:
             # checking if field contains data
             if not info or info.endswith('ВІДСУТНІЙ'):
                 continue
             # checking if there is additional data except name
-            if ',' in item.text:
-                name, edrpou, address, equity = self.extract_detail_founder_data(item.text)
+            if ',' in info:
+                name, edrpou, address, equity = self.extract_detail_founder_data(info)
                 name = name.lower()
             else:
-                name = item.text.lower()
+                name = info.lower()
                 edrpou, equity, address = None, None, None
             country = None
             is_beneficiary = False
             info_beneficiary = None
             for beneficiary in beneficiaries_from_record:
                 name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary =\
-                    self.extract_beneficiary_data(beneficiary.text)
+                    self.extract_beneficiary_data(beneficiary)
                 name_beneficiary = name_beneficiary.lower()
                 if name_beneficiary == name:
-                    info_beneficiary = beneficiary.text
+                    info_beneficiary = beneficiary
                     country = country_beneficiary.lower()
                     address = address_beneficiary
                     edrpou = edrpou_beneficiary or edrpou
@@ -189,9 +261,9 @@ class UkrCompanyFullConverter(CompanyConverter):
             self.founder_to_dict[code].append(founder)
         for beneficiary in beneficiaries_from_record:
             name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary = \
-                self.extract_beneficiary_data(beneficiary.text)
+                self.extract_beneficiary_data(beneficiary)
             name = name_beneficiary.lower()
-            info_beneficiary = beneficiary.text
+            info_beneficiary = beneficiary
             country = country_beneficiary.lower() if country_beneficiary else None
             address = address_beneficiary
             founder = Founder(
@@ -206,747 +278,414 @@ class UkrCompanyFullConverter(CompanyConverter):
             self.founder_to_dict[code].append(founder)
 
     def update_founders(self, founders_from_record, beneficiaries_from_record, company):
-        already_stored_founders = list(Founder.include_deleted_objects.filter(company_id=company.id))
-        for item in founders_from_record:
-            info = item.text
-            # checking if field contains data
-            if not info or info.endswith('ВІДСУТНІЙ'):
-                continue
-            # checking if there is additional data except name
-            if ',' in item.text:
-                name, edrpou, address, equity = self.extract_detail_founder_data(item.text)
-                name = name.lower()
-            else:
-                name = item.text.lower()
-                edrpou, equity, address = None, None, None
-            country = None
-            is_beneficiary = False
-            info_beneficiary = None
-            for beneficiary in beneficiaries_from_record:
-                name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary = \
-                    self.extract_beneficiary_data(beneficiary.text)
-                name_beneficiary = name_beneficiary.lower()
-                if name_beneficiary == name:
-                    info_beneficiary = beneficiary.text
-                    country = country_beneficiary.lower()
-                    address = address_beneficiary
-                    edrpou = edrpou_beneficiary or edrpou
-                    is_beneficiary = True
-                    beneficiaries_from_record.remove(beneficiary)
-                    break
-            already_stored = False
-            if len(already_stored_founders):
-                for stored_founder in already_stored_founders:
-                    if stored_founder.name == name:
-                        already_stored = True
-                        if stored_founder.info != info or stored_founder.info_beneficiary != info_beneficiary:
-                            update_fields = []
-                            stored_founder.info = info
-                            stored_founder.info_beneficiary = info_beneficiary
-                            update_fields.extend(['info', 'info_beneficiary'])
-                            if stored_founder.is_beneficiary != is_beneficiary:
-                                stored_founder.is_beneficiary = is_beneficiary
-                                update_fields.append('is_beneficiary')
-                            if address and stored_founder.address != address:
-                                stored_founder.address = address
-                                update_fields.append('address')
-                            if equity and stored_founder.equity != equity:
-                                stored_founder.equity = equity
-                                update_fields.append('equity')
-                            if edrpou and stored_founder.edrpou != edrpou:
-                                stored_founder.edrpou = edrpou
-                                update_fields.append('edrpou')
-                            if country and stored_founder.country != country:
-                                stored_founder.country = country
-                                update_fields.append('country')
-                            if stored_founder.deleted_at:
-                                stored_founder.deleted_at = None
-                                update_fields.append('deleted_at')
-                            if update_fields:
-                                update_fields.append('updated_at')
-                                stored_founder.save(update_fields=update_fields)
-                        already_stored_founders.remove(stored_founder)
-                        break
-            if not already_stored:
-                founder = Founder(
-                    company_id=company.id,
-                    info=info,
-                    info_beneficiary=info_beneficiary,
-                    name=name,
-                    edrpou=edrpou,
-                    address=address,
-                    equity=equity,
-                    country=country,
-                    is_beneficiary=is_beneficiary,
-                    is_founder=True
-                )
-                self.bulk_manager.add(founder)
-        for beneficiary in beneficiaries_from_record:
-            name_beneficiary, country_beneficiary, address_beneficiary, edrpou_beneficiary = \
-                self.extract_beneficiary_data(beneficiary.text)
-            name = name_beneficiary.lower()
-            info_beneficiary = beneficiary.text
-            if country_beneficiary:
-                country_beneficiary = country_beneficiary.lower()
-            already_stored = False
-            if len(already_stored_founders):
-                for stored_founder in already_stored_founders:
-                    if stored_founder.name == name:
-                        already_stored = True
-                        if stored_founder.info_beneficiary != info_beneficiary:
-                            stored_founder.info_beneficiary = info_beneficiary
-                            stored_founder.address = address_beneficiary
-                            stored_founder.country = country_beneficiary
-                            stored_founder.edrpou = edrpou_beneficiary
-                            stored_founder.is_beneficiary = True
-                            stored_founder.is_founder = False
-                            update_fields = ['info_beneficiary', 'address', 'country', 'edrpou', 'is_beneficiary',
-                                             'is_founder']
-                            if stored_founder.deleted_at:
-                                stored_founder.deleted_at = None
-                                update_fields.append('deleted_at')
-                            update_fields.append('updated_at')
-                            stored_founder.save(update_fields=update_fields)
-                        already_stored_founders.remove(stored_founder)
-                        break
-            if not already_stored:
-                founder = Founder(
-                    company_id=company.id,
-                    info_beneficiary=info_beneficiary,
-                    name=name,
-                    address=address_beneficiary,
-                    country=country_beneficiary,
-                    edrpou=edrpou_beneficiary,
-                    is_beneficiary=True,
-                    is_founder=False
-                )
+        self.add_founders(founders_from_record, beneficiaries_from_record, company.code)
+        self.founders_updater.update(company, self.founder_to_dict.pop(company.code))
 
-                if country_beneficiary and len(country_beneficiary) > 100:
-                    print('country', country_beneficiary, 'name', name, 'address', address)
-                self.bulk_manager.add(founder)
-        if len(already_stored_founders):
-            for outdated_founder in already_stored_founders:
-                outdated_founder.soft_delete()
-
-    def add_company_detail(self, founding_document_number, executive_power, superior_management,
-                           managing_paper, terminated_info, termination_cancel_info, vp_dates,
-                           code):
-        company_detail = CompanyDetail()
-        company_detail.founding_document_number = founding_document_number
-        company_detail.executive_power = executive_power
-        company_detail.superior_management = superior_management
-        company_detail.managing_paper = managing_paper
-        company_detail.terminated_info = terminated_info
-        company_detail.termination_cancel_info = termination_cancel_info
-        company_detail.vp_dates = vp_dates
-        self.company_detail_to_dict[code] = company_detail
-
-    def update_company_detail(self, founding_document_number, executive_power, superior_management,
-                              managing_paper, terminated_info, termination_cancel_info, vp_dates,
-                              company):
+    def add_company_detail(self, data, code):
+        self.company_detail_to_dict[code] = CompanyDetail(**{field: data[field] for field in self.DETAIL_FIELDS})
+
+    def update_company_detail(self, data, company):
         company_detail = CompanyDetail.include_deleted_objects.filter(company_id=company.id).first()
         if company_detail:
-            update_fields = []
-            if company_detail.founding_document_number != founding_document_number:
-                company_detail.founding_document_number = founding_document_number
-                update_fields.append('founding_document_number')
-            if company_detail.executive_power != executive_power:
-                company_detail.executive_power = executive_power
-                update_fields.append('executive_power')
-            if company_detail.superior_management != superior_management:
-                company_detail.superior_management = superior_management
-                update_fields.append('superior_management')
-            if company_detail.managing_paper != managing_paper:
-                company_detail.managing_paper = managing_paper
-                update_fields.append('managing_paper')
-            if company_detail.terminated_info != terminated_info:
-                company_detail.terminated_info = terminated_info
-                update_fields.append('terminated_info')
-            if company_detail.termination_cancel_info != termination_cancel_info:
-                company_detail.termination_cancel_info = termination_cancel_info
-                update_fields.append('termination_cancel_info')
-            if company_detail.vp_dates != vp_dates:
-                company_detail.vp_dates = vp_dates
-                update_fields.append('vp_dates')
-            if company_detail.deleted_at:
-                company_detail.deleted_at = None
-                update_fields.append('deleted_at')
-            if len(update_fields):
-                update_fields.append('updated_at')
-                company_detail.save(update_fields=update_fields)
+            self.update_child(company_detail, {field: data[field] for field in self.DETAIL_FIELDS})
         else:
-            company_detail = CompanyDetail()
-            company_detail.founding_document_number = founding_document_number
-            company_detail.executive_power = executive_power
-            company_detail.superior_management = superior_management
-            company_detail.managing_paper = managing_paper
-            company_detail.terminated_info = terminated_info
-            company_detail.termination_cancel_info = termination_cancel_info
-            company_detail.vp_dates = vp_dates
+            company_detail = CompanyDetail(**{field: data[field] for field in self.DETAIL_FIELDS})
             company_detail.company = company
             self.bulk_manager.add(company_detail)
 
+    def update_child(self, child, values):
+        """Saves changed values of the stored child of the company and restores it if it is deleted"""
+        update_fields = []
+        for field_name, value in values.items():
+            if getattr(child, field_name) != value:
+                setattr(child, field_name, value)
+                update_fields.append(field_name)
+        if child.deleted_at:
+            child.deleted_at = None
+            update_fields.append('deleted_at')
+        if update_fields:
+            update_fields.append('updated_at')
+            child.save(update_fields=update_fields)
+
     def add_assignees(self, assignees_from_record, code):
         assignees = []
         for item in assignees_from_record:
-            assignee = Assignee()
-            if item.xpath('NAME')[0].text:
-                assignee.name = item.xpath('NAME')[0].text.lower()
-            else:
-                assignee.name = ''
-            assignee.edrpou = item.xpath('CODE')[0].text
-            if not assignee.edrpou:
-                assignee.edrpou = ''
+            assignee = Assignee(name=(item['name'] or '').lower(), edrpou=item['code'] or '')
             if assignee.name or assignee.edrpou:
                 assignees.append(assignee)
         self.assignee_to_dict[code] = assignees
 
     def update_assignees(self, assignees_from_record, company):
-        already_stored_assignees = list(Assignee.include_deleted_objects.filter(company_id=company.id))
-        for item in assignees_from_record:
-            name = item.xpath('NAME')[0].text
-            if name:
-                name = name.lower()
-            else:
-                name = ''
-            edrpou = item.xpath('CODE')[0].text
-            if not edrpou:
-                edrpou = ''
-            if not name and not edrpou:
-                continue
-            already_stored = False
-            if len(already_stored_assignees):
-                for stored_assignee in already_stored_assignees:
-                    if stored_assignee.name == name and stored_assignee.edrpou == edrpou:
-                        already_stored = True
-                        if stored_assignee.deleted_at:
-                            stored_assignee.deleted_at = None
-                            stored_assignee.save(update_fields=['deleted_at', 'updated_at'])
-                        already_stored_assignees.remove(stored_assignee)
-                        break
-            if not already_stored:
-                assignee = Assignee()
-                assignee.name = name
-                assignee.edrpou = edrpou
-                assignee.company = company
-                self.bulk_manager.add(assignee)
-        if len(already_stored_assignees):
-            for outdated_assignees in already_stored_assignees:
-                outdated_assignees.soft_delete()
-
-    def add_bancruptcy_readjustment(self, record, code):
-        bancruptcy_readjustment = BancruptcyReadjustment()
-        bancruptcy_readjustment.op_date = format_date_to_yymmdd(
-            record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE')[0].text) or None
-        bancruptcy_readjustment.reason = record.xpath(
-            'BANKRUPTCY_READJUSTMENT_INFO/REASON')[0].text.lower()
-        bancruptcy_readjustment.sbj_state = record.xpath(
-            'BANKRUPTCY_READJUSTMENT_INFO/SBJ_STATE')[0].text.lower()
-        if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME'):
-            head_name = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME')[0].text
-            if head_name:
-                bancruptcy_readjustment.head_name = head_name.lower()
-        self.bancruptcy_readjustment_to_dict[code] = bancruptcy_readjustment
-
-    def update_bancruptcy_readjustment(self, record, company):
+        self.add_assignees(assignees_from_record, company.code)
+        self.assignees_updater.update(company, self.assignee_to_dict.pop(company.code))
+
+    def add_bancruptcy_readjustment(self, bancruptcy_readjustment_from_record, code):
+        self.bancruptcy_readjustment_to_dict[code] = BancruptcyReadjustment(**{
+            field: bancruptcy_readjustment_from_record[field] for field in self.BANCRUPTCY_READJUSTMENT_FIELDS
+        })
+
+    def update_bancruptcy_readjustment(self, bancruptcy_readjustment_from_record, company):
         already_stored_bancruptcy_readjustment = \
             BancruptcyReadjustment.include_deleted_objects.filter(company_id=company.id).first()
-        if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE'):
-            op_date = format_date_to_yymmdd(record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE')[0].text) or None
-            reason = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/REASON')[0].text.lower()
-            sbj_state = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/SBJ_STATE')[0].text.lower()
-            if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME'):
-                head_name = record.xpath('BANKRUPTCY_READJUSTMENT_INFO/BANKRUPTCY_READJUSTMENT_HEAD_NAME')[0].text
-                if head_name:
-                    head_name = head_name.lower()
-            else:
-                head_name = None
+        if bancruptcy_readjustment_from_record:
+            values = {
+                field: bancruptcy_readjustment_from_record[field] for field in self.BANCRUPTCY_READJUSTMENT_FIELDS
+            }
             if not already_stored_bancruptcy_readjustment:
-                bancruptcy_readjustment = BancruptcyReadjustment()
-                bancruptcy_readjustment.company = company
-                bancruptcy_readjustment.op_date = op_date
-                bancruptcy_readjustment.reason = reason
-                bancruptcy_readjustment.sbj_state = sbj_state
-                bancruptcy_readjustment.head_name = head_name
-                self.bulk_manager.add(bancruptcy_readjustment)
-                return
+                self.bulk_manager.add(BancruptcyReadjustment(company=company, **values))
             else:
-                update_fields = []
-                if already_stored_bancruptcy_readjustment.op_date != op_date:
-                    already_stored_bancruptcy_readjustment.op_date = op_date
-                    update_fields.append('op_date')
-                if already_stored_bancruptcy_readjustment.reason != reason:
-                    already_stored_bancruptcy_readjustment.reason = reason
-                    update_fields.append('reason')
-                if already_stored_bancruptcy_readjustment.sbj_state != sbj_state:
-                    already_stored_bancruptcy_readjustment.sbj_state = sbj_state
-                    update_fields.append('sbj_state')
-                if already_stored_bancruptcy_readjustment.head_name != head_name:
-                    already_stored_bancruptcy_readjustment.head_name = head_name
-                    update_fields.append('head_name')
-                if already_stored_bancruptcy_readjustment.deleted_at:
-                    already_stored_bancruptcy_readjustment.deleted_at = None
-                    update_fields.append('deleted_at')
-                if len(update_fields):
-                    update_fields.append('updated_at')
-                    already_stored_bancruptcy_readjustment.save(update_fields=update_fields)
+                self.update_child(already_stored_bancruptcy_readjustment, values)
         elif already_stored_bancruptcy_readjustment:
             already_stored_bancruptcy_readjustment.soft_delete()
 
     def add_company_to_kved(self, kveds_from_record, code):
         company_to_kveds = []
         for item in kveds_from_record:
-            if not item.xpath('NAME'):
-                continue
-            kved_code = item.xpath('CODE')[0].text
-            kved_name = item.xpath('NAME')[0].text
-            if not kved_name:
-                continue
-            if not kved_code:
-                kved_code = ''
             company_to_kved = CompanyToKved()
-            company_to_kved.kved = self.get_kved_from_DB(kved_code, kved_name)
-            if item.xpath('PRIMARY'):
-                company_to_kved.primary_kved = item.xpath('PRIMARY')[0].text == "так"
+            company_to_kved.kved = self.get_kved_from_DB(item['code'] or '', item['name'])
+            company_to_kved.primary_kved = item['is_primary'] or False
             company_to_kveds.append(company_to_kved)
         self.company_to_kved_to_dict[code] = company_to_kveds
 
     def update_company_to_kved(self, kveds_from_record, company):
-        already_stored_company_to_kved = list(CompanyToKved.include_deleted_objects.filter(company_id=company.id))
-        for item in kveds_from_record:
-            if not item.xpath('NAME'):
-                continue
-            kved_code = item.xpath('CODE')[0].text
-            kved_name = item.xpath('NAME')[0].text
-            if not kved_name:
-                continue
-            if not kved_code:
-                kved_code = ''
-            already_stored = False
-            kved_from_db = self.get_kved_from_DB(kved_code, kved_name)
-            if len(already_stored_company_to_kved):
-                for stored_company_to_kved in already_stored_company_to_kved:
-                    if stored_company_to_kved.kved_id == kved_from_db.id:
-                        already_stored = True
-                        update_fields = []
-                        if item.xpath('PRIMARY'):
-                            if stored_company_to_kved.primary_kved != (item.xpath('PRIMARY')[0].text == "так"):
-                                stored_company_to_kved.primary_kved = item.xpath('PRIMARY')[0].text == "так"
-                                update_fields.append('primary_kved')
-                        if stored_company_to_kved.deleted_at:
-                            stored_company_to_kved.deleted_at = None
-                            update_fields.append('deleted_at')
-                        if len(update_fields):
-                            update_fields.append('updated_at')
-                            stored_company_to_kved.save(update_fields=update_fields)
-                        already_stored_company_to_kved.remove(stored_company_to_kved)
-                        break
-            if not already_stored:
-                company_to_kved = CompanyToKved()
-                company_to_kved.company = company
-                company_to_kved.kved = kved_from_db
-                if item.xpath('PRIMARY'):
-                    company_to_kved.primary_kved = item.xpath('PRIMARY')[0].text == "так"
-                self.bulk_manager.add(company_to_kved)
-        if len(already_stored_company_to_kved):
-            for outdated_company_to_kved in already_stored_company_to_kved:
-                outdated_company_to_kved.soft_delete()
+        self.add_company_to_kved(kveds_from_record, company.code)
+        self.company_to_kved_updater.update(company, self.company_to_kved_to_dict.pop(company.code))
 
     def add_exchange_data(self, exchange_data_from_record, code):
         exchange_datas = []
         for item in exchange_data_from_record:
-            if item.xpath('AUTHORITY_NAME') and item.xpath('AUTHORITY_NAME')[0].text:
-                exchange_data = ExchangeDataCompany()
-                exchange_data.authority = self.save_or_get_authority(item.xpath(
-                    'AUTHORITY_NAME')[0].text)
-                if item.xpath('TAX_PAYER_TYPE'):
-                    taxpayer_type = item.xpath('TAX_PAYER_TYPE')[0].text
-                    exchange_data.taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_type)
-                if item.xpath('START_DATE'):
-                    exchange_data.start_date = format_date_to_yymmdd(
-                        item.xpath('START_DATE')[0].text) or None
-                if item.xpath('START_NUM'):
-                    exchange_data.start_number = item.xpath('START_NUM')[0].text
-                if item.xpath('END_DATE'):
-                    exchange_data.end_date = format_date_to_yymmdd(
-                        item.xpath('END_DATE')[0].text) or None
-                if item.xpath('END_NUM'):
-                    exchange_data.end_number = item.xpath('END_NUM')[0].text
-                exchange_datas.append(exchange_data)
-            self.exchange_data_to_dict[code] = exchange_datas
+            if not item['authority']:
+                continue
+            exchange_data = ExchangeDataCompany()
+            exchange_data.authority = self.save_or_get_authority(item['authority'])
+            if item['taxpayer_type']:
+                exchange_data.taxpayer_type = self.save_or_get_taxpayer_type(item['taxpayer_type'])
+            exchange_data.start_date = item['start_date']
+            exchange_data.start_number = item['start_number']
+            exchange_data.end_date = item['end_date']
+            exchange_data.end_number = item['end_number']
+            exchange_datas.append(exchange_data)
+        self.exchange_data_to_dict[code] = exchange_datas
 
     def update_exchange_data(self, exchange_data_from_record, company):
-        already_stored_exchange_data = list(ExchangeDataCompany.include_deleted_objects.filter(company_id=company.id))
-        for item in exchange_data_from_record:
-            if not item.xpath('NAME'):
-                continue
-            authority = self.save_or_get_authority(item.xpath('AUTHORITY_NAME')[0].text)
-            taxpayer_type = item.xpath('TAX_PAYER_TYPE')[0].text
-            start_date, end_date = None, None
-            if taxpayer_type:
-                taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_type)
-            if item.xpath('START_DATE')[0].text:
-                start_date = format_date_to_yymmdd(item.xpath('START_DATE')[0].text) or None
-            start_number = item.xpath('START_NUM')[0].text
-            if item.xpath('END_DATE')[0].text:
-                end_date = format_date_to_yymmdd(item.xpath('END_DATE')[0].text) or None
-            end_number = item.xpath('END_NUM')[0].text
-            already_stored = False
-            if len(already_stored_exchange_data):
-                for stored_exchange_data in already_stored_exchange_data:
-                    if stored_exchange_data.authority_id == authority.id and \
-                            stored_exchange_data.start_date == start_date:
-                        already_stored = True
-                        update_fields = []
-                        if stored_exchange_data.start_number != start_number:
-                            stored_exchange_data.start_number = start_number
-                            update_fields.append('start_number')
-                        if stored_exchange_data.taxpayer_type_id != taxpayer_type.id:
-                            stored_exchange_data.taxpayer_type = taxpayer_type
-                            update_fields.append('taxpayer_type')
-                        if stored_exchange_data.end_date != end_date:
-                            stored_exchange_data.end_date = end_date
-                            update_fields.append('end_date')
-                        if stored_exchange_data.end_number != end_number:
-                            stored_exchange_data.end_number = end_number
-                            update_fields.append('end_number')
-                        if stored_exchange_data.deleted_at:
-                            stored_exchange_data.deleted_at = None
-                            update_fields.append('deleted_at')
-                        if len(update_fields):
-                            update_fields.append('updated_at')
-                            stored_exchange_data.save(update_fields=update_fields)
-                        already_stored_exchange_data.remove(stored_exchange_data)
-            if not already_stored:
-                exchange_data = ExchangeDataCompany()
-                exchange_data.authority = authority
-                exchange_data.taxpayer_type = taxpayer_type
-                exchange_data.start_date = start_date
-                exchange_data.start_number = start_number
-                exchange_data.end_date = end_date
-                exchange_data.end_number = end_number
-                exchange_data.company = company
-                self.bulk_manager.add(exchange_data)
-        if len(already_stored_exchange_data):
-            for outdated_exchange_data in already_stored_exchange_data:
-                outdated_exchange_data.soft_delete()
+        self.add_exchange_data(exchange_data_from_record, company.code)
+        self.exchange_data_updater.update(company, self.exchange_data_to_dict.pop(company.code, []))
 
     def add_company_to_predecessors(self, predecessors_from_record, code):
         company_to_predecessors = []
         for item in predecessors_from_record:
-            if item.xpath('NAME')[0].text:
+            if item['name']:
                 company_to_predecessor = CompanyToPredecessor()
-                company_to_predecessor.predecessor = self.save_or_get_predecessor(item)
+                company_to_predecessor.predecessor = self.save_or_get_predecessor(item['name'], item['code'])
                 company_to_predecessors.append(company_to_predecessor)
         self.company_to_predecessor_to_dict[code] = company_to_predecessors
 
     def update_company_to_predecessors(self, predecessors_from_record, company):
-        already_stored_company_to_predecessors = \
-            list(CompanyToPredecessor.include_deleted_objects.filter(company_id=company.id))
-        for item in predecessors_from_record:
-            if item.xpath('NAME')[0].text:
-                already_stored = False
-                predecessor = self.save_or_get_predecessor(item)
-                if len(already_stored_company_to_predecessors):
-                    for stored_predecessor in already_stored_company_to_predecessors:
-                        if stored_predecessor.predecessor_id == predecessor.id:
-                            already_stored = True
-                            if stored_predecessor.deleted_at:
-                                stored_predecessor.deleted_at = None
-                                stored_predecessor.save(update_fields=['deleted_at', 'updated_at'])
-                            already_stored_company_to_predecessors.remove(stored_predecessor)
-                            break
-                if not already_stored:
-                    company_to_predecessor = CompanyToPredecessor()
-                    company_to_predecessor.predecessor = predecessor
-                    company_to_predecessor.company = company
-                    self.bulk_manager.add(company_to_predecessor)
-        if len(already_stored_company_to_predecessors):
-            for outdated_company_to_predecessors in already_stored_company_to_predecessors:
-                outdated_company_to_predecessors.soft_delete()
+        self.add_company_to_predecessors(predecessors_from_record, company.code)
+        self.company_to_predecessor_updater.update(company, self.company_to_predecessor_to_dict.pop(company.code))
 
     def add_signers(self, signers_from_record, code):
-        signers = []
-        for item in signers_from_record:
-            signer = Signer()
-            signer.name = item.text[:389].lower()
-            signers.append(signer)
-        self.signer_to_dict[code] = signers
+        self.signer_to_dict[code] = [Signer(name=name[:389].lower()) for name in signers_from_record if name]
 
     def update_signers(self, signers_from_record, company):
-        already_stored_signers = list(Signer.include_deleted_objects.filter(company_id=company.id))
-        for item in signers_from_record:
-            already_stored = False
-            if len(already_stored_signers):
-                for stored_signer in already_stored_signers:
-                    if stored_signer.name == item.text[:389].lower():
-                        already_stored = True
-                        if stored_signer.deleted_at:
-                            stored_signer.deleted_at = None
-                            stored_signer.save(update_fields=['deleted_at', 'updated_at'])
-                        already_stored_signers.remove(stored_signer)
-                        break
-            if not already_stored:
-                signer = Signer()
-                signer.name = item.text[:389].lower()
-                signer.company = company
-                self.bulk_manager.add(signer)
-        if len(already_stored_signers):
-            for outdated_signers in already_stored_signers:
-                outdated_signers.soft_delete()
-
-    def add_termination_started(self, record, code):
-        termination_started = TerminationStarted()
-        if record.xpath('TERMINATION_STARTED_INFO/OP_DATE')[0].text:
-            termination_started.op_date = format_date_to_yymmdd(
-                record.xpath('TERMINATION_STARTED_INFO/OP_DATE')[0].text) or None
-        termination_started.reason = record.xpath('TERMINATION_STARTED_INFO'
-                                                  '/REASON')[0].text.lower()
-        termination_started.sbj_state = record.xpath(
-            'TERMINATION_STARTED_INFO/SBJ_STATE')[0].text.lower()
-        if record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME'):
-            signer_name = record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME')[0].text
-            if signer_name:
-                termination_started.signer_name = signer_name.lower()
-        if record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE'):
-            termination_started.creditor_reg_end_date = format_date_to_yymmdd(
-                record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE')[0].text) or '1990-01-01'
-        self.termination_started_to_dict[code] = termination_started
-
-    def update_termination_started(self, record, company):
+        self.add_signers(signers_from_record, company.code)
+        self.signers_updater.update(company, self.signer_to_dict.pop(company.code))
+
+    def get_termination_started_values(self, termination_started_from_record):
+        values = {field: termination_started_from_record[field] for field in self.TERMINATION_STARTED_FIELDS}
+        values['creditor_reg_end_date'] = values['creditor_reg_end_date'] or '1990-01-01'
+        return values
+
+    def add_termination_started(self, termination_started_from_record, code):
+        self.termination_started_to_dict[code] = TerminationStarted(
+            **self.get_termination_started_values(termination_started_from_record)
+        )
+
+    def update_termination_started(self, termination_started_from_record, company):
         already_stored_termination_started = \
             TerminationStarted.include_deleted_objects.filter(company_id=company.id).first()
-        if record.xpath('TERMINATION_STARTED_INFO/OP_DATE'):
-            op_date = format_date_to_yymmdd(record.xpath('TERMINATION_STARTED_INFO/OP_DATE')[0].text) or None
-            reason = record.xpath('TERMINATION_STARTED_INFO/REASON')[0].text.lower()
-            sbj_state = record.xpath('TERMINATION_STARTED_INFO/SBJ_STATE')[0].text.lower()
-            if record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME'):
-                signer_name = record.xpath('TERMINATION_STARTED_INFO/SIGNER_NAME')[0].text
-                if signer_name:
-                    signer_name = signer_name.lower()
-            else:
-                signer_name = None
-            if record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE'):
-                creditor_reg_end_date = format_date_to_yymmdd(
-                    record.xpath('TERMINATION_STARTED_INFO/CREDITOR_REQ_END_DATE')[0].text) or '1990-01-01'
-            else:
-                creditor_reg_end_date = '1990-01-01'
+        if termination_started_from_record:
+            values = self.get_termination_started_values(termination_started_from_record)
             if not already_stored_termination_started:
-                termination_started = TerminationStarted()
-                termination_started.company = company
-                termination_started.op_date = op_date
-                termination_started.reason = reason
-                termination_started.sbj_state = sbj_state
-                termination_started.signer_name = signer_name
-                termination_started.creditor_reg_end_date = creditor_reg_end_date
-                self.bulk_manager.add(termination_started)
-                return
+                self.bulk_manager.add(TerminationStarted(company=company, **values))
             else:
-                update_fields = []
-                if already_stored_termination_started.op_date != op_date:
-                    already_stored_termination_started.op_date = op_date
-                    update_fields.append('op_date')
-                if already_stored_termination_started.reason != reason:
-                    already_stored_termination_started.reason = reason
-                    update_fields.append('reason')
-                if already_stored_termination_started.sbj_state != sbj_state:
-                    already_stored_termination_started.sbj_state = sbj_state
-                    update_fields.append('sbj_state')
-                if already_stored_termination_started.signer_name != signer_name:
-                    already_stored_termination_started.signer_name = signer_name
-                    update_fields.append('signer_name')
-                if already_stored_termination_started.creditor_reg_end_date != creditor_reg_end_date:
-                    already_stored_termination_started.creditor_reg_end_date = creditor_reg_end_date
-                    update_fields.append('creditor_reg_end_date')
-                if already_stored_termination_started.deleted_at:
-                    already_stored_termination_started.deleted_at = None
-                    update_fields.append('deleted_at')
-                if len(update_fields):
-                    update_fields.append('updated_at')
-                    already_stored_termination_started.save(update_fields=update_fields)
+                self.update_child(already_stored_termination_started, values)
         elif already_stored_termination_started:
             already_stored_termination_started.soft_delete()
 
-    def save_to_db(self, records):
-        for record in records:
-            edrpou = record.xpath('EDRPOU')[0].text
-            if not edrpou:
+    def get_companies_data(self, records):
+        """
+        Returns values of Company fields, all the data extracted from the record and the fingerprint
+        for every valid record of the chunk
+        """
+        extracted_records = []
+        for record, fingerprint in records:
+            data = self.RECORD_SCHEMA.extract(record)
+            if not data:
                 self.invalid_data_counter += 1
                 log_records(record, self.LOCAL_FOLDER + 'invalid_companies.txt', self.invalid_data_counter)
                 continue
-            if record.xpath('NAME')[0].text:
-                name = record.xpath('NAME')[0].text.lower()
+            extracted_records.append((data, fingerprint))
+        self.prefetch_dimensions(data for data, _ in extracted_records)
+        return [(self.get_company_data(data), data, fingerprint) for data, fingerprint in extracted_records]
+
+    def get_company_data(self, data):
+        """Returns values of Company fields from the data extracted from the record"""
+        registration_date = None
+        registration_info = None
+        if data['registration']:
+            registration_date = format_date_to_yymmdd(get_first_word(data['registration']))
+            registration_info = cut_first_word(data['registration'])
+        company_type = data['company_type']
+        if company_type:
+            company_type = self.save_or_get_company_type(company_type, 'uk')
+        authority = data['authority']
+        if authority:
+            authority = self.save_or_get_authority(authority)
+        company_data = {
+            'name': data['name'],
+            'short_name': data['short_name'],
+            'company_type': company_type,
+            'edrpou': data['edrpou'],
+            'country': self.company_country,
+            'address': data['address'],
+            'authorized_capital': data['authorized_capital'],
+            'status': self.save_or_get_status(data['status']),
+            'bylaw': self.save_or_get_bylaw(data['bylaw']),
+            'registration_date': registration_date,
+            'registration_info': registration_info,
+            'contact_info': data['contact_info'],
+            'authority': authority or None,
+            'source': self.source,
+            'code': data['name'] + data['edrpou'],
+        }
+        return company_data
+
+    def add_company_children(self, data, code):
+        self.add_company_detail(data, code)
+        if data['kveds']:
+            self.add_company_to_kved(data['kveds'], code)
+        if data['signers']:
+            self.add_signers(data['signers'], code)
+        if data['termination_started']:
+            self.add_termination_started(data['termination_started'], code)
+        if data['bancruptcy_readjustment']:
+            self.add_bancruptcy_readjustment(data['bancruptcy_readjustment'], code)
+        if data['predecessors']:
+            self.add_company_to_predecessors(data['predecessors'], code)
+        if data['assignees']:
+            self.add_assignees(data['assignees'], code)
+        if data['exchange_data']:
+            self.add_exchange_data(data['exchange_data'], code)
+        self.add_founders(data['founders'], data['beneficiaries'], code)
+
+    def update_company_children(self, data, company):
+        self.update_company_detail(data, company)
+        self.time_it('update company details\t')
+        self.update_founders(data['founders'], data['beneficiaries'], company)
+        self.time_it('update founders\t\t')
+        self.update_company_to_kved(data['kveds'], company)
+        self.time_it('update kveds\t\t')
+        self.update_signers(data['signers'], company)
+        self.time_it('update signers\t\t')
+        self.update_termination_started(data['termination_started'], company)
+        self.time_it('update termination\t')
+        self.update_bancruptcy_readjustment(data['bancruptcy_readjustment'], company)
+        self.time_it('update bancruptcy\t')
+        self.update_company_to_predecessors(data['predecessors'], company)
+        self.time_it('update predecessors\t')
+        self.update_assignees(data['assignees'], company)
+        self.time_it('update assignes\t\t')
+        self.update_exchange_data(data['exchange_data'], company)
+        self.time_it('update exchange data\t')
+
+    def skip_unchanged_records(self, records):
+        """
+        Returns pairs of records and their fingerprints without records that are the same
+        as when the stored companies were saved. All fingerprints of the chunk are checked with one query.
+        """
+        fingerprints = [self.get_fingerprint(record) for record in records]
+        unchanged_companies = dict(Company.objects.filter(
+            source=self.source,
+            fingerprint__in=fingerprints
+        ).values_list('fingerprint', 'id'))
+        changed_records = []
+        for record, fingerprint in zip(records, fingerprints):
+            if fingerprint in unchanged_companies:
+                self.companies_tracker.mark(unchanged_companies[fingerprint])
+                self.skipped_records_counter += 1
             else:
-                self.invalid_data_counter += 1
-                log_records(record, self.LOCAL_FOLDER + 'invalid_companies.txt', self.invalid_data_counter)
-                continue
-            code = name + edrpou
-            address = record.xpath('ADDRESS')[0].text
-            founding_document_number = record.xpath('FOUNDING_DOCUMENT_NUM')[0].text
-            contact_info = record.xpath('CONTACTS')[0].text
-            vp_dates = record.xpath('VP_DATES')[0].text
-            short_name = record.xpath('SHORT_NAME')[0].text
-            if short_name:
-                short_name = short_name.lower()
-            executive_power = record.xpath('EXECUTIVE_POWER')[0].text
-            if executive_power:
-                executive_power = executive_power.lower()
-            superior_management = record.xpath('SUPERIOR_MANAGEMENT')[0].text
-            if superior_management:
-                superior_management = superior_management.lower()
-            managing_paper = record.xpath('MANAGING_PAPER')[0].text
-            if managing_paper:
-                managing_paper = managing_paper.lower()
-            terminated_info = record.xpath('TERMINATED_INFO')[0].text
-            if terminated_info:
-                terminated_info = terminated_info.lower()
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
-            if termination_cancel_info:
-                termination_cancel_info = termination_cancel_info.lower()
-            authorized_capital = record.xpath('AUTHORIZED_CAPITAL')[0].text
-            if authorized_capital:
-                authorized_capital = authorized_capital.replace(',', '.')
-                authorized_capital = float(authorized_capital)
-            registration_date = None
-            registration_info = None
-            registration = record.xpath('REGISTRATION')[0].text
-            if registration:
-                registration_date = format_date_to_yymmdd(get_first_word(registration))
-                registration_info = cut_first_word(registration)
-            company_type = record.xpath('OPF')[0].text
-            if company_type:
-                company_type = self.save_or_get_company_type(company_type, 'uk')
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            bylaw = self.save_or_get_bylaw(record.xpath('STATUTE')[0].text)
-            authority = record.xpath('CURRENT_AUTHORITY')[0].text
-            if authority:
-                authority = self.save_or_get_authority(authority)
-            else:
-                authority = None
-            self.time_it('getting data from record')
-
-            company = Company.include_deleted_objects.filter(code=code, source=Company.UKRAINE_REGISTER).first()
-            self.time_it('trying get companies\t')
+                changed_records.append((record, fingerprint))
+        self.time_it('skip unchanged records\t')
+        return changed_records
 
+    def save_to_db(self, records):
+        records = self.skip_unchanged_records(records)
+        if self.STAGING_MERGE:
+            self.merge_companies(records)
+            return
+        parsed_records = []
+        for company_data, record_data, fingerprint in self.get_companies_data(records):
+            company_data['fingerprint'] = fingerprint
+            parsed_records.append((company_data, record_data))
+        self.time_it('getting data from record')
+        stored_companies = self.get_stored_objects(
+            Company.include_deleted_objects.filter(source=Company.UKRAINE_REGISTER),
+            'code',
+            [company_data['code'] for company_data, _ in parsed_records]
+        )
+        self.prefetch_children(company.id for company in stored_companies.values())
+
+        for company_data, record_data in parsed_records:
+            code = company_data['code']
+            company = stored_companies.get(code)
             if not company:
-                company = Company(
-                    name=name,
-                    short_name=short_name,
-                    company_type=company_type,
-                    edrpou=edrpou,
-                    country=self.company_country,
-                    address=address,
-                    authorized_capital=authorized_capital,
-                    status=status,
-                    bylaw=bylaw,
-                    registration_date=registration_date,
-                    registration_info=registration_info,
-                    contact_info=contact_info,
-                    authority=authority,
-                    source=self.source,
-                    code=code
-                )
+                company = Company(**company_data)
                 self.bulk_manager.add(company)
-                self.add_company_detail(founding_document_number, executive_power, superior_management, managing_paper,
-                                        terminated_info, termination_cancel_info, vp_dates, code)
-                if len(record.xpath('ACTIVITY_KINDS')[0]):
-                    self.add_company_to_kved(record.xpath('ACTIVITY_KINDS')[0], code)
-                if len(record.xpath('SIGNERS')[0]):
-                    self.add_signers(record.xpath('SIGNERS')[0], code)
-                if record.xpath('TERMINATION_STARTED_INFO/OP_DATE'):
-                    self.add_termination_started(record, code)
-                if record.xpath('BANKRUPTCY_READJUSTMENT_INFO/OP_DATE'):
-                    self.add_bancruptcy_readjustment(record, code)
-                if len(record.xpath('PREDECESSORS')[0]):
-                    self.add_company_to_predecessors(record.xpath('PREDECESSORS')[0], code)
-                if len(record.xpath('ASSIGNEES')[0]):
-                    self.add_assignees(record.xpath('ASSIGNEES')[0], code)
-                if len(record.xpath('EXCHANGE_DATA')[0]):
-                    self.add_exchange_data(record.xpath('EXCHANGE_DATA')[0], code)
-                self.add_founders(record.xpath('FOUNDERS')[0] if len(record.xpath('FOUNDERS')[0]) else [],
-                                  record.xpath('BENEFICIARIES')[0] if len(record.xpath('BENEFICIARIES')[0]) else [],
-                                  code)
+                self.add_company_children(record_data, code)
                 self.time_it('save companies\t')
             else:
-                self.uptodated_companies.append(company.id)
+                self.companies_tracker.mark(company.id)
                 update_fields = []
-                if company.name != name:
-                    company.name = name
-                    update_fields.append('name')
-                if company.short_name != short_name:
-                    company.short_name = short_name
-                    update_fields.append('short_name')
-                if company_type:
-                    if company.company_type_id != company_type.id:
-                        company.company_type = company_type
-                        update_fields.append('company_type')
-                elif company.company_type_id:
-                    company.company_type = None
-                    update_fields.append('company_type')
-                if company.authorized_capital != authorized_capital:
-                    company.authorized_capital = authorized_capital
-                    update_fields.append('authorized_capital')
-                if company.address != address:
-                    company.address = address
-                    update_fields.append('address')
-                if company.status_id != status.id:
-                    company.status = status
-                    update_fields.append('status')
-                if company.bylaw_id != bylaw.id:
-                    company.bylaw = bylaw
-                    update_fields.append('bylaw')
-                if to_lower_string_if_exists(company.registration_date) != registration_date:
-                    company.registration_date = registration_date
+                for field_name in ('name', 'short_name', 'authorized_capital', 'address',
+                                   'registration_info', 'contact_info'):
+                    if getattr(company, field_name) != company_data[field_name]:
+                        setattr(company, field_name, company_data[field_name])
+                        update_fields.append(field_name)
+                for field_name in ('company_type', 'country', 'status', 'bylaw', 'authority'):
+                    related_object = company_data[field_name]
+                    if getattr(company, f'{field_name}_id') != (related_object.id if related_object else None):
+                        setattr(company, field_name, related_object)
+                        update_fields.append(field_name)
+                if to_lower_string_if_exists(company.registration_date) != company_data['registration_date']:
+                    company.registration_date = company_data['registration_date']
                     update_fields.append('registration_date')
-                if company.registration_info != registration_info:
-                    company.registration_info = registration_info
-                    update_fields.append('registration_info')
-                if company.contact_info != contact_info:
-                    company.contact_info = contact_info
-                    update_fields.append('contact_info')
-                if authority:
-                    if company.authority_id != authority.id:
-                        company.authority = authority
-                        update_fields.append('authority')
-                else:
-                    if company.authority_id:
-                        company.authority = None
-                        update_fields.append('authority')
-                if company.country_id != self.company_country.id:
-                    company.country = self.company_country
-                    update_fields.append('country')
                 if company.deleted_at:
                     company.deleted_at = None
                     update_fields.append('deleted_at')
                 if update_fields:
                     update_fields.append('updated_at')
+                if company.fingerprint != company_data['fingerprint']:
+                    # updated_at is not changed, when only the source record of the company is new
+                    company.fingerprint = company_data['fingerprint']
+                    update_fields.append('fingerprint')
+                if update_fields:
                     company.save(update_fields=update_fields)
                 self.time_it('update companies\t')
-                self.update_company_detail(founding_document_number, executive_power, superior_management,
-                                           managing_paper, terminated_info, termination_cancel_info, vp_dates, company)
-                self.time_it('update company details\t')
-                self.update_founders(record.xpath('FOUNDERS')[0] if len(record.xpath('FOUNDERS')[0]) else [],
-                                  record.xpath('BENEFICIARIES')[0] if len(record.xpath('BENEFICIARIES')[0]) else [],
-                                  company)
-                self.time_it('update founders\t\t')
-                self.update_company_to_kved(record.xpath('ACTIVITY_KINDS')[0], company)
-                self.time_it('update kveds\t\t')
-                self.update_signers(record.xpath('SIGNERS')[0], company)
-                self.time_it('update signers\t\t')
-                self.update_termination_started(record, company)
-                self.time_it('update termination\t')
-                self.update_bancruptcy_readjustment(record, company)
-                self.time_it('update bancruptcy\t')
-                self.update_company_to_predecessors(record.xpath('PREDECESSORS')[0], company)
-                self.time_it('update predecessors\t')
-                self.update_assignees(record.xpath('ASSIGNEES')[0], company)
-                self.time_it('update assignes\t\t')
-                self.update_exchange_data(record.xpath('EXCHANGE_DATA')[0], company)
-                self.time_it('update exchange data\t')
+                self.update_company_children(record_data, company)
 
         if len(self.bulk_manager.queues['business_register.Company']):
             self.bulk_manager.commit(Company)
-        for company in self.bulk_manager.queues['business_register.Company']:
+        self.save_children(self.bulk_manager.queues['business_register.Company'])
+
+    def merge_companies(self, records):
+        """
+        Saves the chunk of companies with set-based statements through the staging table
+        instead of getting and saving each company separately
+        """
+        companies = {}
+        for company_data, record_data, fingerprint in self.get_companies_data(records):
+            # only the last version of the company in the chunk is saved, like it would be after updates
+            companies[company_data['code']] = (record_data, Company(**company_data, fingerprint=fingerprint))
+        self.time_it('getting data from record')
+        new_companies = []
+        merged_companies = self.merge_with_staging_table([company for _, company in companies.values()])
+        self.prefetch_children(company_id for company_id, _, is_new in merged_companies if not is_new)
+        for company_id, code, is_new in merged_companies:
+            record_data, staged_company = companies[code]
+            company = Company(id=company_id, code=code, fingerprint=staged_company.fingerprint)
+            if is_new:
+                self.add_company_children(record_data, code)
+                new_companies.append(company)
+            else:
+                self.companies_tracker.mark(company_id)
+                self.update_company_children(record_data, company)
+        self.time_it('merge companies\t')
+        self.save_children(new_companies)
+
+    def merge_with_staging_table(self, companies):
+        """
+        Copies companies to the temporary staging table and in one statement updates changed companies
+        with their history, restores deleted ones and inserts new ones.
+        Returns (id, code, is_new) for all companies from the staging table.
+        Like with saving companies one by one, updated_at is changed only for new and changed companies,
+        so Downloader.measure_company_changes counts them the same way.
+        """
+        table = Company._meta.db_table
+        history_table = Company.history.model._meta.db_table
+        fields = [field for field in Company._meta.concrete_fields
+                  if field.name not in ('id', 'created_at', 'updated_at', 'deleted_at')]
+        columns = [field.column for field in fields]
+        update_columns = [Company._meta.get_field(field_name).column for field_name in self.MERGE_FIELDS]
+        changed = (
+            f"(({', '.join(f'c.{column}' for column in update_columns)}) IS DISTINCT FROM "
+            f"({', '.join(f's.{column}' for column in update_columns)}) OR c.deleted_at IS NOT NULL)"
+        )
+        history_values = []
+        for field in Company.history.model._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            if field.name == 'history_date':
+                history_values.append((field.column, '%(now)s'))
+            elif field.name == 'history_type':
+                history_values.append((field.column, "'~'"))
+            elif field.column in columns or field.column in ('id', 'created_at', 'updated_at', 'deleted_at'):
+                history_values.append((field.column, f'u.{field.column}'))
+            else:
+                history_values.append((field.column, 'NULL'))
+        with connection.cursor() as cursor:
+            # temporary table is not written to WAL and is visible only for the current connection,
+            # so parallel workers do not share it
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS company_staging AS "
+                f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+            )
+            cursor.execute('TRUNCATE company_staging')
+            CopyBulkCreateManager.copy(
+                cursor, 'company_staging', columns,
+                [[field.get_db_prep_save(field.pre_save(company, True), connection) for field in fields]
+                 for company in companies]
+            )
+            cursor.execute(f"""
+                WITH matched AS (
+                    SELECT c.id, s.code FROM company_staging s
+                    JOIN {table} c ON c.code = s.code AND c.source = s.source
+                ), updated AS (
+                    UPDATE {table} c
+                    SET {', '.join(f'{column} = s.{column}' for column in update_columns)},
+                        fingerprint = s.fingerprint,
+                        updated_at = CASE WHEN {changed} THEN %(now)s ELSE c.updated_at END,
+                        deleted_at = NULL
+                    FROM company_staging s
+                    WHERE c.code = s.code AND c.source = s.source AND (
+                        {changed} OR c.fingerprint IS DISTINCT FROM s.fingerprint
+                    )
+                    RETURNING c.*
+                ), history AS (
+                    INSERT INTO {history_table} ({', '.join(column for column, _ in history_values)})
+                    SELECT {', '.join(value for _, value in history_values)} FROM updated u
+                ), inserted AS (
+                    INSERT INTO {table} (created_at, updated_at, {', '.join(columns)})
+                    SELECT %(now)s, %(now)s, {', '.join(f's.{column}' for column in columns)}
+                    FROM company_staging s
+                    WHERE NOT EXISTS (SELECT 1 FROM {table} c WHERE c.code = s.code AND c.source = s.source)
+                    RETURNING id, code
+                )
+                SELECT id, code, FALSE FROM matched
+                UNION ALL
+                SELECT id, code, TRUE FROM inserted
+            """, {'now': timezone.now()})
+            return cursor.fetchall()
+
+    def prefetch_children(self, company_ids):
+        company_ids = list(company_ids)
+        for updater in self.children_updaters:
+            updater.prefetch(company_ids)
+        self.time_it('prefetch children\t')
+
+    def save_children(self, new_companies):
+        """Saves children of new companies and changes of children of updated companies"""
+        for company in new_companies:
             code = company.code
             if code in self.founder_to_dict:
                 for founder in self.founder_to_dict[code]:
@@ -1009,40 +748,33 @@ class UkrCompanyFullConverter(CompanyConverter):
         self.company_to_predecessor_to_dict = {}
         self.assignee_to_dict = {}
         self.exchange_data_to_dict = {}
+        for updater in self.children_updaters:
+            updater.commit()
         self.time_it('save others\t\t')
 
+    def get_worker_state(self):
+        return self.companies_tracker, self.invalid_data_counter, self.skipped_records_counter
+
+    def merge_worker_state(self, state):
+        companies_tracker, invalid_data_counter, skipped_records_counter = state
+        self.companies_tracker.merge(companies_tracker)
+        self.invalid_data_counter += invalid_data_counter
+        self.skipped_records_counter += skipped_records_counter
+
+    def mark_seen(self, records):
+        codes = []
+        for record in records:
+            data = self.RECORD_SCHEMA.extract(record)
+            if data:
+                codes.append(data['name'] + data['edrpou'])
+        for company_id in Company.objects.filter(source=self.source, code__in=codes).values_list('id', flat=True):
+            self.companies_tracker.mark(company_id)
+
     def delete_outdated(self):
-        outdated_companies = list(set(self.already_stored_companies) - set(self.uptodated_companies))
-        for company_id in outdated_companies:
-            if CompanyDetail.objects.filter(company_id=company_id).first():
-                CompanyDetail.objects.filter(company_id=company_id).first().soft_delete()
-            if CompanyToPredecessor.objects.filter(company_id=company_id).first():
-                CompanyToPredecessor.objects.filter(company_id=company_id).first().soft_delete()
-            if TerminationStarted.objects.filter(company_id=company_id).first():
-                TerminationStarted.objects.filter(company_id=company_id).first().soft_delete()
-            if BancruptcyReadjustment.objects.filter(company_id=company_id).first():
-                BancruptcyReadjustment.objects.filter(company_id=company_id).first().soft_delete()
-            outdated_founders = list(Founder.objects.filter(company_id=company_id))
-            if len(outdated_founders):
-                for founder in outdated_founders:
-                    founder.soft_delete()
-            outdated_signers = list(Signer.objects.filter(company_id=company_id))
-            if len(outdated_signers):
-                for signer in outdated_signers:
-                    signer.soft_delete()
-            outdated_assignees = list(Assignee.objects.filter(company_id=company_id))
-            if len(outdated_assignees):
-                for assignee in outdated_assignees:
-                    assignee.soft_delete()
-            outdated_exchange_data = list(ExchangeDataCompany.objects.filter(company_id=company_id))
-            if len(outdated_exchange_data):
-                for exchange_data in outdated_exchange_data:
-                    exchange_data.soft_delete()
-            outdated_company_to_kved = list(CompanyToKved.objects.filter(company_id=company_id))
-            if len(outdated_company_to_kved):
-                for company_to_kved in outdated_company_to_kved:
-                    company_to_kved.soft_delete()
-            Company.objects.get(id=company_id).soft_delete()
+        Company.bulk_soft_delete(self.companies_tracker.get_unseen_ids(), children=(
+            CompanyDetail, CompanyToPredecessor, TerminationStarted, BancruptcyReadjustment,
+            Founder, Signer, Assignee, ExchangeDataCompany, CompanyToKved
+        ))
 
 
 class UkrCompanyFullDownloader(Downloader):
@@ -1050,6 +782,8 @@ class UkrCompanyFullDownloader(Downloader):
     zip_required_file_sign = 'ufop_full'
     unzip_required_file_sign = 'EDR_UO_FULL'
     unzip_after_download = True
+    segments = settings.DOWNLOAD_SEGMENTS_UO_FULL
+    stream_from_zip = settings.STREAM_FROM_ZIP_UO_FULL
     source_dataset_url = settings.BUSINESS_UKR_COMPANY_SOURCE_PACKAGE
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_FULL
 
@@ -1071,23 +805,26 @@ class UkrCompanyFullDownloader(Downloader):
 
         logger.info(f'{self.reg_name}: Update started...')
 
-        self.report_init()
-        self.report.long_time_converter = True
-        self.report.save()
-        self.download()
+        if not self.resume_report():
+            self.report_init()
+            self.report.long_time_converter = True
+            self.report.save()
+            self.download()
 
-        self.LOCAL_FILE_NAME = self.file_name
-        self.remove_unreadable_characters()
+            if not self.stream_from_zip:
+                self.LOCAL_FILE_NAME = self.file_name
+                self.remove_unreadable_characters()
 
-        self.report.update_start = timezone.now()
-        self.report.save()
+            self.report.update_start = timezone.now()
+            self.report.save()
 
         logger.info(f'{self.reg_name}: process() with {self.file_path} started ...')
         ukr_company_full = UkrCompanyFullConverter()
-        ukr_company_full.LOCAL_FILE_NAME = self.file_name
+        self.set_converter_source(ukr_company_full)
+        ukr_company_full.report = self.report
 
         sleep(5)
-        if ukr_company_full.process():
+        if ukr_company_full.process(resume=True):
             logger.info(f'{self.reg_name}: process() with {self.file_path} finished successfully.')
             self.report.update_status = True
             self.report.update_finish = timezone.now()
@@ -1106,6 +843,7 @@ class UkrCompanyFullDownloader(Downloader):
             logger.info(f'{self.reg_name}: Update total records finished successfully.')
 
             self.report.invalid_data = ukr_company_full.invalid_data_counter
+            self.report.records_skipped = ukr_company_full.skipped_records_counter
             self.measure_company_changes(Company.UKRAINE_REGISTER)
             logger.info(f'{self.reg_name}: Report created successfully.')
 
@@ -0,0 +1,92 @@
+from business_register.models.company_models import Company
+
+
+class DeclarationCompanyResolver:
+    """
+    Companies referred to in declarations, resolved once for the run of the converter.
+    prefetch gets companies with all codes found in the declaration with one query. Ukrainian companies
+    are found by EDRPOU in the register, foreign ones are created once for the run and then reused
+    by the code and the name instead of creating a new company for every reference.
+    New foreign companies are queued in the bulk manager of the declaration and created in bulk
+    with its other objects, companies of a failed declaration are forgotten with rollback.
+    """
+
+    def __init__(self, no_data, bulk_manager):
+        self.no_data = no_data
+        self.bulk_manager = bulk_manager
+        # EDRPOU -> the first company from the register or None
+        self.ukrainian_companies = {}
+        # (code, name) -> company created from declarations
+        self.foreign_companies = {}
+        self.fetched_foreign_codes = set()
+        # keys of foreign companies queued for the current declaration
+        self.new_foreign_keys = []
+
+    @staticmethod
+    def is_code_key(key):
+        return key == 'reestrCode' or ('company_code' in key and not key.endswith('extendedstatus'))
+
+    def collect_codes(self, data, codes):
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if isinstance(value, str):
+                    if value not in self.no_data and self.is_code_key(key):
+                        codes.add(value)
+                        # ukrainian codes are often declared without leading zeros
+                        if value.isdigit():
+                            codes.add(value.zfill(8))
+                else:
+                    self.collect_codes(value, codes)
+        elif isinstance(data, list):
+            for item in data:
+                self.collect_codes(item, codes)
+
+    def prefetch(self, declaration_data):
+        codes = set()
+        self.collect_codes(declaration_data, codes)
+        codes = [code for code in codes
+                 if code not in self.ukrainian_companies or code not in self.fetched_foreign_codes]
+        if not codes:
+            return
+        companies = Company.objects.filter(
+            edrpou__any=codes,
+            source__in=[Company.UKRAINE_REGISTER, Company.DECLARATIONS],
+        ).only('id', 'edrpou', 'name', 'source').order_by('id')
+        for company in companies:
+            if company.source == Company.UKRAINE_REGISTER:
+                self.ukrainian_companies.setdefault(company.edrpou, company)
+            else:
+                self.foreign_companies.setdefault((company.edrpou, company.name), company)
+        for code in codes:
+            self.ukrainian_companies.setdefault(code, None)
+        self.fetched_foreign_codes.update(codes)
+
+    def get_ukrainian_company(self, edrpou):
+        if edrpou not in self.ukrainian_companies:
+            self.ukrainian_companies[edrpou] = Company.objects.filter(
+                edrpou=edrpou,
+                source=Company.UKRAINE_REGISTER
+            ).first()
+        return self.ukrainian_companies[edrpou]
+
+    def get_foreign_company(self, code, name, **fields):
+        key = (code, name)
+        company = self.foreign_companies.get(key)
+        if not company and code not in self.fetched_foreign_codes:
+            company = Company.objects.filter(edrpou=code, name=name, source=Company.DECLARATIONS).first()
+        if not company:
+            company = Company(name=name, edrpou=code, source=Company.DECLARATIONS, **fields)
+            self.bulk_manager.add(company)
+            self.new_foreign_keys.append(key)
+        self.foreign_companies[key] = company
+        return company
+
+    def commit(self):
+        """New foreign companies of the declaration are stored, so they are reused by the next ones"""
+        self.new_foreign_keys = []
+
+    def rollback(self):
+        """New foreign companies of the failed declaration are not stored and must not be reused"""
+        for key in self.new_foreign_keys:
+            self.foreign_companies.pop(key, None)
+        self.new_foreign_keys = []
@@ -1,10 +1,13 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dateutil.parser import isoparse
-import requests
-from django.conf import settings
+from django.db import transaction
 
 from business_register.converter.business_converter import BusinessConverter
+from business_register.converter.company_resolver import DeclarationCompanyResolver
+from business_register.converter.nacp_client import NacpClient
 from business_register.models.declaration_models import (Declaration,
                                                          Property,
                                                          PropertyRight,
@@ -26,11 +29,11 @@ from business_register.models.declaration_models import (Declaration,
                                                          )
 from business_register.models.pep_models import Pep, RelatedPersonsLink
 from location_register.models.address_models import Country
-from business_register.models.company_models import Company
 from data_ocean.utils import simple_format_date_to_yymmdd
 from location_register.models.ratu_models import RatuRegion, RatuDistrict, RatuCity
 
 from business_register.management.commands.fetch_peps_nacp_id import is_same_full_name, InvalidRelativeData
+from data_ocean.converter import TransactionBulkCreateManager
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -39,6 +42,9 @@ logger.setLevel(logging.INFO)
 class DeclarationConverter(BusinessConverter):
 
     def __init__(self):
+        self.nacp_client = NacpClient()
+        # objects of the declaration being saved, created with one transaction
+        self.bulk_manager = TransactionBulkCreateManager()
         self.only_peps = {pep.nacp_id[0]: pep for pep in Pep.objects.filter(
             is_pep=True,
             nacp_id__len=1
@@ -58,6 +64,7 @@ class DeclarationConverter(BusinessConverter):
             'Не визначено',
             'невідомо',
         }
+        self.companies = DeclarationCompanyResolver(self.NO_DATA, self.bulk_manager)
         self.BOOLEAN_VALUES = {
             '1': True,
             '0': False,
@@ -148,10 +155,7 @@ class DeclarationConverter(BusinessConverter):
                 company_name = ''
             company_code = right_data.get('ua_company_code')
             if company_code not in self.NO_DATA:
-                company = Company.objects.filter(
-                    edrpou=company_code,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                company = self.companies.get_ukrainian_company(company_code)
                 if not company:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {company_code}.'
@@ -170,12 +174,11 @@ class DeclarationConverter(BusinessConverter):
                 address = right_data.get('ukr_company_address')
                 if address in self.NO_DATA:
                     address = ''
-                company = Company.objects.create(
+                company = self.companies.get_foreign_company(
+                    company_code,
                     name=company_name,
                     name_en=eng_name,
-                    edrpou=company_code,
-                    address=address,
-                    source=Company.DECLARATIONS,
+                    address=address
                 )
         return owner_type, full_name, company, company_name
 
@@ -198,10 +201,7 @@ class DeclarationConverter(BusinessConverter):
         ngo_registration_number = data.get('reestrCode')
         ngo = None
         if ngo_registration_number not in self.NO_DATA:
-            ngo = Company.objects.filter(
-                edrpou=ngo_registration_number,
-                source=Company.UKRAINE_REGISTER
-            ).first()
+            ngo = self.companies.get_ukrainian_company(ngo_registration_number)
             if not ngo:
                 self.log_error(
                     f'Cannot identify ukrainian NGO with edrpou {ngo_registration_number}.'
@@ -209,7 +209,7 @@ class DeclarationConverter(BusinessConverter):
                 )
         else:
             ngo_registration_number = ''
-        NgoParticipation.objects.create(
+        self.bulk_manager.add(NgoParticipation(
             declaration=declaration,
             participation_type=participation_type,
             ngo_type=ngo_type,
@@ -219,7 +219,7 @@ class DeclarationConverter(BusinessConverter):
             ngo_body_name=ngo_body_name,
             ngo=ngo,
             pep=declaration.pep
-        )
+        ))
 
     def save_ngo_participation(self, ngo_data, declaration):
         # possible_keys = {'iteration', 'objectType', 'subObjectType', 'objectName', 'reestrCode'}
@@ -266,10 +266,7 @@ class DeclarationConverter(BusinessConverter):
             employer_registration_number = data.get('emitent_ua_company_code')
             if employer_registration_number not in self.NO_DATA:
                 employer_registration_number = employer_registration_number.zfill(8)
-                employer = Company.objects.filter(
-                    edrpou=employer_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                employer = self.companies.get_ukrainian_company(employer_registration_number)
                 if not employer:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {employer_registration_number}.'
@@ -279,11 +276,10 @@ class DeclarationConverter(BusinessConverter):
                 employer_registration_number = ''
             employer_foreign_registration_number = data.get('emitent_eng_company_code')
             if employer_foreign_registration_number not in self.NO_DATA:
-                employer = Company.objects.create(
+                employer = self.companies.get_foreign_company(
+                    employer_foreign_registration_number,
                     name=employer_name_eng,
-                    edrpou=employer_foreign_registration_number,
-                    address=employer_address,
-                    source=Company.DECLARATIONS
+                    address=employer_address
                 )
                 employer_registration_number = employer_foreign_registration_number
 
@@ -296,7 +292,7 @@ class DeclarationConverter(BusinessConverter):
                 if employer_middle_name:
                     employer_full_name = f'{employer_full_name} {employer_middle_name}'
 
-            PartTimeJob.objects.create(
+            self.bulk_manager.add(PartTimeJob(
                 declaration=declaration,
                 is_paid=is_paid,
                 description=description,
@@ -307,7 +303,7 @@ class DeclarationConverter(BusinessConverter):
                 employer_registration_number=employer_registration_number,
                 employer=employer,
                 employer_full_name=employer_full_name
-            )
+            ))
 
     # possible_keys = {
     #     'specExpensesMovableSubject', 'specOtherExpensesSubject', 'specExpenses', 'country', 'date_costAmount',
@@ -360,7 +356,7 @@ class DeclarationConverter(BusinessConverter):
             if not participant:
                 self.log_error(f'Cannot identify participant of the transaction from data({data})')
 
-            Transaction.objects.create(
+            self.bulk_manager.add(Transaction(
                 declaration=declaration,
                 is_money_spent=is_money_spent,
                 amount=amount,
@@ -370,7 +366,7 @@ class DeclarationConverter(BusinessConverter):
                 date=date,
                 country=country,
                 participant=participant
-            )
+            ))
 
     # possible_keys = {
     #     'emitent_ua_company_code_extendedstatus', 'emitent_ua_company_code', 'guarantor_realty',
@@ -438,10 +434,7 @@ class DeclarationConverter(BusinessConverter):
             bank = None
             bank_registration_number = data.get('emitent_ua_company_code')
             if bank_registration_number not in self.NO_DATA:
-                bank = Company.objects.filter(
-                    edrpou=bank_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                bank = self.companies.get_ukrainian_company(bank_registration_number)
                 if not bank:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {bank_registration_number}.'
@@ -452,11 +445,10 @@ class DeclarationConverter(BusinessConverter):
                 bank_registration_number = ''
             bank_foreign_registration_number = data.get('emitent_eng_company_code')
             if bank_foreign_registration_number not in self.NO_DATA:
-                bank = Company.objects.create(
+                bank = self.companies.get_foreign_company(
+                    bank_foreign_registration_number,
                     name=bank_name_eng,
-                    edrpou=bank_foreign_registration_number,
-                    address=bank_address,
-                    source=Company.DECLARATIONS
+                    address=bank_address
                 )
                 bank_registration_number = bank_foreign_registration_number
 
@@ -505,7 +497,7 @@ class DeclarationConverter(BusinessConverter):
             if not owner:
                 self.log_error(f'Cannot identify owner of the liability from data({data})')
             else:
-                Liability.objects.create(
+                self.bulk_manager.add(Liability(
                     declaration=declaration,
                     type=liability_type,
                     additional_info=additional_info,
@@ -527,12 +519,15 @@ class DeclarationConverter(BusinessConverter):
                     creditor_from_info=creditor_from_info,
                     creditor_full_name=creditor_full_name,
                     creditor_full_name_eng=creditor_full_name_eng,
-                    owner=owner)
+                    owner=owner))
 
     def save_bank_account(self, account_data, declaration, pep):
         all_banks = list(Money.objects.filter(declaration__pep=pep, type=Money.BANK_ACCOUNT).values_list(
             'bank_registration_number',
             flat=True))
+        # bank accounts of step 12 of this declaration are not saved yet
+        all_banks.extend(money.bank_registration_number for money in self.bulk_manager.queues[Money._meta.label]
+                         if money.type == Money.BANK_ACCOUNT)
         for data in account_data:
             bank_code_ua = data.get('establishment_ua_company_code')
             if bank_code_ua in self.NO_DATA:
@@ -549,17 +544,13 @@ class DeclarationConverter(BusinessConverter):
             bank_info = data.get('establishment_type', '')
             if bank_code_ua:
                 registration_number = bank_code_ua
-                company = Company.objects.filter(
-                    edrpou=registration_number,
-                    source=Company.UKRAINE_REGISTER,
-                ).first()
+                company = self.companies.get_ukrainian_company(registration_number)
             elif bank_code_en:
                 registration_number = bank_code_en
-                company = Company.objects.create(
+                company = self.companies.get_foreign_company(
+                    registration_number,
                     name=bank_name_ukr,
-                    name_en=bank_name_en,
-                    edrpou=registration_number,
-                    source=Company.DECLARATIONS,
+                    name_en=bank_name_en
                 )
             else:
                 continue
@@ -582,7 +573,7 @@ class DeclarationConverter(BusinessConverter):
                 if not owner:
                     self.log_error(f'Cannot find owner of account ({data})')
                     continue
-                Money.objects.create(
+                self.bulk_manager.add(Money(
                     type=Money.BANK_ACCOUNT,
                     bank_name_eng=bank_name_en,
                     bank_name=bank_name_ukr,
@@ -591,7 +582,7 @@ class DeclarationConverter(BusinessConverter):
                     owner=owner,
                     declaration=declaration,
                     bank_from_info=bank_info,
-                )
+                ))
             all_banks.append(registration_number)
 
     # TODO: discover what are 'guarantor' and 'margin-emitent' (can be 'j') fields
@@ -655,10 +646,7 @@ class DeclarationConverter(BusinessConverter):
                 bank = None
                 bank_registration_number = data.get('organization_ua_company_code')
                 if bank_registration_number not in self.NO_DATA:
-                    bank = Company.objects.filter(
-                        edrpou=bank_registration_number,
-                        source=Company.UKRAINE_REGISTER
-                    ).first()
+                    bank = self.companies.get_ukrainian_company(bank_registration_number)
                     if not bank:
                         self.log_error(
                             f'Cannot identify ukrainian company with edrpou {bank_registration_number}.'
@@ -669,11 +657,10 @@ class DeclarationConverter(BusinessConverter):
                     bank_registration_number = ''
                 bank_foreign_registration_number = data.get('organization_eng_company_code')
                 if bank_foreign_registration_number not in self.NO_DATA:
-                    bank = Company.objects.create(
+                    bank = self.companies.get_foreign_company(
+                        bank_foreign_registration_number,
                         name=bank_name_eng,
-                        edrpou=bank_foreign_registration_number,
-                        address=bank_address,
-                        source=Company.DECLARATIONS
+                        address=bank_address
                     )
                     bank_registration_number = bank_foreign_registration_number
 
@@ -708,7 +695,7 @@ class DeclarationConverter(BusinessConverter):
                 self.log_error(f'Cannot identify owner of the money from data ({data})')
                 continue
             else:
-                Money.objects.create(
+                self.bulk_manager.add(Money(
                     declaration=declaration,
                     type=money_type,
                     additional_info=additional_info,
@@ -721,7 +708,7 @@ class DeclarationConverter(BusinessConverter):
                     bank_registration_number=bank_registration_number,
                     bank=bank,
                     owner=owner
-                )
+                ))
 
     # possible_keys = {
     #     'source_eng_company_code', 'source_ukr_regAddress', 'incomeSource', 'source_ukr_fullname', 'source_citizen',
@@ -798,10 +785,7 @@ class DeclarationConverter(BusinessConverter):
             company_code = data.get('source_ua_company_code')
             if company_code not in self.NO_DATA and company_code not in self.ENIGMA:
                 company_code = company_code.zfill(8)
-                company = Company.objects.filter(
-                    edrpou=company_code,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                company = self.companies.get_ukrainian_company(company_code)
                 if not company:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {company_code}.'
@@ -810,11 +794,10 @@ class DeclarationConverter(BusinessConverter):
             foreign_company_code = data.get('source_eng_company_code')
             if company_code not in self.NO_DATA and foreign_company_code not in self.ENIGMA:
                 if not company:
-                    Company.objects.create(
+                    self.companies.get_foreign_company(
+                        foreign_company_code,
                         name=data.get('source_eng_company_name'),
-                        edrpou=foreign_company_code,
-                        address=data.get('source_eng_company_address'),
-                        source=Company.DECLARATIONS
+                        address=data.get('source_eng_company_address')
                     )
 
             full_name = data.get('source_ukr_fullname')
@@ -869,7 +852,7 @@ class DeclarationConverter(BusinessConverter):
                 )
                 continue
 
-            income = Income.objects.create(
+            income = Income(
                 declaration=declaration,
                 type=income_type,
                 additional_info=additional_info,
@@ -879,6 +862,7 @@ class DeclarationConverter(BusinessConverter):
                 from_info=from_info,
                 recipient=recipient
             )
+            self.bulk_manager.add(income)
 
             # TODO: discover  'iteration'. Example of the value '1614443380219'
             iteration = data.get('iteration')
@@ -940,26 +924,22 @@ class DeclarationConverter(BusinessConverter):
             if company_registration_number not in self.NO_DATA:
                 if country == self.UKRAINE:
                     company_registration_number = company_registration_number.zfill(8)
-                    company = Company.objects.filter(
-                        edrpou=company_registration_number,
-                        source=Company.UKRAINE_REGISTER
-                    ).first()
+                    company = self.companies.get_ukrainian_company(company_registration_number)
                     if not company:
                         self.log_error(
                             f'Cannot identify ukrainian company with edrpou {company_registration_number}.'
                             f'Check corporate rights data({data})'
                         )
                 else:
-                    company = Company.objects.create(
+                    company = self.companies.get_foreign_company(
+                        company_registration_number,
                         name=company_name,
-                        name_en=company_name_eng,
-                        edrpou=company_registration_number,
-                        source=Company.DECLARATIONS
+                        name_en=company_name_eng
                     )
             else:
                 company_registration_number = ''
 
-            Beneficary.objects.create(
+            self.bulk_manager.add(Beneficary(
                 declaration=declaration,
                 company_name=company_name,
                 company_name_eng=company_name_eng,
@@ -971,7 +951,7 @@ class DeclarationConverter(BusinessConverter):
                 company_email=company_email,
                 company_address=company_address,
                 company=company
-            )
+            ))
 
     # possible_keys = {
     #     'corporate_rights_company_code', 'person', 'country', 'is_transferred', 'regNumber', 'cost',
@@ -1002,21 +982,17 @@ class DeclarationConverter(BusinessConverter):
             if company_registration_number not in self.NO_DATA:
                 if country == self.UKRAINE:
                     company_registration_number = company_registration_number.zfill(8)
-                    company = Company.objects.filter(
-                        edrpou=company_registration_number,
-                        source=Company.UKRAINE_REGISTER
-                    ).first()
+                    company = self.companies.get_ukrainian_company(company_registration_number)
                     if not company:
                         self.log_error(
                             f'Cannot identify ukrainian company with edrpou {company_registration_number}.'
                             f'Check corporate rights data({data})'
                         )
                 else:
-                    company = Company.objects.create(
+                    company = self.companies.get_foreign_company(
+                        company_registration_number,
                         name=company_name,
-                        name_en=company_name_eng,
-                        edrpou=company_registration_number,
-                        source=Company.DECLARATIONS
+                        name_en=company_name_eng
                     )
             else:
                 company_registration_number = ''
@@ -1025,7 +1001,7 @@ class DeclarationConverter(BusinessConverter):
             share = self.to_float(data.get('cost_percent'))
             is_transferred = is_transferred_booleans.get(data.get('is_transferred'))
 
-            CorporateRights.objects.create(
+            self.bulk_manager.add(CorporateRights(
                 declaration=declaration,
                 company_name=company_name,
                 company_name_eng=company_name_eng,
@@ -1036,7 +1012,7 @@ class DeclarationConverter(BusinessConverter):
                 value=value,
                 share=share,
                 is_transferred=is_transferred
-            )
+            ))
 
             acquisition_date = data.get('owningDate')
             if acquisition_date not in self.NO_DATA:
@@ -1108,10 +1084,7 @@ class DeclarationConverter(BusinessConverter):
             issuer_registration_number = data.get('emitent_ua_company_code')
             if issuer_registration_number not in self.NO_DATA:
                 issuer_registration_number = issuer_registration_number.zfill(8)
-                issuer = Company.objects.filter(
-                    edrpou=issuer_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                issuer = self.companies.get_ukrainian_company(issuer_registration_number)
                 if not issuer:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {issuer_registration_number}.'
@@ -1121,11 +1094,10 @@ class DeclarationConverter(BusinessConverter):
                 issuer_registration_number = ''
             issuer_foreign_registration_number = data.get('emitent_eng_company_code')
             if issuer_foreign_registration_number not in self.NO_DATA:
-                issuer = Company.objects.create(
+                issuer = self.companies.get_foreign_company(
+                    issuer_foreign_registration_number,
                     name=issuer_name_eng,
-                    edrpou=issuer_foreign_registration_number,
-                    address=issuer_address,
-                    source=Company.DECLARATIONS
+                    address=issuer_address
                 )
                 issuer_registration_number = issuer_foreign_registration_number
 
@@ -1155,10 +1127,7 @@ class DeclarationConverter(BusinessConverter):
             trustee = None
             if trustee_registration_number not in self.NO_DATA:
                 trustee_registration_number = trustee_registration_number.zfill(8)
-                trustee = Company.objects.filter(
-                    edrpou=trustee_registration_number,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                trustee = self.companies.get_ukrainian_company(trustee_registration_number)
                 if not trustee:
                     self.log_error(
                         f'Cannot identify ukrainian company with edrpou {trustee_registration_number}.'
@@ -1169,11 +1138,10 @@ class DeclarationConverter(BusinessConverter):
 
             trustee_foreign_registration_number = data.get('persons_eng_company_code')
             if trustee_foreign_registration_number not in self.NO_DATA:
-                trustee = Company.objects.create(
+                trustee = self.companies.get_foreign_company(
+                    trustee_foreign_registration_number,
                     name=trustee_name_eng,
-                    edrpou=trustee_foreign_registration_number,
-                    address=trustee_address,
-                    source=Company.DECLARATIONS
+                    address=trustee_address
                 )
                 trustee_registration_number = trustee_foreign_registration_number
 
@@ -1183,7 +1151,7 @@ class DeclarationConverter(BusinessConverter):
             else:
                 quantity = None
             nominal_value = self.to_float(data.get('cost'))
-            securities = Securities.objects.create(
+            securities = Securities(
                 declaration=declaration,
                 type=securities_type,
                 additional_info=additional_info,
@@ -1202,6 +1170,7 @@ class DeclarationConverter(BusinessConverter):
                 quantity=quantity,
                 nominal_value=nominal_value
             )
+            self.bulk_manager.add(securities)
 
             acquisition_date = simple_format_date_to_yymmdd(data.get('owningDate'))
             rights_data = data.get('rights')
@@ -1247,7 +1216,7 @@ class DeclarationConverter(BusinessConverter):
             taxpayer_number = data.get('ua_taxNumber')
             if taxpayer_number and taxpayer_number != '[Конфіденційна інформація]':
                 print(taxpayer_number)
-            VehicleRight.objects.create(
+            self.bulk_manager.add(VehicleRight(
                 car=vehicle,
                 type=type,
                 additional_info=additional_info,
@@ -1259,7 +1228,7 @@ class DeclarationConverter(BusinessConverter):
                 full_name=full_name,
                 company_name=company_name,
                 owner_type=owner_type,
-            )
+            ))
 
     # TODO: implement
     def is_vehicle_luxury(self, brand, model, year):
@@ -1296,7 +1265,7 @@ class DeclarationConverter(BusinessConverter):
             else:
                 valuation = None
             is_luxury = self.is_vehicle_luxury(brand, model, year)
-            vehicle = Vehicle.objects.create(
+            vehicle = Vehicle(
                 declaration=declaration,
                 type=vehicle_type,
                 additional_info=additional_info,
@@ -1306,6 +1275,7 @@ class DeclarationConverter(BusinessConverter):
                 is_luxury=is_luxury,
                 valuation=valuation,
             )
+            self.bulk_manager.add(vehicle)
             acquisition_date = data.get('owningDate')
             if acquisition_date:
                 acquisition_date = simple_format_date_to_yymmdd(acquisition_date)
@@ -1348,7 +1318,7 @@ class DeclarationConverter(BusinessConverter):
                     owner_type = BaseRight.FAMILY_MEMBER
                 else:
                     self.log_error(f'Wrong value for owner_info = {owner_info}. Check property_right {data}')
-            LuxuryItemRight.objects.create(
+            self.bulk_manager.add(LuxuryItemRight(
                 luxury_item=luxury_item,
                 type=type,
                 acquisition_date=acquisition_date,
@@ -1358,7 +1328,7 @@ class DeclarationConverter(BusinessConverter):
                 company=company,
                 owner_type=owner_type,
                 company_name=company_name,
-            )
+            ))
 
     # possible_keys = {
     #     'otherObjectType', 'costDateUse_extendedstatus', 'dateUse', 'manufacturerName',
@@ -1390,7 +1360,7 @@ class DeclarationConverter(BusinessConverter):
                 valuation = int(valuation)
             else:
                 valuation = None
-            luxury_item = LuxuryItem.objects.create(
+            luxury_item = LuxuryItem(
                 declaration=declaration,
                 type=luxury_type,
                 additional_info=additional_info,
@@ -1400,6 +1370,7 @@ class DeclarationConverter(BusinessConverter):
                 description=description,
                 valuation=valuation
             )
+            self.bulk_manager.add(luxury_item)
             acquisition_date = data.get('dateUse')
             if acquisition_date:
                 acquisition_date = simple_format_date_to_yymmdd(acquisition_date)
@@ -1421,7 +1392,7 @@ class DeclarationConverter(BusinessConverter):
             if property_location:
                 city = self.find_city(property_location)
             area = self.to_float(data.get('totalArea'))
-            unfinished_construction_property = Property.objects.create(
+            unfinished_construction_property = Property(
                 declaration=declaration,
                 type=Property.UNFINISHED_CONSTRUCTION,
                 additional_info=additional_info,
@@ -1429,6 +1400,7 @@ class DeclarationConverter(BusinessConverter):
                 country=country,
                 city=city,
             )
+            self.bulk_manager.add(unfinished_construction_property)
 
     # possible_keys = [
     #     {'ua_sameRegLivingAddress', 'percent-ownership', 'ua_regAddressFull', 'otherOwnership', 'citizen',
@@ -1474,7 +1446,7 @@ class DeclarationConverter(BusinessConverter):
             # Possible values = ['Продавець']
             seller = data.get('seller')
 
-            PropertyRight.objects.create(
+            self.bulk_manager.add(PropertyRight(
                 property=property,
                 type=type,
                 additional_info=additional_info,
@@ -1486,7 +1458,7 @@ class DeclarationConverter(BusinessConverter):
                 full_name=full_name,
                 company_name=company_name,
                 owner_type=owner_type,
-            )
+            ))
 
     # possible_keys = [
     #     'ua_street_extendedstatus', 'postCode_extendedstatus', 'regNumber_extendedstatus',
@@ -1545,7 +1517,7 @@ class DeclarationConverter(BusinessConverter):
                 if len(acquisition_date) < 10:
                     self.log_error(f'Wrong value for acquisition_date = {acquisition_date}')
                     acquisition_date = None
-            property = Property.objects.create(
+            property = Property(
                 declaration=declaration,
                 type=property_type,
                 additional_info=additional_info,
@@ -1554,6 +1526,7 @@ class DeclarationConverter(BusinessConverter):
                 city=city,
                 valuation=valuation,
             )
+            self.bulk_manager.add(property)
             # TODO: investigate 'sources'
             sources = data.get('sources')
             rights_data = data.get('rights')
@@ -1694,142 +1667,214 @@ class DeclarationConverter(BusinessConverter):
         declaration.last_job_title = declarant_data.get('workPost')
         declaration.save()
 
-    def save_declaration(self):
-        for nacp_declarant_id in self.only_peps:
-            # getting general info including declaration id
-            response = requests.get(
-                f'{settings.NACP_DECLARATION_LIST}?user_declarant_id={nacp_declarant_id}'
-            )
-            declarations_data = response.json().get('data')
-            if response.status_code != 200 or not declarations_data:
-                logger.error(
-                    f'cannot find declarations of the PEP with nacp_declarant_id: {nacp_declarant_id}'
-                )
-                continue
-
-            pep = self.only_peps[nacp_declarant_id]
-            for declaration_data in declarations_data:
-                # possible_keys = {
-                #     'post_type', 'corruption_affected', 'id', 'options', 'type', 'declaration_type',
-                #     'responsible_position', 'declaration_year', 'schema_version', 'data', 'post_category',
-                #     'date', 'user_declarant_id'
-                # }
-                declaration_type = declaration_data['declaration_type']
-                # TODO: predict storing changes from the declarant
-                if declaration_type not in [1, 2, 3, 4]:
-                    continue
-                declaration_id = declaration_data['id']
-                declaration = self.all_declarations.get(declaration_id)
-                if declaration:
+    def is_supported_declaration(self, declaration_data):
+        # possible_keys = {
+        #     'post_type', 'corruption_affected', 'id', 'options', 'type', 'declaration_type',
+        #     'responsible_position', 'declaration_year', 'schema_version', 'data', 'post_category',
+        #     'date', 'user_declarant_id'
+        # }
+        return declaration_data['declaration_type'] in [1, 2, 3, 4]
+
+    def is_new_declaration(self, declaration_data):
+        # TODO: predict storing changes from the declarant
+        return self.is_supported_declaration(declaration_data) and declaration_data['id'] not in self.all_declarations
+
+    def fetch_pep_declarations(self, nacp_declarant_id):
+        """
+        Runs in a thread of the pool, returns pairs of general info and full data (None if it can't be got)
+        of new declarations of the PEP or None if the list of declarations can't be got
+        """
+        declarations_data = self.nacp_client.get_declarations_list(nacp_declarant_id)
+        if not declarations_data:
+            return None
+        # getting full declaration data
+        return [(declaration_data, self.nacp_client.get_declaration(declaration_data['id']))
+                for declaration_data in declarations_data if self.is_new_declaration(declaration_data)]
+
+    def get_archived_pep_declarations(self, nacp_declarant_id):
+        """
+        The same as fetch_pep_declarations, but declarations are got only from the archive,
+        stored declarations are returned too, so they are saved again
+        """
+        declarations_data = self.nacp_client.archive.get_declarant_declarations(nacp_declarant_id)
+        if not declarations_data:
+            return None
+        # the full declaration has the same general info as the item of the list
+        return [(declaration_data, declaration_data)
+                for declaration_data in declarations_data if self.is_supported_declaration(declaration_data)]
+
+    def save_declaration(self, replay=False):
+        """
+        Declarations are fetched by the pool of threads, and only the main thread saves them to DB.
+        With replay declarations are saved again from the archive without requests to NACP,
+        objects of the steps of stored declarations are replaced with the ones from the archive.
+        """
+        if replay and not self.nacp_client.archive:
+            raise ValueError('NACP_ARCHIVE_FOLDER is required for replaying declarations')
+        fetch = self.get_archived_pep_declarations if replay else self.fetch_pep_declarations
+        with ThreadPoolExecutor(max_workers=self.nacp_client.threads) as executor:
+            for nacp_declarant_id, new_declarations in self.nacp_client.fetch_all(
+                    executor, fetch, list(self.only_peps)
+            ):
+                if new_declarations is None:
+                    logger.error(
+                        f'cannot find declarations of the PEP with nacp_declarant_id: {nacp_declarant_id}'
+                    )
                     continue
+                pep = self.only_peps[nacp_declarant_id]
+                for declaration_data, detailed_declaration_response in new_declarations:
+                    self.save_declaration_objects(
+                        declaration_data, detailed_declaration_response, nacp_declarant_id, pep
+                    )
+
+    def delete_declaration_objects(self, declaration):
+        """Deletes objects of all steps of the stored declaration, rights are deleted before their objects"""
+        for relation in Declaration._meta.related_objects:
+            # the scoring is not an object of the steps
+            if relation.one_to_one:
+                continue
+            step_model = relation.related_model
+            for right_relation in step_model._meta.related_objects:
+                right_relation.related_model.include_deleted_objects.filter(
+                    **{f'{right_relation.field.name}__{relation.field.name}': declaration}
+                ).delete()
+            step_model.include_deleted_objects.filter(**{relation.field.name: declaration}).delete()
+
+    def save_declaration_objects(self, declaration_data, detailed_declaration_response, nacp_declarant_id, pep):
+        """
+        Saves the declaration with all objects of its steps in one transaction,
+        objects of a stored declaration are replaced
+        """
+        started = time.monotonic()
+        try:
+            with transaction.atomic():
                 # TODO: add date to the model and here
+                declaration_values = {
+                    'type': declaration_data['declaration_type'],
+                    'year': declaration_data['declaration_year'],
+                    'submission_date': isoparse(declaration_data['date']).date(),
+                    'nacp_declarant_id': nacp_declarant_id,
+                    'pep': pep,
+                }
+                declaration = self.all_declarations.get(declaration_data['id'])
+                if declaration:
+                    self.delete_declaration_objects(declaration)
+                    for field_name, value in declaration_values.items():
+                        setattr(declaration, field_name, value)
+                    declaration.save()
                 else:
-                    submission_date = isoparse(declaration_data['date']).date()
                     declaration = Declaration.objects.create(
-                        type=declaration_type,
-                        year=declaration_data['declaration_year'],
-                        submission_date=submission_date,
-                        nacp_declaration_id=declaration_id,
-                        nacp_declarant_id=nacp_declarant_id,
-                        pep=pep,
+                        nacp_declaration_id=declaration_data['id'],
+                        **declaration_values
                     )
                 self.current_declaration = declaration
-
-                # getting full declaration data
-                response = requests.get(settings.NACP_DECLARATION_RETRIEVE + declaration_id)
-                if response.status_code != 200:
+                if not detailed_declaration_response:
                     self.log_error(f'cannot find declarations')
-                    continue
-                # possible_keys = {
-                #     'step_9', 'step_13', 'step_3', 'step_14', 'step_16', 'step_11', 'step_17',
-                #     'step_6', 'step_5', 'step_8', 'step_0', 'step_1', 'step_7', 'step_2',
-                #     'step_4', 'step_12', 'step_10', 'step_15',
-                # }
-                detailed_declaration_data = response.json()['data']
-
-                # TODO: predict updating
-                # 'Step_1' - declarant`s personal data
-                self.save_declarant_data(detailed_declaration_data['step_1']['data'], pep, declaration)
-
-                # TODO: predict updating
-                # 'Step_2' - declarant`s family
-                if (
-                        not declaration.spouse
-                        and detailed_declaration_data['step_2']
-                        and not detailed_declaration_data['step_2'].get('isNotApplicable')
-                ):
-                    self.relatives_data = detailed_declaration_data['step_2']['data']
-                    self.save_related_person(pep, declaration)
-                else:
-                    self.relatives_data = None
-
-                # 'Step_3' - declarant`s family`s properties
-                if (detailed_declaration_data['step_3']
-                        and not detailed_declaration_data['step_3'].get('isNotApplicable')):
-                    self.save_property(detailed_declaration_data['step_3']['data'], declaration)
-
-                # 'Step_4' - declarant`s family`s unfinished construction
-                if (detailed_declaration_data['step_4']
-                        and not detailed_declaration_data['step_4'].get('isNotApplicable')):
-                    self.save_unfinished_construction(detailed_declaration_data['step_4']['data'], declaration)
-
-                # 'Step_5' - declarant`s family`s luxury items
-                if (detailed_declaration_data['step_5']
-                        and not detailed_declaration_data['step_5'].get('isNotApplicable')):
-                    self.save_luxury_item(detailed_declaration_data['step_5']['data'], declaration)
-
-                # 'Step_6' - declarant`s family`s vehicles
-                if (detailed_declaration_data['step_6']
-                        and not detailed_declaration_data['step_6'].get('isNotApplicable')):
-                    self.save_vehicle(detailed_declaration_data['step_6']['data'], declaration)
-
-                # 'Step_7' - declarant`s family`s securities
-                if (detailed_declaration_data['step_7']
-                        and not detailed_declaration_data['step_7'].get('isNotApplicable')):
-                    self.save_securities(detailed_declaration_data['step_7']['data'], declaration)
-
-                # 'Step_8' - declarant`s family`s corporate rights
-                if (detailed_declaration_data['step_8']
-                        and not detailed_declaration_data['step_8'].get('isNotApplicable')):
-                    self.save_corporate_rights(detailed_declaration_data['step_8']['data'], declaration)
-
-                # 'Step_9' - companies where declarant`s family`s members are beneficiaries
-                if (detailed_declaration_data['step_9']
-                        and not detailed_declaration_data['step_9'].get('isNotApplicable')):
-                    self.save_beneficiary_of(detailed_declaration_data['step_9']['data'], declaration)
-
-                # 'Step_11' - declarant`s family`s incomes
-                if (detailed_declaration_data['step_11']
-                        and not detailed_declaration_data['step_11'].get('isNotApplicable')):
-                    self.save_income(detailed_declaration_data['step_11']['data'], declaration)
-
-                # 'Step_12' - declarant`s family`s money
-                if (detailed_declaration_data['step_12']
-                        and not detailed_declaration_data['step_12'].get('isNotApplicable')):
-                    self.save_money(detailed_declaration_data['step_12']['data'], declaration)
-
-                # 'Step_13' - declarant`s family`s liabilities
-                if (detailed_declaration_data['step_13']
-                        and not detailed_declaration_data['step_13'].get('isNotApplicable')):
-                    self.save_liability(detailed_declaration_data['step_13']['data'], declaration)
-
-                # 'Step_14' - declarant`s family`s transactions
-                if (detailed_declaration_data['step_14']
-                        and not detailed_declaration_data['step_14'].get('isNotApplicable')):
-                    self.save_transaction(detailed_declaration_data['step_14']['data'], declaration)
-
-                # 'Step_15' - declarant`s part-time job info
-                if (detailed_declaration_data['step_15']
-                        and not detailed_declaration_data['step_15'].get('isNotApplicable')):
-                    self.save_part_time_job(detailed_declaration_data['step_15']['data'], declaration)
-
-                # 'Step_16' - declarant`s membership in NGOs
-                if (detailed_declaration_data['step_16']
-                        and not detailed_declaration_data['step_16'].get('isNotApplicable')):
-                    self.save_ngo_participation(detailed_declaration_data['step_16']['data'], declaration)
-
-                # 'Step_17' Banks and other financial institutions in which the accounts of
-                # the declarant or declarant't family are opened
-                if (detailed_declaration_data.get('step_17')
-                        and not detailed_declaration_data['step_17'].get('isNotApplicable')):
-                    self.save_bank_account(detailed_declaration_data['step_17']['data'], declaration, pep)
+                    return
+                self.save_declaration_steps(detailed_declaration_response['data'], pep, declaration)
+                objects_count = self.bulk_manager.commit_all()
+        except Exception:
+            self.companies.rollback()
+            raise
+        finally:
+            # objects of a failed declaration must not be created with the next one
+            self.bulk_manager.queues.clear()
+        self.companies.commit()
+        logger.info(f'declaration {declaration.nacp_declaration_id}: {objects_count} objects saved '
+                    f'in {time.monotonic() - started:.3f} s')
+
+    def save_declaration_steps(self, detailed_declaration_data, pep, declaration):
+        # possible_keys = {
+        #     'step_9', 'step_13', 'step_3', 'step_14', 'step_16', 'step_11', 'step_17',
+        #     'step_6', 'step_5', 'step_8', 'step_0', 'step_1', 'step_7', 'step_2',
+        #     'step_4', 'step_12', 'step_10', 'step_15',
+        # }
+        # all companies referred to in the declaration are got with one query
+        self.companies.prefetch(detailed_declaration_data)
+
+        # TODO: predict updating
+        # 'Step_1' - declarant`s personal data
+        self.save_declarant_data(detailed_declaration_data['step_1']['data'], pep, declaration)
+
+        # TODO: predict updating
+        # 'Step_2' - declarant`s family
+        if (
+                not declaration.spouse
+                and detailed_declaration_data['step_2']
+                and not detailed_declaration_data['step_2'].get('isNotApplicable')
+        ):
+            self.relatives_data = detailed_declaration_data['step_2']['data']
+            self.save_related_person(pep, declaration)
+        else:
+            self.relatives_data = None
+
+        # 'Step_3' - declarant`s family`s properties
+        if (detailed_declaration_data['step_3']
+                and not detailed_declaration_data['step_3'].get('isNotApplicable')):
+            self.save_property(detailed_declaration_data['step_3']['data'], declaration)
+
+        # 'Step_4' - declarant`s family`s unfinished construction
+        if (detailed_declaration_data['step_4']
+                and not detailed_declaration_data['step_4'].get('isNotApplicable')):
+            self.save_unfinished_construction(detailed_declaration_data['step_4']['data'], declaration)
+
+        # 'Step_5' - declarant`s family`s luxury items
+        if (detailed_declaration_data['step_5']
+                and not detailed_declaration_data['step_5'].get('isNotApplicable')):
+            self.save_luxury_item(detailed_declaration_data['step_5']['data'], declaration)
+
+        # 'Step_6' - declarant`s family`s vehicles
+        if (detailed_declaration_data['step_6']
+                and not detailed_declaration_data['step_6'].get('isNotApplicable')):
+            self.save_vehicle(detailed_declaration_data['step_6']['data'], declaration)
+
+        # 'Step_7' - declarant`s family`s securities
+        if (detailed_declaration_data['step_7']
+                and not detailed_declaration_data['step_7'].get('isNotApplicable')):
+            self.save_securities(detailed_declaration_data['step_7']['data'], declaration)
+
+        # 'Step_8' - declarant`s family`s corporate rights
+        if (detailed_declaration_data['step_8']
+                and not detailed_declaration_data['step_8'].get('isNotApplicable')):
+            self.save_corporate_rights(detailed_declaration_data['step_8']['data'], declaration)
+
+        # 'Step_9' - companies where declarant`s family`s members are beneficiaries
+        if (detailed_declaration_data['step_9']
+                and not detailed_declaration_data['step_9'].get('isNotApplicable')):
+            self.save_beneficiary_of(detailed_declaration_data['step_9']['data'], declaration)
+
+        # 'Step_11' - declarant`s family`s incomes
+        if (detailed_declaration_data['step_11']
+                and not detailed_declaration_data['step_11'].get('isNotApplicable')):
+            self.save_income(detailed_declaration_data['step_11']['data'], declaration)
+
+        # 'Step_12' - declarant`s family`s money
+        if (detailed_declaration_data['step_12']
+                and not detailed_declaration_data['step_12'].get('isNotApplicable')):
+            self.save_money(detailed_declaration_data['step_12']['data'], declaration)
+
+        # 'Step_13' - declarant`s family`s liabilities
+        if (detailed_declaration_data['step_13']
+                and not detailed_declaration_data['step_13'].get('isNotApplicable')):
+            self.save_liability(detailed_declaration_data['step_13']['data'], declaration)
+
+        # 'Step_14' - declarant`s family`s transactions
+        if (detailed_declaration_data['step_14']
+                and not detailed_declaration_data['step_14'].get('isNotApplicable')):
+            self.save_transaction(detailed_declaration_data['step_14']['data'], declaration)
+
+        # 'Step_15' - declarant`s part-time job info
+        if (detailed_declaration_data['step_15']
+                and not detailed_declaration_data['step_15'].get('isNotApplicable')):
+            self.save_part_time_job(detailed_declaration_data['step_15']['data'], declaration)
+
+        # 'Step_16' - declarant`s membership in NGOs
+        if (detailed_declaration_data['step_16']
+                and not detailed_declaration_data['step_16'].get('isNotApplicable')):
+            self.save_ngo_participation(detailed_declaration_data['step_16']['data'], declaration)
+
+        # 'Step_17' Banks and other financial institutions in which the accounts of
+        # the declarant or declarant't family are opened
+        if (detailed_declaration_data.get('step_17')
+                and not detailed_declaration_data['step_17'].get('isNotApplicable')):
+            self.save_bank_account(detailed_declaration_data['step_17']['data'], declaration, pep)
@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from django.utils import timezone
+
+
+class DeclarationArchive:
+    """
+    Local store of raw declarations got from NACP, so they can be saved again without downloading.
+    Documents are gzipped into files named by the SHA-256 of their content, a declaration fetched again
+    without changes takes no space. index.jsonl keeps every fetch: declaration id, declarant id,
+    content hash and date, the last fetch of the declaration wins. Threads of the pool can put documents
+    concurrently.
+    """
+    INDEX_FILE_NAME = 'index.jsonl'
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, self.INDEX_FILE_NAME)
+        self.lock = threading.Lock()
+        # declaration id -> hash of the content of the last fetch
+        self.hashes = {}
+        # declarant id -> ids of declarations in the order of the first fetch
+        self.declarant_declarations = {}
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as index_file:
+                for line in index_file:
+                    if line.strip():
+                        self.add_to_index(json.loads(line))
+
+    def add_to_index(self, entry):
+        self.hashes[entry['id']] = entry['hash']
+        self.declarant_declarations.setdefault(entry['declarant_id'], {})[entry['id']] = None
+
+    def get_path(self, content_hash):
+        return os.path.join(self.folder, content_hash[:2], f'{content_hash}.json.gz')
+
+    def __contains__(self, declaration_id):
+        return declaration_id in self.hashes
+
+    def put(self, declaration_id, declaration):
+        content = json.dumps(declaration, ensure_ascii=False, sort_keys=True).encode()
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self.get_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # the document appears under its name only when it is written completely
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with gzip.open(temp_path, 'wb') as document_file:
+                document_file.write(content)
+            os.replace(temp_path, path)
+        entry = {
+            'id': declaration_id,
+            'declarant_id': declaration.get('user_declarant_id'),
+            'hash': content_hash,
+            'fetched_at': timezone.now().isoformat(),
+        }
+        with self.lock:
+            with open(self.index_path, 'a', encoding='utf-8') as index_file:
+                index_file.write(json.dumps(entry) + '\n')
+            self.add_to_index(entry)
+
+    def get(self, declaration_id):
+        """Returns the last fetched content of the declaration or None if it is not archived"""
+        content_hash = self.hashes.get(declaration_id)
+        if not content_hash:
+            return None
+        with gzip.open(self.get_path(content_hash)) as document_file:
+            return json.loads(document_file.read())
+
+    def get_declarant_declarations(self, declarant_id):
+        return [self.get(declaration_id) for declaration_id in self.declarant_declarations.get(declarant_id, ())]
@@ -0,0 +1,94 @@
+from array import array
+from bisect import bisect_left
+
+from business_register.models.company_models import Company
+
+
+class EdrpouIndex:
+    """
+    Compact map of EDRPOU to the id of the company, the same as Company.objects.filter(edrpou=...).first().
+    It is built once per run by streaming values_list and is shared by all converters of the process
+    (forked workers inherit it). Numeric EDRPOU are packed with their length into int64 keys of
+    sorted arrays searched by bisect, that is about 16 bytes for a company instead of ~150 bytes
+    of a dict item with a string key. Other EDRPOU are kept in a small dict.
+    """
+    MAX_NUMERIC_LENGTH = 16  # longer numbers do not fit into int64 with their length
+    ITERATOR_CHUNK_SIZE = 20000
+
+    def __init__(self):
+        self.keys = None
+        self.ids = None
+        self.other_ids = {}
+
+    def clear(self):
+        """Drops the built index, it is built again on the next use"""
+        self.keys = None
+        self.ids = None
+        self.other_ids = {}
+
+    @classmethod
+    def to_key(cls, edrpou):
+        """Returns the int key of the numeric EDRPOU, the length keeps leading zeros significant"""
+        if edrpou.isdigit() and len(edrpou) <= cls.MAX_NUMERIC_LENGTH:
+            return int(edrpou) * 100 + len(edrpou)
+        return None
+
+    def build(self, pairs):
+        """Builds the index from (edrpou, id) pairs ordered by id, the first id of the EDRPOU wins"""
+        keys = array('q')
+        ids = array('q')
+        self.other_ids = {}
+        for edrpou, company_id in pairs:
+            if not edrpou:
+                continue
+            key = self.to_key(edrpou)
+            if key is None:
+                self.other_ids.setdefault(edrpou, company_id)
+            else:
+                keys.append(key)
+                ids.append(company_id)
+        # stable sort keeps the first id of the duplicated key before others
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = array('q')
+        self.ids = array('q')
+        for i in order:
+            key = keys[i]
+            if self.keys and self.keys[-1] == key:
+                continue
+            self.keys.append(key)
+            self.ids.append(ids[i])
+
+    def load(self):
+        if self.keys is None:
+            self.build(Company.objects.order_by('id').values_list('edrpou', 'id').iterator(
+                chunk_size=self.ITERATOR_CHUNK_SIZE
+            ))
+
+    def get_id(self, edrpou):
+        """Returns the id of the company with the EDRPOU or None"""
+        if not edrpou:
+            return None
+        self.load()
+        key = self.to_key(edrpou)
+        if key is None:
+            return self.other_ids.get(edrpou)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.ids[i]
+        return None
+
+
+_edrpou_index = None
+
+
+def get_edrpou_index():
+    global _edrpou_index
+    if _edrpou_index is None:
+        _edrpou_index = EdrpouIndex()
+    return _edrpou_index
+
+
+def clear_edrpou_index():
+    """HistoryConverter calls it when a run starts, so companies stored since the previous run are found"""
+    if _edrpou_index is not None:
+        _edrpou_index.clear()
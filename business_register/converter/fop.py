@@ -4,12 +4,13 @@ import re
 import requests
 from django.utils import timezone
 from data_ocean.downloader import Downloader
-from business_register.converter.business_converter import BusinessConverter
+from business_register.converter.business_converter import BusinessConverter, EXCHANGE_DATA_SCHEMA, KVED_SCHEMA
 from business_register.models.fop_models import (ExchangeDataFop, Fop,
                                                  FopToKved)
 from django.conf import settings
 from data_ocean.converter import BulkCreateManager
 from data_ocean.models import Register
+from data_ocean.record_schema import RecordField, RecordSchema
 from data_ocean.utils import get_first_word, cut_first_word, format_date_to_yymmdd
 from stats.tasks import endpoints_cache_warm_up
 
@@ -18,6 +19,26 @@ logger.setLevel(logging.INFO)
 
 
 class FopConverter(BusinessConverter):
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('FIO', 'fullname'),
+        RecordField('ADDRESS', 'address'),
+        RecordField('STAN', 'status'),
+        RecordField('KVED', 'kved'),
+    )
+    DETAILED_RECORD_SCHEMA = RecordSchema(
+        RecordField('NAME', 'fullname'),
+        RecordField('ADDRESS', 'address'),
+        RecordField('STAN', 'status'),
+        RecordField('REGISTRATION', 'registration'),
+        RecordField('ESTATE_MANAGER', 'estate_manager'),
+        RecordField('TERMINATED_INFO', 'termination'),
+        RecordField('TERMINATION_CANCEL_INFO', 'termination_cancel_info'),
+        RecordField('CONTACTS', 'contact_info'),
+        RecordField('VP_DATES', 'vp_dates'),
+        RecordField('CURRENT_AUTHORITY', 'authority'),
+        RecordField('ACTIVITY_KINDS', 'kveds', schema=KVED_SCHEMA, many=True),
+        RecordField('EXCHANGE_DATA', 'exchange_data', schema=EXCHANGE_DATA_SCHEMA, many=True),
+    )
 
     def __init__(self):
         self.API_ADDRESS_FOR_DATASET = Register.objects.get(source_register_id=
@@ -34,21 +55,10 @@ class FopConverter(BusinessConverter):
     def add_fop_kveds_to_dict(self, fop_kveds_from_record, code):
         all_fop_foptokveds = []
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
+            if not activity['code']:
                 continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
-                continue
-            kved = self.get_kved_from_DB(kved_code, kved_name)
-            is_primary = activity.xpath('PRIMARY')[0].text == "так"
-            fop_to_kved = FopToKved(kved=kved, primary_kved=is_primary)
+            kved = self.get_kved_from_DB(activity['code'], activity['name'])
+            fop_to_kved = FopToKved(kved=kved, primary_kved=activity['is_primary'] or False)
             all_fop_foptokveds.append(fop_to_kved)
         if len(all_fop_foptokveds):
             self.new_fops_foptokveds[code] = all_fop_foptokveds
@@ -57,20 +67,10 @@ class FopConverter(BusinessConverter):
     def update_fop_kveds(self, fop_kveds_from_record, fop):
         already_stored_foptokveds = list(FopToKved.objects.filter(fop=fop))
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
-                continue
-            kved_code = code_info[0].text
-            if not kved_code:
+            if not activity['code']:
                 continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
-                continue
-            kved = self.get_kved_from_DB(kved_code, kved_name)
-            is_primary = activity.xpath('PRIMARY')[0].text == "так"
+            kved = self.get_kved_from_DB(activity['code'], activity['name'])
+            is_primary = activity['is_primary'] or False
             alredy_stored = False
             if len(already_stored_foptokveds):
                 for stored_foptokved in already_stored_foptokveds:
@@ -90,31 +90,14 @@ class FopConverter(BusinessConverter):
                 outdated_foptokved.soft_delete()
 
     def extract_exchange_data(self, answer):
-        authority_info = answer.xpath('AUTHORITY_NAME')
         authority = None
-        if authority_info and authority_info[0].text:
-            authority = self.save_or_get_authority(authority_info[0].text)
-        taxpayer_info = answer.xpath('TAX_PAYER_TYPE')
+        if answer['authority']:
+            authority = self.save_or_get_authority(answer['authority'])
         taxpayer_type = None
-        if taxpayer_info and taxpayer_info[0].text:
-            taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_info[0].text)
-        start_date_info = answer.xpath('START_DATE')
-        start_date = None
-        if start_date_info and start_date_info[0].text:
-            start_date = format_date_to_yymmdd(start_date_info[0].text)
-        start_number_info = answer.xpath('START_NUM')
-        start_number = None
-        if start_number_info:
-            start_number = start_number_info[0].text
-        end_date_info = answer.xpath('END_DATE')
-        end_date = None
-        if end_date_info and end_date_info[0].text:
-            end_date = format_date_to_yymmdd(end_date_info[0].text)
-        end_number_info = answer.xpath('END_NUM')
-        end_number = None
-        if end_number_info and end_number_info[0].text:
-            end_number = end_number_info[0].text
-        return authority, taxpayer_type, start_date, start_number, end_date, end_number
+        if answer['taxpayer_type']:
+            taxpayer_type = self.save_or_get_taxpayer_type(answer['taxpayer_type'])
+        return (authority, taxpayer_type, answer['start_date'], answer['start_number'],
+                answer['end_date'], answer['end_number'])
 
     def add_fop_exchange_data_to_dict(self, exchange_data, code):
         all_fop_exchangedata = []
@@ -156,9 +139,21 @@ class FopConverter(BusinessConverter):
                                                 end_date=end_date, end_number=end_number)
                 self.bulk_manager.add(exchange_data)
 
+    def get_fop_code(self, data):
+        if not data['fullname']:
+            return None
+        return data['fullname'].lower() + (data['address'] or 'EMPTY')
+
     def save_detailed_fop_to_db(self, records):
-        for record in records:
-            fullname = record.xpath('NAME')[0].text
+        records = [(record, self.DETAILED_RECORD_SCHEMA.extract(record)) for record in records]
+        self.prefetch_dimensions(data for _, data in records)
+        stored_fops = self.get_stored_objects(
+            Fop.objects.all(),
+            'code',
+            [code for code in (self.get_fop_code(data) for _, data in records) if code]
+        )
+        for record, data in records:
+            fullname = data['fullname']
             if not fullname:
                 logger.warning(f'ФОП без прізвища: {record}')
                 self.report.invalid_data += 1
@@ -168,32 +163,32 @@ class FopConverter(BusinessConverter):
                 continue
             if fullname:
                 fullname = fullname.lower()
-            address = record.xpath('ADDRESS')[0].text
+            address = data['address']
             if not address:
                 address = 'EMPTY'
             code = fullname + address
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            registration_text = record.xpath('REGISTRATION')[0].text
+            status = self.save_or_get_status(data['status'])
+            registration_text = data['registration']
             # first getting date, then registration info if REGISTRATION.text exists
             registration_date = None
             registration_info = None
             if registration_text:
                 registration_date = format_date_to_yymmdd(get_first_word(registration_text))
                 registration_info = cut_first_word(registration_text)
-            estate_manager = record.xpath('ESTATE_MANAGER')[0].text
-            termination_text = record.xpath('TERMINATED_INFO')[0].text
+            estate_manager = data['estate_manager']
+            termination_text = data['termination']
             termination_date = None
             terminated_info = None
             if termination_text:
                 termination_date = format_date_to_yymmdd(get_first_word(termination_text))
                 terminated_info = cut_first_word(termination_text)
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
-            contact_info = record.xpath('CONTACTS')[0].text
-            vp_dates = record.xpath('VP_DATES')[0].text
-            authority = self.save_or_get_authority(record.xpath('CURRENT_AUTHORITY')[0].text)
-            fop_kveds = record.xpath('ACTIVITY_KINDS')[0]
-            exchange_data = record.xpath('EXCHANGE_DATA')[0]
-            fop = Fop.objects.filter(code=code).first()
+            termination_cancel_info = data['termination_cancel_info']
+            contact_info = data['contact_info']
+            vp_dates = data['vp_dates']
+            authority = self.save_or_get_authority(data['authority'])
+            fop_kveds = data['kveds']
+            exchange_data = data['exchange_data']
+            fop = stored_fops.get(code)
             if not fop:
                 fop = Fop(
                     fullname=fullname,
@@ -297,8 +292,15 @@ class FopConverter(BusinessConverter):
                 current_fop_to_kved.save(update_fields=['primary_kved', 'updated_at'])
 
     def save_to_db(self, records):
-        for record in records:
-            fullname = record.xpath('FIO')[0].text
+        records = [(record, self.RECORD_SCHEMA.extract(record)) for record in records]
+        self.prefetch_dimensions(data for _, data in records)
+        stored_fops = self.get_stored_objects(
+            Fop.objects.all(),
+            'code',
+            [code for code in (self.get_fop_code(data) for _, data in records) if code]
+        )
+        for record, data in records:
+            fullname = data['fullname']
             if not fullname:
                 logger.warning(f'ФОП без прізвища: {record}')
                 self.report.invalid_data += 1
@@ -307,18 +309,19 @@ class FopConverter(BusinessConverter):
                 logger.warning(f'ФОП із задовгим прізвищем: {record}')
                 continue
             fullname = fullname.lower()
-            address = record.xpath('ADDRESS')[0].text
+            address = data['address']
             if not address:
                 address = 'EMPTY'
             code = fullname + address
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            fop = Fop.objects.filter(code=code).first()
+            status = self.save_or_get_status(data['status'])
+            fop = stored_fops.get(code)
             if not fop:
                 fop = Fop.objects.create(
                     fullname=fullname,
                     address=address,
                     status=status,
                     code=code)
+                stored_fops[code] = fop
             else:
                 # TODO: make a decision: our algorithm when Fop changes fullname or address?
                 update_fields = []
@@ -328,7 +331,7 @@ class FopConverter(BusinessConverter):
                 if len(update_fields):
                     update_fields.append('updated_at')
                     fop.save(update_fields=update_fields)
-            kved_data = record.xpath('KVED')[0].text
+            kved_data = data['kved']
             if kved_data and ' ' in kved_data:
                 kved = self.extract_kved(kved_data)
                 self.save_or_update_kved(kved, fop)
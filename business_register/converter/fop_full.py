@@ -5,10 +5,11 @@ from time import sleep
 from django.conf import settings
 from django.utils import timezone
 
-from business_register.converter.business_converter import BusinessConverter
+from business_register.converter.business_converter import BusinessConverter, EXCHANGE_DATA_SCHEMA, KVED_SCHEMA
 from business_register.models.fop_models import (ExchangeDataFop, Fop, FopToKved)
-from data_ocean.converter import BulkCreateManager
+from data_ocean.converter import ChildrenUpdater, CopyBulkCreateManager
 from data_ocean.downloader import Downloader
+from data_ocean.record_schema import RecordField, RecordSchema
 from data_ocean.utils import get_first_word, cut_first_word, format_date_to_yymmdd, to_lower_string_if_exists
 from stats.tasks import endpoints_cache_warm_up
 
@@ -19,109 +20,67 @@ logger.setLevel(logging.INFO)
 class FopFullConverter(BusinessConverter):
     # Uncomment for switch Timer ON.
     # timing = True
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('NAME', 'fullname'),
+        RecordField('ADDRESS', 'address'),
+        RecordField('STAN', 'status'),
+        RecordField('REGISTRATION', 'registration'),
+        RecordField('ESTATE_MANAGER', 'estate_manager'),
+        RecordField('TERMINATED_INFO', 'termination'),
+        RecordField('TERMINATION_CANCEL_INFO', 'termination_cancel_info'),
+        RecordField('CONTACTS', 'contact_info'),
+        RecordField('VP_DATES', 'vp_dates'),
+        RecordField('CURRENT_AUTHORITY', 'authority'),
+        RecordField('ACTIVITY_KINDS', 'kveds', schema=KVED_SCHEMA, many=True),
+        RecordField('EXCHANGE_DATA', 'exchange_data', schema=EXCHANGE_DATA_SCHEMA, many=True),
+    )
 
     def __init__(self):
         self.LOCAL_FOLDER = settings.LOCAL_FOLDER
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_FOP_FULL
         self.CHUNK_SIZE = settings.CHUNK_SIZE_FOP_FULL
+        self.WORKERS = settings.WORKERS_FOP_FULL
         self.RECORD_TAG = 'SUBJECT'
-        self.bulk_manager = BulkCreateManager()
+        # FOP code is made of the name and the address, so the same FOP always has the same NAME
+        self.PARTITION_TAG = 'NAME'
+        self.bulk_manager = CopyBulkCreateManager()
         self.new_fops_foptokveds = {}
         self.new_fops_exchange_data = {}
+        self.fop_to_kved_updater = ChildrenUpdater(
+            FopToKved, 'fop', ('kved',), ('primary_kved',), self.bulk_manager
+        )
+        self.exchange_data_updater = ChildrenUpdater(
+            ExchangeDataFop, 'fop', ('authority', 'taxpayer_type', 'start_number', 'end_number'),
+            ('start_date', 'end_date'),
+            self.bulk_manager
+        )
+        self.skipped_records_counter = 0
         super().__init__()
 
     def add_fop_kveds_to_dict(self, fop_kveds_from_record, code):
         all_fop_foptokveds = []
         for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
+            if not activity['code']:
                 continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
-                continue
-            kved = self.get_kved_from_DB(kved_code, kved_name)
-            if activity.xpath('PRIMARY'):
-                is_primary = activity.xpath('PRIMARY')[0].text == "так"
-            else:
-                is_primary = False
-            fop_to_kved = FopToKved(kved=kved, primary_kved=is_primary)
+            kved = self.get_kved_from_DB(activity['code'], activity['name'])
+            fop_to_kved = FopToKved(kved=kved, primary_kved=activity['is_primary'] or False)
             all_fop_foptokveds.append(fop_to_kved)
         if len(all_fop_foptokveds):
             self.new_fops_foptokveds[code] = all_fop_foptokveds
 
-    # putting all kveds into a list
     def update_fop_kveds(self, fop_kveds_from_record, fop):
-        already_stored_foptokveds = list(FopToKved.objects.filter(fop_id=fop.id))
-        self.time_it('trying get kveds\t')
-        for activity in fop_kveds_from_record:
-            code_info = activity.xpath('CODE')
-            if not code_info:
-                continue
-            kved_code = code_info[0].text
-            if not kved_code:
-                continue
-            name_info = activity.xpath('NAME')
-            if not name_info:
-                continue
-            kved_name = name_info[0].text
-            if not kved_name:
-                continue
-            kved = self.get_kved_from_DB(kved_code, kved_name)
-            if activity.xpath('PRIMARY'):
-                is_primary = activity.xpath('PRIMARY')[0].text == "так"
-            else:
-                is_primary = False
-            alredy_stored = False
-            self.time_it('getting data kveds from record')
-            if len(already_stored_foptokveds):
-                for stored_foptokved in already_stored_foptokveds:
-                    if stored_foptokved.kved_id == kved.id:
-                        alredy_stored = True
-                        if stored_foptokved.primary_kved != is_primary:
-                            stored_foptokved.primary_kved = is_primary
-                            stored_foptokved.save(update_fields=['primary_kved', 'updated_at'])
-                        already_stored_foptokveds.remove(stored_foptokved)
-                        break
-            if not alredy_stored:
-                fop_to_kved = FopToKved(fop=fop, kved=kved, primary_kved=is_primary)
-                self.bulk_manager.add(fop_to_kved)
-            self.time_it('update kveds\t\t')
-        if len(already_stored_foptokveds):
-            for outdated_foptokved in already_stored_foptokveds:
-                outdated_foptokved.soft_delete()
+        self.add_fop_kveds_to_dict(fop_kveds_from_record, fop.code)
+        self.fop_to_kved_updater.update(fop, self.new_fops_foptokveds.pop(fop.code, []))
 
     def extract_exchange_data(self, answer):
-        authority_info = answer.xpath('AUTHORITY_NAME')
         authority = None
-        if authority_info and authority_info[0].text:
-            authority = self.save_or_get_authority(authority_info[0].text)
-        taxpayer_info = answer.xpath('TAX_PAYER_TYPE')
+        if answer['authority']:
+            authority = self.save_or_get_authority(answer['authority'])
         taxpayer_type = None
-        if taxpayer_info and taxpayer_info[0].text:
-            taxpayer_type = self.save_or_get_taxpayer_type(taxpayer_info[0].text)
-        start_date_info = answer.xpath('START_DATE')
-        start_date = None
-        if start_date_info and start_date_info[0].text:
-            start_date = format_date_to_yymmdd(start_date_info[0].text)
-        start_number_info = answer.xpath('START_NUM')
-        start_number = None
-        if start_number_info:
-            start_number = start_number_info[0].text
-        end_date_info = answer.xpath('END_DATE')
-        end_date = None
-        if end_date_info and end_date_info[0].text:
-            end_date = format_date_to_yymmdd(end_date_info[0].text)
-        end_number_info = answer.xpath('END_NUM')
-        end_number = None
-        if end_number_info and end_number_info[0].text:
-            end_number = end_number_info[0].text
-        return authority, taxpayer_type, start_date, start_number, end_date, end_number
+        if answer['taxpayer_type']:
+            taxpayer_type = self.save_or_get_taxpayer_type(answer['taxpayer_type'])
+        return (authority, taxpayer_type, answer['start_date'], answer['start_number'],
+                answer['end_date'], answer['end_number'])
 
     def add_fop_exchange_data_to_dict(self, exchange_data, code):
         all_fop_exchangedata = []
@@ -141,40 +100,49 @@ class FopFullConverter(BusinessConverter):
         if len(all_fop_exchangedata):
             self.new_fops_exchange_data[code] = all_fop_exchangedata
 
-    # putting all exchange data into a list
     def update_fop_exchange_data(self, exchange_data, fop):
-        already_stored_exchange_data = ExchangeDataFop.objects.filter(fop_id=fop.id)
-        self.time_it('trying get exchange_data')
-        for answer in exchange_data:
-            authority, taxpayer_type, start_date, start_number, end_date, end_number \
-                = self.extract_exchange_data(answer)
-            self.time_it('getting exchange_data from record')
-            if (not authority and not taxpayer_type and not start_date
-                    and not start_number and not end_date and not end_number):
-                continue
-            already_stored = False
-            for stored_exchange_data in already_stored_exchange_data:
-                # ToDo: find way to check dates
-                if (stored_exchange_data.authority_id == authority.id if authority else None
-                        and stored_exchange_data.taxpayer_type_id == taxpayer_type.id if taxpayer_type else None
-                        and stored_exchange_data.start_number == start_number
-                        and stored_exchange_data.end_number == end_number):
-                    already_stored = True
-                    break
-            if not already_stored:
-                exchange_data = ExchangeDataFop(fop=fop,
-                                                authority=authority,
-                                                taxpayer_type=taxpayer_type,
-                                                start_date=start_date,
-                                                start_number=start_number,
-                                                end_date=end_date,
-                                                end_number=end_number
-                                                )
-                self.bulk_manager.add(exchange_data)
+        self.add_fop_exchange_data_to_dict(exchange_data, fop.code)
+        self.exchange_data_updater.update(fop, self.new_fops_exchange_data.pop(fop.code, []))
+
+    def skip_unchanged_records(self, records):
+        """
+        Returns pairs of records and their fingerprints without records that are the same
+        as when the stored FOPs were saved. All fingerprints of the chunk are checked with one query.
+        """
+        fingerprints = [self.get_fingerprint(record) for record in records]
+        unchanged_fingerprints = set(Fop.objects.filter(
+            fingerprint__in=fingerprints
+        ).values_list('fingerprint', flat=True))
+        changed_records = []
+        for record, fingerprint in zip(records, fingerprints):
+            if fingerprint in unchanged_fingerprints:
+                self.skipped_records_counter += 1
+            else:
+                changed_records.append((record, fingerprint))
+        self.time_it('skip unchanged records\t')
+        return changed_records
+
+    def get_fop_code(self, data):
+        if not data['fullname']:
+            return None
+        return data['fullname'].lower() + (data['address'] or 'EMPTY')
 
     def save_to_db(self, records):
-        for record in records:
-            fullname = record.xpath('NAME')[0].text
+        records = [(record, self.RECORD_SCHEMA.extract(record), fingerprint)
+                   for record, fingerprint in self.skip_unchanged_records(records)]
+        self.time_it('getting data from record')
+        self.prefetch_dimensions(data for _, data, _ in records)
+        stored_fops = self.get_stored_objects(
+            Fop.objects.all(),
+            'code',
+            [code for code in (self.get_fop_code(data) for _, data, _ in records) if code]
+        )
+        fop_ids = [fop.id for fop in stored_fops.values()]
+        self.fop_to_kved_updater.prefetch(fop_ids)
+        self.exchange_data_updater.prefetch(fop_ids)
+        self.time_it('prefetch children\t')
+        for record, data, fingerprint in records:
+            fullname = data['fullname']
             if not fullname:
                 logger.warning(f'ФОП без прізвища: {record}')
                 # self.report.invalid_data += 1
@@ -184,12 +152,12 @@ class FopFullConverter(BusinessConverter):
                 continue
             if fullname:
                 fullname = fullname.lower()
-            address = record.xpath('ADDRESS')[0].text
+            address = data['address']
             if not address:
                 address = 'EMPTY'
             code = fullname + address
-            status = self.save_or_get_status(record.xpath('STAN')[0].text)
-            registration_text = record.xpath('REGISTRATION')[0].text
+            status = self.save_or_get_status(data['status'])
+            registration_text = data['registration']
             # first getting date, then registration info if REGISTRATION.text exists
             registration_date = None
             registration_date_second = None
@@ -202,25 +170,23 @@ class FopFullConverter(BusinessConverter):
                 registration_date_second = format_date_to_yymmdd(registration_text[1])
                 if 3 <= len(registration_text):
                     registration_number = registration_text[2]
-            estate_manager = record.xpath('ESTATE_MANAGER')[0].text
-            termination_text = record.xpath('TERMINATED_INFO')[0].text
+            estate_manager = data['estate_manager']
+            termination_text = data['termination']
             termination_date = None
             terminated_info = None
             if termination_text:
                 termination_date = format_date_to_yymmdd(get_first_word(termination_text))
                 terminated_info = cut_first_word(termination_text)
-            termination_cancel_info = record.xpath('TERMINATION_CANCEL_INFO')[0].text
-            contact_info = record.xpath('CONTACTS')[0].text
-            vp_dates = record.xpath('VP_DATES')[0].text
-            if record.xpath('CURRENT_AUTHORITY')[0].text:
-                authority = self.save_or_get_authority(record.xpath('CURRENT_AUTHORITY')[0].text)
+            termination_cancel_info = data['termination_cancel_info']
+            contact_info = data['contact_info']
+            vp_dates = data['vp_dates']
+            if data['authority']:
+                authority = self.save_or_get_authority(data['authority'])
             else:
                 authority = None
-            fop_kveds = record.xpath('ACTIVITY_KINDS')[0]
-            exchange_data = record.xpath('EXCHANGE_DATA')[0]
-            self.time_it('getting data from record')
-            fop = Fop.objects.filter(code=code).first()
-            self.time_it('trying get fops\t\t')
+            fop_kveds = data['kveds']
+            exchange_data = data['exchange_data']
+            fop = stored_fops.get(code)
             if not fop:
                 fop = Fop(
                     fullname=fullname,
@@ -237,7 +203,8 @@ class FopFullConverter(BusinessConverter):
                     contact_info=contact_info,
                     vp_dates=vp_dates,
                     authority=authority,
-                    code=code
+                    code=code,
+                    fingerprint=fingerprint
                 )
                 self.bulk_manager.add(fop)
                 if len(fop_kveds):
@@ -287,13 +254,16 @@ class FopFullConverter(BusinessConverter):
                 self.time_it('compare fops\t\t')
                 if len(update_fields):
                     update_fields.append('updated_at')
+                if fop.fingerprint != fingerprint:
+                    # updated_at is not changed, when only the source record of the FOP is new
+                    fop.fingerprint = fingerprint
+                    update_fields.append('fingerprint')
+                if len(update_fields):
                     fop.save(update_fields=update_fields)
                 self.time_it('update fops\t\t')
-                if len(fop_kveds):
-                    self.update_fop_kveds(fop_kveds, fop)
-                self.time_it('delete outdated kveds\t')
-                if len(exchange_data):
-                    self.update_fop_exchange_data(exchange_data, fop)
+                self.update_fop_kveds(fop_kveds, fop)
+                self.time_it('update kveds\t\t')
+                self.update_fop_exchange_data(exchange_data, fop)
                 self.time_it('update exchange_data\t')
         if len(self.bulk_manager.queues['business_register.Fop']):
             self.bulk_manager.commit(Fop)
@@ -320,8 +290,16 @@ class FopFullConverter(BusinessConverter):
             self.bulk_manager.commit(ExchangeDataFop)
         self.bulk_manager.queues['business_register.FopToKved'] = []
         self.bulk_manager.queues['business_register.ExchangeDataFop'] = []
+        self.fop_to_kved_updater.commit()
+        self.exchange_data_updater.commit()
         self.time_it('save others\t\t')
 
+    def get_worker_state(self):
+        return self.skipped_records_counter
+
+    def merge_worker_state(self, state):
+        self.skipped_records_counter += state
+
     print("For storing run FopFullConverter().process()")
 
 
@@ -331,6 +309,8 @@ class FopFullDownloader(Downloader):
     zip_required_file_sign = 'ufop_full'
     unzip_required_file_sign = 'EDR_FOP_FULL'
     unzip_after_download = True
+    segments = settings.DOWNLOAD_SEGMENTS_FOP_FULL
+    stream_from_zip = settings.STREAM_FROM_ZIP_FOP_FULL
     source_dataset_url = settings.BUSINESS_FOP_SOURCE_PACKAGE
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_FOP_FULL
 
@@ -352,23 +332,26 @@ class FopFullDownloader(Downloader):
 
         logger.info(f'{self.reg_name}: Update started...')
 
-        self.report_init()
-        self.report.long_time_converter = True
-        self.report.save()
-        self.download()
+        if not self.resume_report():
+            self.report_init()
+            self.report.long_time_converter = True
+            self.report.save()
+            self.download()
 
-        self.LOCAL_FILE_NAME = self.file_name
-        self.remove_unreadable_characters()
+            if not self.stream_from_zip:
+                self.LOCAL_FILE_NAME = self.file_name
+                self.remove_unreadable_characters()
 
-        self.report.update_start = timezone.now()
-        self.report.save()
+            self.report.update_start = timezone.now()
+            self.report.save()
 
         logger.info(f'{self.reg_name}: process() with {self.file_path} started ...')
         fop_full = FopFullConverter()
-        fop_full.LOCAL_FILE_NAME = self.file_name
+        self.set_converter_source(fop_full)
+        fop_full.report = self.report
 
         sleep(5)
-        if fop_full.process():
+        if fop_full.process(resume=True):
             logger.info(f'{self.reg_name}: process() with {self.file_path} finished successfully.')
             self.report.update_status = True
 
@@ -381,6 +364,7 @@ class FopFullDownloader(Downloader):
             self.update_register_field(settings.FOP_REGISTER_LIST, 'total_records', new_total_records)
             logger.info(f'{self.reg_name}: Update total records finished successfully.')
 
+            self.report.records_skipped = fop_full.skipped_records_counter
             self.measure_changes('business_register', 'Fop')
             logger.info(f'{self.reg_name}: Report created successfully.')
 
@@ -3,324 +3,282 @@ from django.apps import apps
 from django.conf import settings
 
 from business_register.constants import HistoryTypes
+from business_register.converter.edrpou_index import clear_edrpou_index, get_edrpou_index
 from business_register.models.company_models import Company, CompanyDetail, Signer, Founder
-from data_ocean.converter import Converter
+from data_ocean.converter import Converter, CopyBulkCreateManager
+from data_ocean.record_schema import RecordField, RecordSchema
 
 
-class AddressHistorical(Converter):
-    LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_ADDRESS
+def to_history_date(text):
+    return datetime.datetime.strptime(text, "%Y/%m/%d %H:%M:%S")
+
+
+def get_first_ids(queryset, key_field):
+    """Returns a dict of the key to the id of the first object with it, like .first() for every key"""
+    first_ids = {}
+    for key, object_id in queryset.order_by('id').values_list(key_field, 'id'):
+        first_ids.setdefault(key, object_id)
+    return first_ids
+
+
+class HistoryConverter(Converter):
+    """
+    Base of the converters of company history files. Companies are found in the EDRPOU index shared
+    by all history converters of the process, and history rows of the whole chunk are streamed
+    into the table with one COPY.
+    """
     LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
+    CHUNK_SIZE = 20000
     RECORD_TAG = 'DATA_RECORD'
-    HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
-    tables = [HistoricalCompany]
-    create_queues = []
+    RECORD_SCHEMA = None
+    HISTORY_MODEL = None
+    tables = []
+
+    def __init__(self):
+        super().__init__()
+        self.companies = get_edrpou_index()
+        self.bulk_manager = CopyBulkCreateManager()
+
+    def clear_caches(self):
+        super().clear_caches()
+        clear_edrpou_index()
+
+    def get_history_objects(self, records_data):
+        """Yields not saved history objects for the extracted records of the chunk"""
+        raise NotImplementedError
 
     def save_to_db(self, records):
-        for record in records:
-            company = self.HistoricalCompany()
-            company.edrpou = record.xpath('EDRPOU')[0].text
-            address = record.xpath('Address')[0].text
-            company.address = " ".join(address.split())[:1000]
-            company.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
-                company.id = company_exists.id
-            except AttributeError:
-                company.id = 0  # for changed records that can't be assigned to existing company
-            company.history_type = HistoryTypes.UPDATE
-            company.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
-            company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
-
-
-class SignerHistorical(Converter):
+        self.companies.load()
+        records_data = [data for data in map(self.RECORD_SCHEMA.extract, records) if data]
+        created_at = datetime.datetime.now()
+        for history_object in self.get_history_objects(records_data):
+            history_object.history_type = HistoryTypes.UPDATE
+            history_object.created_at = created_at
+            self.bulk_manager.add(history_object)
+        self.bulk_manager.commit(self.HISTORY_MODEL)
+        self.bulk_manager.queues[self.HISTORY_MODEL._meta.label] = []
+
+
+class AddressHistorical(HistoryConverter):
+    LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_ADDRESS
+    HISTORY_MODEL = HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    tables = [HistoricalCompany]
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('NAME', 'name'),
+        RecordField('Address', 'address', lambda text: " ".join(text.split())[:1000]),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
+
+    def get_history_objects(self, records_data):
+        for data in records_data:
+            yield self.HistoricalCompany(
+                # 0 is for changed records that can't be assigned to existing company
+                id=self.companies.get_id(data['edrpou']) or 0,
+                edrpou=data['edrpou'],
+                address=data['address'],
+                history_date=data['history_date'],
+                code=(data['name'] or '') + data['edrpou'],
+            )
+
+
+class SignerHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_SIGNER
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalSigner = apps.get_model('business_register', 'HistoricalSigner')
+    HISTORY_MODEL = HistoricalSigner = apps.get_model('business_register', 'HistoricalSigner')
     tables = [HistoricalSigner]
-    create_queues = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('NAME', 'name'),
+        RecordField('SIGNER', 'signer'),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            signer = self.HistoricalSigner()
-            edrpou = record.xpath('EDRPOU')[0].text
-            signer.name = record.xpath('SIGNER')[0].text
-            signer.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                company_exists = Company.objects.filter(edrpou=edrpou).first()
-                signer.company = company_exists
-            except AttributeError:
+    def get_history_objects(self, records_data):
+        company_ids = {data['edrpou']: self.companies.get_id(data['edrpou']) for data in records_data}
+        signer_ids = get_first_ids(
+            Signer.objects.filter(company_id__any=[i for i in company_ids.values() if i]),
+            'company_id'
+        )
+        for data in records_data:
+            company_id = company_ids[data['edrpou']]
+            if not company_id:
                 continue
-            try:
-                signer.id = Signer.objects.filter(company=company_exists).first().id
-            except AttributeError:
-                signer.id = 0  # for changed records that can't be assigned to existing company
-            signer.history_type = HistoryTypes.UPDATE
-            signer.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
-            signer.created_at = datetime.datetime.now()
-            self.create_queues.append(signer)
-        self.HistoricalSigner.objects.bulk_create(self.create_queues)
-        self.create_queues = []
-
-
-class FounderHistorical(Converter):
+            yield self.HistoricalSigner(
+                # 0 is for changed records that can't be assigned to existing signer
+                id=signer_ids.get(company_id, 0),
+                company_id=company_id,
+                name=data['signer'],
+                history_date=data['history_date'],
+                code=(data['name'] or '') + data['edrpou'],
+            )
+
+
+class FounderHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_FOUNDER
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 1
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalFounder = apps.get_model('business_register', 'HistoricalFounder')
+    HISTORY_MODEL = HistoricalFounder = apps.get_model('business_register', 'HistoricalFounder')
     DATE_OF_DATA_PURCHASE = '2019-06-07 15:25:48.000000'
-    tables = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('FOUNDER_NAME', 'name', str.lower, required=True),
+        RecordField('FOUNDER_CODE', 'code'),
+        RecordField('FOUNDER_EQUITY', 'equity', lambda text: float(text.replace(',', '.'))),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            company_edrpou_info = record.xpath('EDRPOU')
-            if not company_edrpou_info:
-                return
-            company_edrpou = company_edrpou_info[0].text
-            if not company_edrpou:
-                return
-            company = Company.objects.filter(edrpou=company_edrpou).first()
-            if not company:
-                return
-            founder_name_info = record.xpath('FOUNDER_NAME')
-            if not founder_name_info:
-                return
-            founder_name = founder_name_info[0].text
-            if not founder_name:
-                return
-            founder_name = founder_name.lower()
-            founder_code = None
-            founder_code_info = record.xpath('FOUNDER_CODE')
-            if founder_code_info:
-                founder_code = founder_code_info[0].text
-            founder_edrpou = None
-            # ignoring personal data according to the law
-            if founder_code and len(founder_code) == 8:
-                founder_edrpou = founder_code
-            founder_equity = None
-            founder_equity_info = record.xpath('FOUNDER_EQUITY')
-            if founder_equity_info:
-                founder_equity = founder_equity_info[0].text
-            if founder_equity:
-                founder_equity = float(founder_equity.replace(',', '.'))
-            existed_founder = Founder.objects.filter(company=company, name=founder_name)
-            if existed_founder:
-                founder_id = existed_founder.id
-            else:
-                founder_id = 0
-            history_date = self.DATE_OF_DATA_PURCHASE
-            self.HistoricalFounder.objects.create(id=founder_id,
-                                                  created_at=datetime.datetime.now(),
-                                                  history_date=history_date,
-                                                  history_type=HistoryTypes.UPDATE,
-                                                  name=founder_name, edrpou=founder_edrpou,
-                                                  equity=founder_equity, company=company)
-
-
-class NameHistorical(Converter):
+    def get_history_objects(self, records_data):
+        company_ids = {data['edrpou']: self.companies.get_id(data['edrpou']) for data in records_data}
+        founders = Founder.objects.filter(company_id__any=[i for i in company_ids.values() if i])
+        founder_ids = {}
+        for company_id, name, founder_id in founders.order_by('id').values_list('company_id', 'name', 'id'):
+            founder_ids.setdefault((company_id, name), founder_id)
+        for data in records_data:
+            company_id = company_ids[data['edrpou']]
+            if not company_id:
+                continue
+            founder_code = data['code']
+            yield self.HistoricalFounder(
+                id=founder_ids.get((company_id, data['name']), 0),
+                history_date=self.DATE_OF_DATA_PURCHASE,
+                name=data['name'],
+                # ignoring personal data according to the law
+                edrpou=founder_code if founder_code and len(founder_code) == 8 else None,
+                equity=data['equity'],
+                company_id=company_id,
+            )
+
+
+class NameHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_NAME
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    HISTORY_MODEL = HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
     tables = [HistoricalCompany]
-    create_queues = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('NAME', 'name'),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            company = self.HistoricalCompany()
-            company.edrpou = record.xpath('EDRPOU')[0].text
-            company.name = record.xpath('NAME')[0].text
-            company.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
-                company.id = company_exists.id
-            except AttributeError:
-                company.id = 0  # for changed records that can't be assigned to existing company
-            company.history_type = HistoryTypes.UPDATE
-            company.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
-            company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
-
-
-class ShortNameHistorical(Converter):
+    def get_history_objects(self, records_data):
+        for data in records_data:
+            yield self.HistoricalCompany(
+                # 0 is for changed records that can't be assigned to existing company
+                id=self.companies.get_id(data['edrpou']) or 0,
+                edrpou=data['edrpou'],
+                name=data['name'],
+                history_date=data['history_date'],
+                code=(data['name'] or '') + data['edrpou'],
+            )
+
+
+class ShortNameHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_SHORTNAME
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    HISTORY_MODEL = HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
     tables = [HistoricalCompany]
-    create_queues = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('SHORT_NAME', 'short_name'),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            company = self.HistoricalCompany()
-            company.edrpou = record.xpath('EDRPOU')[0].text
-            if len(record.xpath('SHORT_NAME')) > 0:
-                company.short_name = record.xpath('SHORT_NAME')[0].text
-            else:
-                company.short_name = ''
-            company.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            name = ''
-            try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
-                company.id = company_exists.id
-                name = company_exists.name
-            except AttributeError:
-                company.id = 0  # for changed records that can't be assigned to existing company
-            company.history_type = HistoryTypes.UPDATE
-            company.code = name + record.xpath('EDRPOU')[0].text
-            company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
-
-
-class CapitalHistorical(Converter):
+    def get_history_objects(self, records_data):
+        company_ids = {data['edrpou']: self.companies.get_id(data['edrpou']) for data in records_data}
+        names = dict(Company.objects.filter(
+            id__any=[i for i in company_ids.values() if i]
+        ).values_list('id', 'name'))
+        for data in records_data:
+            company_id = company_ids[data['edrpou']]
+            yield self.HistoricalCompany(
+                # 0 is for changed records that can't be assigned to existing company
+                id=company_id or 0,
+                edrpou=data['edrpou'],
+                short_name=data['short_name'] or '',
+                history_date=data['history_date'],
+                code=(names.get(company_id) or '') + data['edrpou'],
+            )
+
+
+class CapitalHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_CAPITAL
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalCompanyDetail = apps.get_model('business_register', 'HistoricalCompanyDetail')
+    HISTORY_MODEL = HistoricalCompanyDetail = apps.get_model('business_register', 'HistoricalCompanyDetail')
     tables = [HistoricalCompanyDetail]
-    create_queues = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('NAME', 'name'),
+        RecordField('AUTHORIZED_CAPITAL', 'authorized_capital'),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            company_detail = self.HistoricalCompanyDetail()
-            edrpou = record.xpath('EDRPOU')[0].text
-            if len(record.xpath('AUTHORIZED_CAPITAL')) > 0:
-                company_detail.authorized_capital = record.xpath('AUTHORIZED_CAPITAL')[0].text
-            else:
-                company_detail.authorized_capital = ''
-            company_detail.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                company_exists = Company.objects.filter(edrpou=edrpou).first()
-                company_detail.company = company_exists
-            except AttributeError:
+    def get_history_objects(self, records_data):
+        company_ids = {data['edrpou']: self.companies.get_id(data['edrpou']) for data in records_data}
+        company_detail_ids = get_first_ids(
+            CompanyDetail.objects.filter(company_id__any=[i for i in company_ids.values() if i]),
+            'company_id'
+        )
+        for data in records_data:
+            company_id = company_ids[data['edrpou']]
+            if not company_id:
                 continue
-            try:
-                company_detail.id = CompanyDetail.objects.filter(company=company_exists).first().id
-            except AttributeError:
-                company_detail.id = 0  # for changed records that can't be assigned
-            company_detail.history_type = HistoryTypes.UPDATE
-            company_detail.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
-            company_detail.created_at = datetime.datetime.now()
-            self.create_queues.append(company_detail)
-        self.HistoricalCompanyDetail.objects.bulk_create(self.create_queues)
-        self.create_queues = []
-
-
-class BranchHistorical(Converter):
+            company_detail = self.HistoricalCompanyDetail(
+                # 0 is for changed records that can't be assigned
+                id=company_detail_ids.get(company_id, 0),
+                company_id=company_id,
+                history_date=data['history_date'],
+                code=(data['name'] or '') + data['edrpou'],
+            )
+            company_detail.authorized_capital = data['authorized_capital'] or ''
+            yield company_detail
+
+
+class BranchHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_BRANCH
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    HISTORY_MODEL = HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
     tables = [HistoricalCompany]
-    create_queues = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou'),
+        RecordField('BRANCH_NAME', 'name', required=True),
+        RecordField('BRANCH_CODE', 'short_name'),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            branch = self.HistoricalCompany()
-            # branch.edrpou = record.xpath('')[0].text
-            branch.name = record.xpath('BRANCH_NAME')[0].text
-            if len(record.xpath('BRANCH_CODE')) > 0:
-                branch.short_name = record.xpath('BRANCH_CODE')[0].text
-            else:
-                branch.short_name = ''
-            branch.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                company_exists = Company.objects.filter(
-                    edrpou=record.xpath('EDRPOU')[0].text).first()
-                branch.id = company_exists.id
-                branch.parent = company_exists
-            except AttributeError:
-                branch.id = 0  # for changed records that can't be assigned to existing company
-            branch.history_type = HistoryTypes.UPDATE
-            branch.code = record.xpath('BRANCH_NAME')[0].text + \
-                          branch.short_name
-            branch.created_at = datetime.datetime.now()
-            self.create_queues.append(branch)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
-
-
-class InfoHistorical(Converter):
+    def get_history_objects(self, records_data):
+        for data in records_data:
+            company_id = self.companies.get_id(data['edrpou'])
+            short_name = data['short_name'] or ''
+            yield self.HistoricalCompany(
+                # 0 is for changed records that can't be assigned to existing company
+                id=company_id or 0,
+                parent_id=company_id,
+                name=data['name'],
+                short_name=short_name,
+                history_date=data['history_date'],
+                code=data['name'] + short_name,
+            )
+
+
+class InfoHistorical(HistoryConverter):
     LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_UO_INFO
-    LOCAL_FOLDER = settings.LOCAL_FOLDER
-    CHUNK_SIZE = 2000
-    RECORD_TAG = 'DATA_RECORD'
-    HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
+    HISTORY_MODEL = HistoricalCompany = apps.get_model('business_register', 'HistoricalCompany')
     tables = [HistoricalCompany]
-    create_queues = []
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('EDRPOU', 'edrpou', required=True),
+        RecordField('NAME', 'name'),
+        RecordField('PHONE_1', 'phone_1'),
+        RecordField('PHONE_2', 'phone_2'),
+        RecordField('FAX', 'fax'),
+        RecordField('EMAIL', 'email'),
+        RecordField('WWW', 'www'),
+        RecordField('DATE', 'history_date', to_history_date, required=True),
+    )
 
-    def save_to_db(self, records):
-        for record in records:
-            company = self.HistoricalCompany()
-            company.edrpou = record.xpath('EDRPOU')[0].text
-            if len(record.xpath('PHONE_1')) > 0:
-                phone_1 = record.xpath('PHONE_1')[0].text
-            else:
-                phone_1 = ''
-            if len(record.xpath('PHONE_2')) > 0:
-                phone_2 = record.xpath('PHONE_2')[0].text
-            else:
-                phone_2 = ''
-            if len(record.xpath('FAX')) > 0:
-                fax = record.xpath('FAX')[0].text
-            else:
-                fax = ''
-            if len(record.xpath('EMAIL')) > 0:
-                email = record.xpath('EMAIL')[0].text
-            else:
-                email = ''
-            if len(record.xpath('WWW')) > 0:
-                www = record.xpath('WWW')[0].text
-            else:
-                www = ''
-            company.contact_info = (
-                f'phone_1: {phone_1}; phone_2: {phone_2}; '
-                f'fax: {fax}; email: {email}; www: {www}'
+    def get_history_objects(self, records_data):
+        for data in records_data:
+            contacts = {key: data[key] or '' for key in ('phone_1', 'phone_2', 'fax', 'email', 'www')}
+            yield self.HistoricalCompany(
+                # 0 is for changed records that can't be assigned to existing company
+                id=self.companies.get_id(data['edrpou']) or 0,
+                edrpou=data['edrpou'],
+                contact_info=(
+                    f'phone_1: {contacts["phone_1"]}; phone_2: {contacts["phone_2"]}; '
+                    f'fax: {contacts["fax"]}; email: {contacts["email"]}; www: {contacts["www"]}'
+                ),
+                history_date=data['history_date'],
+                code=(data['name'] or '') + data['edrpou'],
             )
-            company.history_date = datetime.datetime.strptime(
-                record.xpath('DATE')[0].text,
-                "%Y/%m/%d %H:%M:%S"
-            ).strftime("%Y-%m-%d %H:%M:%S")
-            try:
-                company_exists = Company.objects.filter(edrpou=company.edrpou).first()
-                company.id = company_exists.id
-            except AttributeError:
-                company.id = 0  # for changed records that can't be assigned to existing company
-            company.history_type = HistoryTypes.UPDATE
-            company.code = record.xpath('NAME')[0].text + record.xpath('EDRPOU')[0].text
-            company.created_at = datetime.datetime.now()
-            self.create_queues.append(company)
-        self.HistoricalCompany.objects.bulk_create(self.create_queues)
-        self.create_queues = []
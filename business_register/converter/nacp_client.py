@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from business_register.converter.declaration_archive import DeclarationArchive
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class NacpClient:
+    """
+    Gets declarations from the public API of NACP.
+    All threads share one session with a pool of keep-alive connections. Requests of all threads together
+    are spaced to not exceed requests_per_second and are retried after network errors and 429 or 5xx
+    responses with the doubled delay. fetch_all spreads requests over the pool of threads.
+    With archive_folder full declarations are kept in DeclarationArchive and are requested only once.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, list_url=settings.NACP_DECLARATION_LIST, retrieve_url=settings.NACP_DECLARATION_RETRIEVE,
+                 threads=settings.NACP_THREADS, requests_per_second=settings.NACP_REQUESTS_PER_SECOND,
+                 attempts=settings.NACP_ATTEMPTS, retry_delay=settings.NACP_RETRY_DELAY,
+                 timeout=settings.NACP_TIMEOUT, archive_folder=settings.NACP_ARCHIVE_FOLDER):
+        self.list_url = list_url
+        self.retrieve_url = retrieve_url
+        self.threads = threads
+        self.requests_per_second = requests_per_second
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.next_request_time = 0
+        self.archive = DeclarationArchive(archive_folder) if archive_folder else None
+
+    def wait_for_turn(self):
+        """Sleeps until the time reserved for the next request of all threads"""
+        if not self.requests_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + 1 / self.requests_per_second
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def get(self, url):
+        """Returns the decoded JSON response or None if the data can't be got"""
+        for attempt in range(1, self.attempts + 1):
+            self.wait_for_turn()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in self.RETRY_STATUSES:
+                    logger.error(f'NACP: {url}: status {response.status_code}')
+                    return None
+                error = f'status {response.status_code}'
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            if attempt == self.attempts:
+                logger.error(f'NACP: {url}: {error}, all {self.attempts} attempts failed')
+                return None
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            logger.warning(f'NACP: {url}: {error}, attempt {attempt} of {self.attempts} failed, '
+                           f'retry in {delay} s ...')
+            time.sleep(delay)
+
+    def get_declarations_list(self, nacp_declarant_id):
+        """Returns general info of declarations of the declarant or None"""
+        response = self.get(f'{self.list_url}?user_declarant_id={nacp_declarant_id}')
+        return response.get('data') if response else None
+
+    def get_declaration(self, declaration_id):
+        """Returns the full declaration with the data of all steps or None, archived ones are not requested"""
+        if self.archive and declaration_id in self.archive:
+            return self.archive.get(declaration_id)
+        declaration = self.get(self.retrieve_url + declaration_id)
+        if declaration and self.archive:
+            self.archive.put(declaration_id, declaration)
+        return declaration
+
+    def fetch_all(self, executor, fetch, items):
+        """
+        Yields pairs of items and results of fetch(item) in the order of items.
+        The queue of up to twice as many requests as threads are in progress or done and not yet yielded,
+        so the pool is busy while the caller saves the results, but responses don't pile up.
+        """
+        futures = deque()
+        for item in items:
+            futures.append((item, executor.submit(fetch, item)))
+            if len(futures) >= self.threads * 2:
+                item, future = futures.popleft()
+                yield item, future.result()
+        while futures:
+            item, future = futures.popleft()
+            yield item, future.result()
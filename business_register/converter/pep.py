@@ -1,16 +1,23 @@
+import json
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
+from itertools import islice
 
 import psycopg2
 import sshtunnel
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from requests.auth import HTTPBasicAuth
+from simple_history.utils import bulk_create_with_history
 
 from business_register.converter.business_converter import BusinessConverter
 from business_register.models.company_models import Company
 from business_register.models.pep_models import Pep, RelatedPersonsLink, CompanyLinkWithPep
-from data_ocean.converter import Converter
+from data_ocean.converter import Converter, IdTracker, TransactionBulkCreateManager
 from data_ocean.downloader import Downloader
 from data_ocean.utils import to_lower_string_if_exists
 from location_register.converter.address import AddressConverter
@@ -235,27 +242,29 @@ class PepConverterFromDB(Converter):
         self.database = settings.PEP_SOURCE_DATABASE
         self.user = settings.PEP_SOURCE_USER
         self.password = settings.PEP_SOURCE_PASSWORD
+        self.itersize = settings.PEP_SOURCE_ITERSIZE
+        self.sync_state_file = settings.PEP_SYNC_STATE_FILE
+        self.sync_batch_size = settings.PEP_SYNC_BATCH_SIZE
+        # only changed rows are got from the source and records removed from it are not deleted
+        self.delta = False
         self.peps_dict = self.put_objects_to_dict('code', 'business_register', 'Pep')
-        self.outdated_peps_dict = self.put_objects_to_dict('code', 'business_register', 'Pep')
+        self.peps_tracker = IdTracker(pep.id for pep in self.peps_dict.values())
         self.peps_links_dict = self.put_objects_to_dict(
             'source_id',
             'business_register',
             'RelatedPersonsLink')
-        self.outdated_peps_links_dict = self.put_objects_to_dict(
-            'source_id',
-            'business_register',
-            'RelatedPersonsLink')
+        self.peps_links_tracker = IdTracker(link.id for link in self.peps_links_dict.values())
         self.peps_companies_dict = self.put_objects_to_dict(
             'source_id',
             'business_register',
             'CompanyLinkWithPep')
-        self.outdated_peps_companies_dict = self.put_objects_to_dict(
-            'source_id',
-            'business_register',
-            'CompanyLinkWithPep')
+        self.peps_companies_tracker = IdTracker(link.id for link in self.peps_companies_dict.values())
+        # new companies and links with PEPs of the batch
+        self.bulk_manager = TransactionBulkCreateManager()
         self.peps_total_records_from_source = 0
         self.peps_links_total_records_from_source = 0
         self.peps_companies_total_records_from_source = 0
+        self.rows_count = 0
 
         self.invalid_data_counter = 0
         self.PEP_QUERY = ("""
@@ -268,14 +277,14 @@ class PepConverterFromDB(Converter):
             reputation_crimes_uk, reputation_crimes_en, 
             reputation_manhunt_uk, reputation_manhunt_en, wiki_uk, wiki_en, 
             type_of_official, reason_of_termination, termination_date 
-            FROM core_person;
+            FROM core_person
         """)
         self.PEPS_LINKS_QUERY = ("""
             SELECT from_person_id, to_person_id, 
             from_relationship_type, to_relationship_type, 
             date_established, date_confirmed, date_finished,
             id 
-            FROM core_person2person;
+            FROM core_person2person
         """)
         self.PEPS_COMPANIES_QUERY = ("""
             SELECT 
@@ -302,7 +311,18 @@ class PepConverterFromDB(Converter):
                 where relationship_type = 'registered_in'
                 GROUP BY from_company_id
             ) c2c on p2c.to_company_id = c2c.from_company_id
-            LEFT JOIN core_country country on c2c.to_country_id = country.id;
+            LEFT JOIN core_country country on c2c.to_country_id = country.id
+        """)
+        # rows of the query are grouped in batches by source id, the checksum of the batch changes
+        # when any row of it is added, changed or deleted
+        self.CHECKSUMS_QUERY = ("""
+            SELECT source_row.id / %s, COUNT(*), md5(string_agg(md5(source_row::text), '' ORDER BY source_row.id))
+            FROM ({query}) source_row
+            GROUP BY 1
+        """)
+        self.DELTA_QUERY = ("""
+            SELECT * FROM ({query}) source_row
+            WHERE source_row.id / %s = ANY(%s)
         """)
         self.REASONS_OF_TERMINATION = {
             1: Pep.DIED,
@@ -384,8 +404,8 @@ class PepConverterFromDB(Converter):
             'свекруха': 'mother-in-laws',
         }
 
-    def get_pep_data(self, host=None, port=None):
-
+    @contextmanager
+    def connect_to_source_db(self, host=None, port=None):
         host = host or self.host
         port = port or self.port
 
@@ -395,33 +415,30 @@ class PepConverterFromDB(Converter):
             port=port,
             database=self.database,
             user=self.user,
-            password=self.password
+            password=self.password,
+            # the connection stays open while rows are saved, a dropped tunnel is detected by keepalives
+            keepalives=1,
+            keepalives_idle=settings.PEP_SOURCE_KEEPALIVES_IDLE,
+            keepalives_interval=settings.PEP_SOURCE_KEEPALIVES_INTERVAL,
+            keepalives_count=settings.PEP_SOURCE_KEEPALIVES_COUNT,
         )
         logger.info(f'business_pep: psycopg2 connection is active: {not connection.closed}')
+        # all queries of the run see the same snapshot of the source
+        connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        try:
+            yield connection
+        finally:
+            connection.close()
 
-        with connection.cursor() as cursor:
-            cursor.execute(self.PEP_QUERY)
-            pep_data = cursor.fetchall()
-            logger.info(f'business_pep: psycopg2 result data length: {len(pep_data)} elements.')
-
-            cursor.execute(self.PEPS_LINKS_QUERY)
-            pep_links_data = cursor.fetchall()
-            logger.info(f'business_pep: psycopg2 result data length: {len(pep_links_data)} elements.')
-
-            cursor.execute(self.PEPS_COMPANIES_QUERY)
-            pep_companies_data = cursor.fetchall()
-            logger.info(f'business_pep: psycopg2 result data length: {len(pep_companies_data)} elements.')
-
-        connection.close()
-
-        return pep_data, pep_links_data, pep_companies_data
-
-    def get_data_from_source_db(self):
+    @contextmanager
+    def get_source_db_connection(self):
 
         logger.info(f'business_pep: use SSH tunnel: {settings.PEP_SOURCE_USE_SSH}')
 
         if not settings.PEP_SOURCE_USE_SSH:
-            return self.get_pep_data()
+            with self.connect_to_source_db() as connection:
+                yield connection
+            return
 
         sshtunnel.TUNNEL_TIMEOUT = settings.PEP_TUNNEL_TIMEOUT
         sshtunnel.SSH_TIMEOUT = settings.PEP_SSH_TIMEOUT
@@ -430,16 +447,92 @@ class PepConverterFromDB(Converter):
                 ssh_username=settings.PEP_SSH_USERNAME,
                 ssh_pkey=settings.PEP_SSH_PKEY,
                 remote_bind_address=(self.host, self.port),
+                set_keepalive=settings.PEP_SSH_KEEPALIVE,
                 # local_bind_address=(settings.PEP_LOCAL_SOURCE_HOST, settings.PEP_LOCAL_SOURCE_PORT)
         ) as tunnel:
             logger.info(
                 f'business_pep: tunnel is active: {tunnel.is_active} on '
                 f'{tunnel.local_bind_host}:{tunnel.local_bind_port}'
             )
-            return self.get_pep_data(
+            with self.connect_to_source_db(
                 host=tunnel.local_bind_host,
                 port=tunnel.local_bind_port,
-            )
+            ) as connection:
+                yield connection
+
+    def stream_rows(self, connection, name, query, params=None):
+        """
+        Yields rows of the query from a named server-side cursor, so only itersize rows are kept in memory.
+        The next batch is fetched by a thread while rows of the current one are saved.
+        """
+        with connection.cursor(name=name) as cursor:
+            cursor.execute(query, params)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                next_rows = executor.submit(cursor.fetchmany, self.itersize)
+                while True:
+                    rows = next_rows.result()
+                    if not rows:
+                        break
+                    next_rows = executor.submit(cursor.fetchmany, self.itersize)
+                    self.rows_count += len(rows)
+                    yield from rows
+
+    def run_stage(self, connection, name, query, save, params=None):
+        """
+        Streams rows of the query to save, returns the number of rows from the source.
+        If the connection to the source is lost the run fails before records are deleted or the sync state is saved.
+        """
+        logger.info(f'business_pep: {save.__name__} started ...')
+        self.rows_count = 0
+        try:
+            save(self.stream_rows(connection, name, query, params))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logger.error(f'business_pep: {name}: connection to the source lost after {self.rows_count} rows: {e}')
+            raise
+        logger.info(f'business_pep: {save.__name__} finished with {self.rows_count} elements.')
+        return self.rows_count
+
+    def load_sync_state(self):
+        """Returns the state of the last sync or None if all data should be got from the source"""
+        if not self.sync_state_file or not os.path.exists(self.sync_state_file):
+            return None
+        with open(self.sync_state_file, encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        full_sync_at = datetime.fromisoformat(state['full_sync_at'])
+        if (timezone.now() - full_sync_at).days >= settings.PEP_FULL_SYNC_DAYS:
+            return None
+        return state
+
+    def save_sync_state(self, state):
+        temp_path = f'{self.sync_state_file}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.sync_state_file)
+
+    def get_checksums(self, connection, query):
+        """Returns a dict of the batch number to the number of rows and the checksum of the batch"""
+        with connection.cursor() as cursor:
+            cursor.execute(self.CHECKSUMS_QUERY.format(query=query), [self.sync_batch_size])
+            return {str(batch): (count, checksum) for batch, count, checksum in cursor.fetchall()}
+
+    def sync_stage(self, connection, name, query, save, state, new_state):
+        """
+        Without the state of the last sync all rows are saved. Otherwise only rows of the batches
+        that are new or have other checksums are got from the source. Returns the number of rows in the source.
+        """
+        if not self.sync_state_file:
+            return self.run_stage(connection, name, query, save)
+        checksums = self.get_checksums(connection, query)
+        new_state['tables'][name] = {batch: checksum for batch, (_, checksum) in checksums.items()}
+        if not state:
+            return self.run_stage(connection, name, query, save)
+        stored_checksums = state['tables'].get(name, {})
+        changed_batches = [int(batch) for batch, (_, checksum) in checksums.items()
+                           if stored_checksums.get(batch) != checksum]
+        logger.info(f'business_pep: {name}: {len(changed_batches)} of {len(checksums)} batches changed')
+        self.run_stage(connection, name, self.DELTA_QUERY.format(query=query), save,
+                       [self.sync_batch_size, changed_batches])
+        return sum(count for count, _ in checksums.values())
 
     def save_or_update_peps_links(self, peps_links_data):
         for link in peps_links_data:
@@ -518,20 +611,22 @@ class PepConverterFromDB(Converter):
                     update_fields.append('updated_at')
                     stored_link.save(update_fields=update_fields)
                     is_changed = True
-                if self.outdated_peps_links_dict.get(source_id):
-                    del self.outdated_peps_links_dict[source_id]
+                self.peps_links_tracker.mark(stored_link.id)
             if is_changed and self.refresh_updated_at_field:
                 from_person.save(update_fields=['updated_at', ])
                 to_person.save(update_fields=['updated_at', ])
-        if self.outdated_peps_links_dict:
-            for link in self.outdated_peps_links_dict.values():
-                link.soft_delete()
-                link.from_person.save(update_fields=['updated_at', ])
-                link.to_person.save(update_fields=['updated_at', ])
+        outdated_links_ids = [] if self.delta else self.peps_links_tracker.get_unseen_ids()
+        if outdated_links_ids:
+            outdated_links = RelatedPersonsLink.objects.filter(
+                id__any=outdated_links_ids
+            ).values_list('from_person_id', 'to_person_id')
+            peps_ids = {pep_id for link in outdated_links for pep_id in link}
+            RelatedPersonsLink.bulk_soft_delete(outdated_links_ids)
+            Pep.objects.filter(id__any=list(peps_ids)).update(updated_at=timezone.now())
 
     def create_company_link_with_pep(self, company, pep, category, start_date, confirmation_date,
                                      end_date, is_state_company, source_id, relationship_type, relationship_type_en):
-        self.peps_companies_dict[source_id] = CompanyLinkWithPep.objects.create(
+        self.peps_companies_dict[source_id] = CompanyLinkWithPep(
             company=company,
             pep=pep,
             category=category,
@@ -543,9 +638,47 @@ class PepConverterFromDB(Converter):
             relationship_type=relationship_type,
             relationship_type_en=relationship_type_en
         )
+        self.bulk_manager.add(self.peps_companies_dict[source_id])
+
+    def get_stored_companies(self, peps_companies_data):
+        """
+        Returns dicts of antac_id to the company and of EDRPOU to the company from the Ukrainian register
+        for companies of all rows, got with two queries
+        """
+        companies_by_antac_id = {company.antac_id: company for company in Company.include_deleted_objects.filter(
+            antac_id__any=list({link[1] for link in peps_companies_data})
+        )}
+        edrpous = {link[6] for link in peps_companies_data if link[1] not in companies_by_antac_id and link[6]}
+        companies_by_edrpou = {}
+        if edrpous:
+            for company in Company.include_deleted_objects.filter(
+                    edrpou__any=list(edrpous),
+                    source=Company.UKRAINE_REGISTER
+            ).order_by('id'):
+                companies_by_edrpou.setdefault(company.edrpou, company)
+        return companies_by_antac_id, companies_by_edrpou
 
     def save_or_update_peps_companies(self, peps_companies_data):
         address_converter = AddressConverter()
+        peps_companies_data = iter(peps_companies_data)
+        while True:
+            batch = list(islice(peps_companies_data, self.itersize))
+            if not batch:
+                break
+            self.save_or_update_peps_companies_batch(batch, address_converter)
+        outdated_links_ids = [] if self.delta else self.peps_companies_tracker.get_unseen_ids()
+        if outdated_links_ids:
+            peps_ids = set(CompanyLinkWithPep.objects.filter(
+                id__any=outdated_links_ids
+            ).values_list('pep_id', flat=True))
+            CompanyLinkWithPep.bulk_soft_delete(outdated_links_ids)
+            Pep.objects.filter(id__any=list(peps_ids)).update(updated_at=timezone.now())
+
+    def save_or_update_peps_companies_batch(self, peps_companies_data, address_converter):
+        """New companies of the batch are created in bulk with their history, then new links"""
+        companies_by_antac_id, companies_by_edrpou = self.get_stored_companies(peps_companies_data)
+        changed_peps_ids = set()
+        new_companies = []
         for link in peps_companies_data:
             is_changed = False
             pep_source_id = link[0]
@@ -570,21 +703,21 @@ class PepConverterFromDB(Converter):
                 company_name_en = transliterate(translate_company_type_in_string(company_name))
             relationship_type = link[13]
             relationship_type_en = link[14]
-            country = address_converter.save_or_get_country(country_name) if country_name else None
-            company = Company.include_deleted_objects.filter(antac_id=company_antac_id).first()
+            company = companies_by_antac_id.get(company_antac_id)
             company_update_fields = []
             if not company and edrpou:
-                company = Company.include_deleted_objects.filter(
-                    edrpou=edrpou,
-                    source=Company.UKRAINE_REGISTER
-                ).first()
+                company = companies_by_edrpou.get(edrpou)
                 if company:
                     company.antac_id = company_antac_id
                     company_update_fields.append('antac_id')
+                    companies_by_antac_id[company_antac_id] = company
             if not company:
-                company = Company.objects.create(name=company_name, name_en=company_name_en, edrpou=edrpou,
-                                                 country=country, code=company_name + edrpou, source=Company.ANTAC,
-                                                 antac_id=company_antac_id, from_antac_only=True)
+                country = address_converter.save_or_get_country(country_name) if country_name else None
+                company = Company(name=company_name, name_en=company_name_en, edrpou=edrpou,
+                                  country=country, code=company_name + edrpou, source=Company.ANTAC,
+                                  antac_id=company_antac_id, from_antac_only=True)
+                new_companies.append(company)
+                companies_by_antac_id[company_antac_id] = company
                 self.create_company_link_with_pep(company, pep, category, start_date,
                                                   confirmation_date, end_date, is_state_company,
                                                   source_id, relationship_type, relationship_type_en)
@@ -593,7 +726,8 @@ class PepConverterFromDB(Converter):
                 if company.name_en != company_name_en:
                     company.name_en = company_name_en
                     company_update_fields.append('name_en')
-                if company_update_fields:
+                # companies created in this batch are saved with the changes in bulk
+                if company_update_fields and company.pk:
                     company_update_fields.append('updated_at')
                     company.save(update_fields=company_update_fields)
                 already_stored_link = self.peps_companies_dict.get(source_id)
@@ -632,14 +766,16 @@ class PepConverterFromDB(Converter):
                         update_fields.append('updated_at')
                         already_stored_link.save(update_fields=update_fields)
                         is_changed = True
-                    if self.outdated_peps_companies_dict.get(source_id):
-                        del self.outdated_peps_companies_dict[source_id]
-            if is_changed and self.refresh_updated_at_field:
-                pep.save(update_fields=['updated_at', ])
-        if self.outdated_peps_companies_dict:
-            for link in self.outdated_peps_companies_dict.values():
-                link.soft_delete()
-                link.pep.save(update_fields=['updated_at', ])
+                    self.peps_companies_tracker.mark(already_stored_link.id)
+            if is_changed:
+                changed_peps_ids.add(pep.id)
+        # new companies get pks and history before links to them are created
+        with transaction.atomic():
+            if new_companies:
+                bulk_create_with_history(new_companies, Company)
+            self.bulk_manager.commit_all()
+        if changed_peps_ids and self.refresh_updated_at_field:
+            Pep.objects.filter(id__any=list(changed_peps_ids)).update(updated_at=timezone.now())
 
     def parse_date_of_birth(self, date_of_birth):
         if isinstance(date_of_birth, date) or isinstance(date_of_birth, datetime):
@@ -780,27 +916,31 @@ class PepConverterFromDB(Converter):
                     if self.refresh_updated_at_field:
                         update_fields.append('updated_at')
                     pep.save(update_fields=update_fields)
-                del self.outdated_peps_dict[code]
-        if self.outdated_peps_dict:
-            for pep in self.outdated_peps_dict.values():
-                pep.soft_delete()
+                self.peps_tracker.mark(pep.id)
+        if not self.delta:
+            Pep.bulk_soft_delete(self.peps_tracker.get_unseen_ids())
 
     def process(self):
-        peps_data, peps_links_data, pep_companies_data = self.get_data_from_source_db()
-        self.peps_total_records_from_source = len(peps_data)
-        self.peps_links_total_records_from_source = len(peps_links_data)
-        self.peps_companies_total_records_from_source = len(pep_companies_data)
-        logger.info(f'business_pep: save_or_update_peps started with {len(peps_data)} elements ...')
-        self.save_or_update_peps(peps_data)
-        logger.info(f'business_pep: save_or_update_peps finished.')
-
-        logger.info(f'business_pep: save_pep_links started with {len(peps_links_data)} elements ...')
-        self.save_or_update_peps_links(peps_links_data)
-        logger.info(f'business_pep: save_pep_links finish.')
-
-        logger.info(f'business_pep: save_pep_links started with {len(pep_companies_data)} elements ...')
-        self.save_or_update_peps_companies(pep_companies_data)
-        logger.info(f'business_pep: save_pep_links finish.')
+        state = self.load_sync_state()
+        self.delta = bool(state)
+        logger.info(f'business_pep: {"delta" if self.delta else "full"} sync')
+        new_state = {
+            'full_sync_at': state['full_sync_at'] if state else timezone.now().isoformat(),
+            'tables': {},
+        }
+        with self.get_source_db_connection() as connection:
+            self.peps_total_records_from_source = self.sync_stage(
+                connection, 'pep', self.PEP_QUERY, self.save_or_update_peps, state, new_state
+            )
+            self.peps_links_total_records_from_source = self.sync_stage(
+                connection, 'pep_links', self.PEPS_LINKS_QUERY, self.save_or_update_peps_links, state, new_state
+            )
+            self.peps_companies_total_records_from_source = self.sync_stage(
+                connection, 'pep_companies', self.PEPS_COMPANIES_QUERY, self.save_or_update_peps_companies,
+                state, new_state
+            )
+        if self.sync_state_file:
+            self.save_sync_state(new_state)
 
 
 class PepDownloader(Downloader):
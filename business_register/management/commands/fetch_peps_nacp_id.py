@@ -1,9 +1,10 @@
-import json
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
-import requests
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from business_register.converter.nacp_client import NacpClient
 from business_register.models.pep_models import Pep
 
 
@@ -105,14 +106,20 @@ class Command(BaseCommand):
 
         with connection.cursor() as cursor:
             cursor.execute(self.PEP_QUERY)
-            for pep_data in cursor.fetchall():
-                pep = self.peps_without_nacp_id.get(pep_data[0])
-                declaration_id = pep_data[1].replace('nacp_', '')
-                response = requests.get(settings.NACP_DECLARATION_RETRIEVE + declaration_id)
-                if response.status_code != 200:
+            # only declarations of PEPs without nacp_id are requested
+            peps_data = [(pep_id, declaration_id.replace('nacp_', ''))
+                         for pep_id, declaration_id in cursor.fetchall()
+                         if pep_id in self.peps_without_nacp_id]
+
+        nacp_client = NacpClient()
+        with ThreadPoolExecutor(max_workers=nacp_client.threads) as executor:
+            for (pep_id, declaration_id), declaration_data in nacp_client.fetch_all(
+                    executor, lambda pep_data: nacp_client.get_declaration(pep_data[1]), peps_data
+            ):
+                pep = self.peps_without_nacp_id.get(pep_id)
+                if not declaration_data:
                     self.stdout.write(f'cannot find the declaration with id: {declaration_id}')
                     continue
-                declaration_data = json.loads(response.text)
 
                 # storing PEP nacp_id from declarations list
                 pep_nacp_id = declaration_data['user_declarant_id']
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from business_register.converter.declaration import DeclarationConverter
+
+
+class Command(BaseCommand):
+    help = 'Saves declarations of PEPs from NACP into DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--replay', action='store_true',
+                            help='save declarations from settings.NACP_ARCHIVE_FOLDER without requests to NACP')
+
+    def handle(self, *args, **options):
+        DeclarationConverter().save_declaration(replay=options['replay'])
@@ -7,6 +7,11 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('start_index', nargs='?', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='number of worker processes, overrides settings.WORKERS_FOP_FULL')
 
     def handle(self, *args, **options):
-        FopFullConverter().process(options['start_index'])
+        converter = FopFullConverter()
+        if options['workers']:
+            converter.WORKERS = options['workers']
+        converter.process(options['start_index'])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from business_register.converter.company_converters.uk_company import UkCompanyConverter
+
+
+class Command(BaseCommand):
+    help = 'Saves companies from the BasicCompanyData CSV of Company House into DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', type=str, help='path to the unzipped CSV file')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='number of worker processes, overrides settings.WORKERS_UK_COMPANY')
+
+    def handle(self, *args, **options):
+        converter = UkCompanyConverter()
+        if options['workers']:
+            converter.WORKERS = options['workers']
+        converter.save_to_db(options['file'])
@@ -0,0 +1,33 @@
+# Generated by Django 3.1.12 on 2021-07-05 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('business_register', '0132_merge_20210630_1537'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, help_text='Hash of the source record', max_length=32, null=True, verbose_name='fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='fop',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True, verbose_name='fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='historicalcompany',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, help_text='Hash of the source record', max_length=32, null=True, verbose_name='fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='historicalfop',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True, verbose_name='fingerprint'),
+        ),
+    ]
@@ -90,6 +90,8 @@ class Company(DataOceanModel):  # constraint for not null in both name & short_n
     source = models.CharField(_('source'), max_length=5, choices=SOURCES, null=True,
                               blank=True, default=None, db_index=True, help_text='Source')
     code = models.CharField(_('our code'), max_length=510, db_index=True, help_text='Our code')
+    fingerprint = models.CharField(_('fingerprint'), max_length=32, null=True, blank=True, db_index=True,
+                                   help_text='Hash of the source record')
     history = HistoricalRecords()
 
     @property
@@ -24,6 +24,7 @@ class Fop(DataOceanModel):
     authority = models.ForeignKey(Authority, on_delete=models.CASCADE,
                                   verbose_name=_('registration authority'), null=True, blank=True)
     code = models.CharField(_('our code'), max_length=675, db_index=True)
+    fingerprint = models.CharField(_('fingerprint'), max_length=32, null=True, blank=True, db_index=True)
     history = HistoricalRecords()
 
     def __str__(self):
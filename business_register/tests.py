@@ -1,3 +1,460 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import psycopg2
+from django.test import SimpleTestCase
+from lxml import etree
+
+from business_register.converter.company_converters.uk_company import UkCompanyConverter
+from business_register.converter.company_converters.ukr_company_full import UkrCompanyFullConverter
+from business_register.converter.company_resolver import DeclarationCompanyResolver
+from business_register.converter.declaration import DeclarationConverter
+from business_register.converter.declaration_archive import DeclarationArchive
+from business_register.converter.edrpou_index import EdrpouIndex, clear_edrpou_index, get_edrpou_index
+from business_register.converter.nacp_client import NacpClient
+from business_register.converter.pep import PepConverterFromDB
+from business_register.models.company_models import Company, Founder
+from business_register.models.declaration_models import Declaration, Money, PepScoring, Property, PropertyRight
+from business_register.models.pep_models import CompanyLinkWithPep, Pep
+from data_ocean.converter import ChildrenUpdater, CopyBulkCreateManager, IdTracker, TransactionBulkCreateManager
+
+
+class EdrpouIndexTestCase(SimpleTestCase):
+    def test_get_id(self):
+        index = EdrpouIndex()
+        index.build([
+            ('00032106', 1), ('32106', 2), ('40000001', 3), (None, 4), ('', 5),
+            ('00032106', 6), ('FC031563', 7), ('12345678901234567890', 8), ('FC031563', 9),
+        ])
+        self.assertEqual(index.get_id('00032106'), 1)
+        self.assertEqual(index.get_id('32106'), 2)
+        self.assertEqual(index.get_id('40000001'), 3)
+        self.assertEqual(index.get_id('FC031563'), 7)
+        self.assertEqual(index.get_id('12345678901234567890'), 8)
+        self.assertIsNone(index.get_id('40000002'))
+        self.assertIsNone(index.get_id(''))
+        self.assertEqual(len(index.keys), 3)
+
+    def test_clear(self):
+        index = get_edrpou_index()
+        index.build([('00032106', 1)])
+        clear_edrpou_index()
+        self.assertIs(get_edrpou_index(), index)
+        with mock.patch.object(Company, 'objects') as companies:
+            companies.order_by.return_value.values_list.return_value.iterator.return_value = [('00032106', 2)]
+            # the index is built again on the next use
+            self.assertEqual(index.get_id('00032106'), 2)
+
+
+class DeclarationCompanyResolverTestCase(SimpleTestCase):
+    def test_collect_codes(self):
+        resolver = DeclarationCompanyResolver({None, '', '[Не відомо]'}, TransactionBulkCreateManager())
+        codes = set()
+        resolver.collect_codes({
+            'step_7': {'data': [{
+                'emitent_ua_company_code': '123',
+                'emitent_ua_company_code_extendedstatus': '1',
+                'persons_eng_company_code': 'HRB 1',
+                'emitent_ua_lastname': 'Шевченко',
+            }]},
+            'step_16': {'data': {'org': [{'reestrCode': '[Не відомо]'}, {'reestrCode': '40000001'}]}},
+        }, codes)
+        self.assertEqual(codes, {'123', '00000123', 'HRB 1', '40000001'})
+
+    def test_foreign_companies(self):
+        bulk_manager = TransactionBulkCreateManager()
+        resolver = DeclarationCompanyResolver(set(), bulk_manager)
+        resolver.fetched_foreign_codes = {'HRB 1', 'HRB 2'}
+        company = resolver.get_foreign_company('HRB 1', 'company')
+        # the company is created in bulk with other objects of the declaration
+        self.assertIsNone(company.pk)
+        self.assertEqual(bulk_manager.queues[Company._meta.label], [company])
+        self.assertIs(resolver.get_foreign_company('HRB 1', 'company'), company)
+        company.pk = 1
+        resolver.commit()
+        failed_company = resolver.get_foreign_company('HRB 2', 'company')
+        resolver.rollback()
+        bulk_manager.queues.clear()
+        self.assertIs(resolver.get_foreign_company('HRB 1', 'company'), company)
+        self.assertIsNot(resolver.get_foreign_company('HRB 2', 'company'), failed_company)
+
+
+class UkCompanyPartitionsTestCase(SimpleTestCase):
+    def test_read_lines(self):
+        # quoted fields with line breaks make rows of several lines
+        rows = [[f'company "{i}"', f'{i:08}', '\n'.join('x' * (i % 7))] for i in range(100)]
+        with tempfile.NamedTemporaryFile('w', newline='', encoding='utf-8', suffix='.csv', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(['CompanyName', ' CompanyNumber', 'RegAddress.CareOf'])
+            writer.writerows(rows)
+        self.addCleanup(os.remove, f.name)
+        converter = UkCompanyConverter.__new__(UkCompanyConverter)
+        converter.BLOCK_SIZE = 10
+        for parts in (1, 3, 8, 50):
+            read_rows = []
+            for start, end in converter.get_partitions(f.name, parts):
+                read_rows.extend(csv.reader(converter.read_lines(f.name, start, end)))
+            # every row is read once, by the range its first byte is in
+            self.assertEqual(read_rows, rows)
+
+
+class NacpRequestHandler(BaseHTTPRequestHandler):
+    """Stand-in for the public API of NACP, fails_left requests fail with 503"""
+    fails_left = 0
+    requests_count = 0
+    lock = threading.Lock()
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, data=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.lock:
+            NacpRequestHandler.requests_count += 1
+            if NacpRequestHandler.fails_left:
+                NacpRequestHandler.fails_left -= 1
+                self.respond(503)
+                return
+        declarant_id = re.search(r'/list/\?user_declarant_id=(\d+)$', self.path)
+        if declarant_id:
+            declarant_id = int(declarant_id.group(1))
+            self.respond(200, {'data': [{'id': f'{declarant_id}-{i}', 'user_declarant_id': declarant_id}
+                                        for i in range(2)]})
+        elif self.path.startswith('/documents/missing'):
+            self.respond(404, {'error': 'not found'})
+        else:
+            declaration_id = self.path.rsplit('/', 1)[-1]
+            self.respond(200, {'id': declaration_id, 'user_declarant_id': int(declaration_id.split('-')[0])})
+
+
+class NacpClientTestCase(SimpleTestCase):
+    def setUp(self):
+        NacpRequestHandler.fails_left = 0
+        NacpRequestHandler.requests_count = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), NacpRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_port}/documents/'
+        self.client = NacpClient(list_url=url + 'list/', retrieve_url=url, threads=4, requests_per_second=100,
+                                 attempts=3, retry_delay=0, timeout=5)
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_all(self):
+        NacpRequestHandler.fails_left = 2
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.client.threads) as executor:
+            results = list(self.client.fetch_all(executor, self.client.get_declarations_list, range(1, 21)))
+        self.assertEqual([declarant_id for declarant_id, _ in results], list(range(1, 21)))
+        self.assertEqual([declaration['id'] for declaration in results[4][1]], ['5-0', '5-1'])
+        self.assertEqual(self.client.get_declaration('7-1')['user_declarant_id'], 7)
+        self.assertIsNone(self.client.get_declaration('missing'))
+        # 20 lists, 2 retries and 2 declarations are spaced by 10 ms at least
+        self.assertEqual(NacpRequestHandler.requests_count, 24)
+        self.assertGreaterEqual(time.monotonic() - started, 0.23)
+
+    def test_archive(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.client.archive = DeclarationArchive(folder)
+        self.assertEqual(self.client.get_declaration('7-1')['user_declarant_id'], 7)
+        self.assertEqual(self.client.get_declaration('7-1')['id'], '7-1')
+        self.client.archive.put('7-0', {'id': '7-0', 'user_declarant_id': 7})
+        self.client.archive.put('8-0', {'id': '8-0', 'user_declarant_id': 8})
+        # the same content is stored once
+        self.client.archive.put('7-0', {'user_declarant_id': 7, 'id': '7-0'})
+        self.assertEqual(NacpRequestHandler.requests_count, 1)
+        archive = DeclarationArchive(folder)
+        self.assertEqual([declaration['id'] for declaration in archive.get_declarant_declarations(7)],
+                         ['7-1', '7-0'])
+        self.assertIsNone(archive.get('9-0'))
+        with open(archive.index_path) as index_file:
+            self.assertEqual(len(index_file.readlines()), 4)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(folder)), 4)
+
+
+class DeclarationBankAccountTestCase(SimpleTestCase):
+    def test_save_bank_account(self):
+        converter = DeclarationConverter.__new__(DeclarationConverter)
+        converter.NO_DATA = {None, ''}
+        converter.DECLARANT = '1'
+        converter.companies = mock.Mock(**{'get_ukrainian_company.return_value': None})
+        converter.bulk_manager = TransactionBulkCreateManager()
+        pep = Pep(id=1)
+        declaration = Declaration(id=2, pep=pep)
+        # the account of step 12 is queued, not saved
+        converter.bulk_manager.add(Money(type=Money.BANK_ACCOUNT, bank_registration_number='00032106',
+                                         owner=pep, declaration=declaration))
+        accounts = [{'establishment_ua_company_code': code, 'person_who_care': [{'person': '1'}]}
+                    for code in ('00032106', '40000001')]
+        with mock.patch.object(Money, 'objects') as money_objects:
+            money_objects.filter.return_value.values_list.return_value = []
+            converter.save_bank_account(accounts, declaration, pep)
+        queued_money = converter.bulk_manager.queues[Money._meta.label]
+        self.assertEqual([money.bank_registration_number for money in queued_money], ['00032106', '40000001'])
+
+
+class SourceCursor:
+    """Stand-in for a named psycopg2 cursor"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetch_sizes = []
+        self.params = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.params = params
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class PepSourceStreamTestCase(SimpleTestCase):
+    def test_run_stage(self):
+        cursor = SourceCursor([(i, f'pep {i}') for i in range(7)])
+        connection = type('SourceConnection', (), {'cursor': lambda self, name=None: cursor})()
+        converter = PepConverterFromDB.__new__(PepConverterFromDB)
+        converter.itersize = 3
+        saved_rows = []
+        self.assertEqual(converter.run_stage(connection, 'pep', 'SELECT', saved_rows.extend), 7)
+        self.assertEqual(saved_rows, [(i, f'pep {i}') for i in range(7)])
+        self.assertEqual(cursor.fetch_sizes, [3, 3, 3, 3])
+
+    def test_run_stage_connection_lost(self):
+        cursor = SourceCursor([(i, f'pep {i}') for i in range(7)])
+        fetchmany = cursor.fetchmany
+
+        def fetchmany_until_tunnel_drops(size):
+            if len(cursor.fetch_sizes) == 2:
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+            return fetchmany(size)
+
+        cursor.fetchmany = fetchmany_until_tunnel_drops
+        connection = type('SourceConnection', (), {'cursor': lambda self, name=None: cursor})()
+        converter = PepConverterFromDB.__new__(PepConverterFromDB)
+        converter.itersize = 3
+        saved_rows = []
+        with self.assertRaises(psycopg2.OperationalError), self.assertLogs('business_register.converter.pep') as logs:
+            converter.run_stage(connection, 'pep', 'SELECT', saved_rows.extend)
+        self.assertEqual(saved_rows, [(i, f'pep {i}') for i in range(6)])
+        self.assertIn('pep: connection to the source lost after 6 rows', logs.output[-1])
+
+    def test_sync_stage(self):
+        checksums_cursor = SourceCursor([(0, 1000, 'a'), (1, 998, 'b2'), (2, 10, 'c')])
+        rows_cursor = SourceCursor([(1001, 'pep 1001'), (2001, 'pep 2001')])
+        connection = type('SourceConnection', (), {
+            'cursor': lambda self, name=None: rows_cursor if name else checksums_cursor
+        })()
+        converter = PepConverterFromDB.__new__(PepConverterFromDB)
+        converter.itersize = 100
+        converter.sync_state_file = 'pep_sync.json'
+        converter.sync_batch_size = 1000
+        converter.CHECKSUMS_QUERY = converter.DELTA_QUERY = '{query}'
+        state = {'tables': {'pep': {'0': 'a', '1': 'b1'}}}
+        new_state = {'tables': {}}
+        saved_rows = []
+        self.assertEqual(
+            converter.sync_stage(connection, 'pep', 'SELECT', saved_rows.extend, state, new_state), 2008
+        )
+        # only the changed and the new batches are got from the source
+        self.assertEqual(rows_cursor.params, [1000, [1, 2]])
+        self.assertEqual(saved_rows, [(1001, 'pep 1001'), (2001, 'pep 2001')])
+        self.assertEqual(new_state['tables']['pep'], {'0': 'a', '1': 'b2', '2': 'c'})
+
+
+class PepCompaniesBatchTestCase(SimpleTestCase):
+    def test_save_peps_companies_batch(self):
+        converter = PepConverterFromDB.__new__(PepConverterFromDB)
+        converter.peps_dict = {'1': Pep(id=7)}
+        converter.peps_companies_dict = {}
+        converter.peps_companies_tracker = IdTracker()
+        converter.bulk_manager = TransactionBulkCreateManager()
+        converter.invalid_data_counter = 0
+        stored_company = Company(id=5, antac_id=10, name_en='stored company')
+        batch = [
+            # the link to the stored company is queued before the new company
+            (1, 10, None, None, None, 'owner', '', False, '', 'компанія', None, 100, 'stored company', 'засновник',
+             'founder'),
+            (1, 11, None, None, None, 'owner', '', False, '', 'нова компанія', None, 101, 'new company', 'засновник',
+             'founder'),
+        ]
+        created = []
+
+        def bulk_create(objs, batch_size=None):
+            for i, obj in enumerate(objs):
+                obj.id = 200 + i
+                created.append((type(obj), obj.id, getattr(obj, 'company_id', None)))
+            return objs
+
+        with mock.patch.object(converter, 'get_stored_companies', return_value=({10: stored_company}, {})), \
+                mock.patch.object(Company, 'objects') as companies, \
+                mock.patch.object(Company, 'history') as companies_history, \
+                mock.patch.object(CompanyLinkWithPep, 'objects') as links, \
+                mock.patch.object(Pep, 'objects') as peps, \
+                mock.patch('business_register.converter.pep.transaction'), \
+                mock.patch('simple_history.utils.transaction'), \
+                mock.patch('data_ocean.converter.transaction'):
+            companies.bulk_create.side_effect = links.bulk_create.side_effect = bulk_create
+            converter.save_or_update_peps_companies_batch(batch, address_converter=None)
+        self.assertEqual(created, [
+            (Company, 200, None), (CompanyLinkWithPep, 200, 5), (CompanyLinkWithPep, 201, 200),
+        ])
+        self.assertEqual(converter.peps_companies_dict[101].company_id, 200)
+        self.assertEqual([company.id for company in companies_history.bulk_history_create.call_args[0][0]], [200])
+        peps.filter.assert_called_once_with(id__any=[7])
+
+
+class UkrCompanyFingerprintTestCase(SimpleTestCase):
+    def test_save_to_db(self):
+        converter = UkrCompanyFullConverter.__new__(UkrCompanyFullConverter)
+        converter.STAGING_MERGE = False
+        converter.source = Company.UKRAINE_REGISTER
+        converter.bulk_manager = CopyBulkCreateManager()
+        converter.companies_tracker = IdTracker([1, 2])
+        converter.skipped_records_counter = 0
+        unchanged_record = etree.fromstring('<SUBJECT><EDRPOU>1</EDRPOU></SUBJECT>')
+        changed_record = etree.fromstring('<SUBJECT><EDRPOU>2</EDRPOU></SUBJECT>')
+        company_data = {
+            'code': '2', 'name': 'компанія', 'short_name': None, 'authorized_capital': None, 'address': None,
+            'registration_info': None, 'contact_info': None, 'company_type': None, 'country': None,
+            'status': None, 'bylaw': None, 'authority': None, 'registration_date': None,
+        }
+        # only the source record of the stored company has changed
+        stored_company = Company(id=2, code='2', fingerprint='old', **{
+            field_name: value for field_name, value in company_data.items() if field_name != 'code'
+        })
+        with mock.patch.object(Company, 'objects') as companies, \
+                mock.patch.object(converter, 'get_companies_data',
+                                  return_value=[(dict(company_data), {}, 'new')]) as get_companies_data, \
+                mock.patch.object(converter, 'get_stored_objects', return_value={'2': stored_company}), \
+                mock.patch.object(converter, 'prefetch_children'), \
+                mock.patch.object(converter, 'update_company_children'), \
+                mock.patch.object(converter, 'save_children'), \
+                mock.patch.object(stored_company, 'save') as save:
+            companies.filter.return_value.values_list.return_value = [
+                (converter.get_fingerprint(unchanged_record), 1)
+            ]
+            converter.save_to_db([unchanged_record, changed_record])
+        self.assertEqual(converter.skipped_records_counter, 1)
+        self.assertEqual([record for record, _ in get_companies_data.call_args[0][0]], [changed_record])
+        save.assert_called_once_with(update_fields=['fingerprint'])
+        self.assertEqual(stored_company.fingerprint, 'new')
+        self.assertEqual(converter.companies_tracker.get_unseen_ids(), [])
+
+
+class ChildrenUpdaterTestCase(SimpleTestCase):
+    def test_two_versions_of_company_in_chunk(self):
+        bulk_manager = CopyBulkCreateManager()
+        updater = ChildrenUpdater(Founder, 'company', ('name',), ('equity',), bulk_manager)
+        company = Company(id=1)
+        stored_founders = [
+            Founder(id=10, company_id=1, name='a', equity=1),
+            Founder(id=11, company_id=1, name='b', equity=1, deleted_at='2020-01-01'),
+        ]
+        with mock.patch.object(Founder, 'include_deleted_objects') as founders:
+            founders.filter.return_value.order_by.return_value = stored_founders
+            updater.prefetch([1])
+        updater.update(company, [Founder(name='a', equity=2), Founder(name='c')])
+        # the second version is compared with the children left by the first one
+        updater.update(company, [Founder(name='b', equity=1), Founder(name='d')])
+        self.assertEqual([founder.name for founder in bulk_manager.queues[Founder._meta.label]], ['d'])
+        self.assertEqual(updater.outdated_children_ids, {10})
+        self.assertEqual(set(updater.changed_children), {10, 11})
+        self.assertIsNone(stored_founders[1].deleted_at)
+        with mock.patch.object(Founder, 'include_deleted_objects') as founders, \
+                mock.patch.object(Founder, 'bulk_soft_delete') as bulk_soft_delete, \
+                mock.patch.object(updater, 'history_manager') as history_manager:
+            updater.commit()
+        self.assertEqual(founders.bulk_update.call_args[0][0], stored_founders)
+        history_manager.bulk_history_create.assert_called_once_with(stored_founders, update=True)
+        bulk_soft_delete.assert_called_once_with([10])
+
+
+class CompanyCopyWithHistoryTestCase(SimpleTestCase):
+    def test_commit_with_history(self):
+        bulk_manager = CopyBulkCreateManager()
+        committed = []
+
+        def commit(model_class):
+            for i, obj in enumerate(bulk_manager.queues[model_class._meta.label]):
+                obj.pk = 100 + i
+                committed.append(obj)
+
+        bulk_manager.add(Company(name='company', edrpou='00000001', source=Company.GREAT_BRITAIN_REGISTER))
+        with mock.patch.object(bulk_manager, 'commit', side_effect=commit):
+            bulk_manager.commit_with_history(Company)
+        company, history = committed
+        self.assertIsInstance(history, Company.history.model)
+        self.assertEqual((history.id, history.edrpou, history.history_type), (100, '00000001', '+'))
+        self.assertEqual(bulk_manager.queues[Company.history.model._meta.label], [])
+
+
+class DeclarationReplayTestCase(SimpleTestCase):
+    def test_stored_declaration_is_rewritten(self):
+        converter = DeclarationConverter.__new__(DeclarationConverter)
+        converter.bulk_manager = TransactionBulkCreateManager()
+        converter.companies = DeclarationCompanyResolver(set(), converter.bulk_manager)
+        pep = Pep(id=1)
+        stored_declaration = Declaration(id=5, nacp_declaration_id='abc', pep=pep, year=2019)
+        converter.all_declarations = {'abc': stored_declaration}
+        declaration_data = {'id': 'abc', 'declaration_type': 1, 'declaration_year': 2020,
+                            'date': '2021-03-30T10:00:00', 'data': {}}
+        converter.nacp_client = mock.Mock(**{
+            'archive.get_declarant_declarations.return_value': [declaration_data, {'declaration_type': 5}]
+        })
+        # the stored declaration is replayed, the one of the not supported type is not
+        self.assertEqual(converter.get_archived_pep_declarations(7), [(declaration_data, declaration_data)])
+        with ExitStack() as stack:
+            # objects of all steps and their rights
+            managers = {
+                model: stack.enter_context(mock.patch.object(model, 'include_deleted_objects'))
+                for relation in Declaration._meta.related_objects
+                for model in [relation.related_model] + [
+                    right_relation.related_model for right_relation in relation.related_model._meta.related_objects
+                ]
+            }
+            declarations = stack.enter_context(mock.patch.object(Declaration, 'objects'))
+            stack.enter_context(mock.patch.object(stored_declaration, 'save'))
+            save_declaration_steps = stack.enter_context(mock.patch.object(converter, 'save_declaration_steps'))
+            stack.enter_context(mock.patch('business_register.converter.declaration.transaction'))
+            stack.enter_context(mock.patch('data_ocean.converter.transaction'))
+            converter.save_declaration_objects(declaration_data, declaration_data, 7, pep)
+        property_rights, properties, scorings = managers[PropertyRight], managers[Property], managers[PepScoring]
+        declarations.create.assert_not_called()
+        save_declaration_steps.assert_called_once_with({}, pep, stored_declaration)
+        self.assertEqual(stored_declaration.year, 2020)
+        property_rights.filter.assert_called_once_with(property__declaration=stored_declaration)
+        property_rights.filter.return_value.delete.assert_called_once_with()
+        properties.filter.assert_called_once_with(declaration=stored_declaration)
+        scorings.filter.assert_not_called()
@@ -99,15 +99,27 @@ LOCATION_KOATUU_SOURCE_REGISTER_ID = "dc081fb0-f504-4696-916c-a5b24312ab6e"
 LOCATION_KOATUU_SOURCE_PACKAGE = DATA_GOV_UA_SOURCE_PACKAGE + LOCATION_KOATUU_SOURCE_REGISTER_ID
 LOCATION_KOATUU_LOCAL_FILE_NAME = 'koatuu.json'
 LOCAL_FILE_NAME_KOATUU = ''
+# number of KOATUU places created or updated with one statement
+BATCH_SIZE_KOATUU = 5000
 
 LOCATION_RATU_SOURCE_REGISTER_ID = "a2d6c060-e7e6-4471-ac67-42cfa1742a19"
 LOCATION_RATU_SOURCE_PACKAGE = DATA_GOV_UA_SOURCE_PACKAGE + LOCATION_RATU_SOURCE_REGISTER_ID
 LOCAL_FILE_NAME_RATU = '28-ex_xml_atu.xml'
+# parse the XML right from the downloaded archive instead of unzipping it, off for RATU, because the stream
+# decodes the file as cp1251 and cleans it like remove_unreadable_characters, that RATU was never run through
+STREAM_FROM_ZIP_RATU = False
 CHUNK_SIZE_RATU = 100
+# number of RATU places created or updated with one statement
+BATCH_SIZE_RATU = 5000
 
 LOCATION_DRV_WSDL_URL = 'https://www.drv.gov.ua/ords/svc/personal/API/Opendata'
 LOCATION_DRV_STRICT = False
 LOCATION_DRV_XML_HUGE_TREE = True
+# number of threads requesting ATOs and streets of DRV concurrently
+LOCATION_DRV_THREADS = 4
+# attempts of a request to DRV and the delay in seconds before the first retry, doubled for every next one
+LOCATION_DRV_ATTEMPTS = 5
+LOCATION_DRV_RETRY_DELAY = 5
 
 BUSINESS_KVED_SOURCE_REGISTER_ID = "e1afb81c-70e4-4009-96a0-b240c36e4603"
 BUSINESS_KVED_SOURCE_PACKAGE = DATA_GOV_UA_SOURCE_PACKAGE + BUSINESS_KVED_SOURCE_REGISTER_ID
@@ -120,6 +132,12 @@ LOCAL_FILE_NAME_FOP = ''
 CHUNK_SIZE_FOP = 100
 LOCAL_FILE_NAME_FOP_FULL = ''
 CHUNK_SIZE_FOP_FULL = 100
+# number of worker processes for saving records, 1 means serial mode
+WORKERS_FOP_FULL = 1
+# number of byte ranges of the source archive downloaded concurrently
+DOWNLOAD_SEGMENTS_FOP_FULL = 1
+# parse the XML right from the downloaded archive instead of unzipping and cleaning it beforehand
+STREAM_FROM_ZIP_FOP_FULL = True
 
 BUSINESS_UKR_COMPANY_SOURCE_REGISTER_ID = '1c7f3815-3259-45e0-bdf1-64dca07ddc10'
 BUSINESS_UKR_COMPANY_SOURCE_PACKAGE = DATA_GOV_UA_SOURCE_PACKAGE + BUSINESS_UKR_COMPANY_SOURCE_REGISTER_ID
@@ -127,6 +145,14 @@ LOCAL_FILE_NAME_UO = ''
 CHUNK_SIZE_UO = 100
 LOCAL_FILE_NAME_UO_FULL = ''
 CHUNK_SIZE_UO_FULL = 100
+# number of worker processes for saving records, 1 means serial mode
+WORKERS_UO_FULL = 1
+# number of byte ranges of the source archive downloaded concurrently
+DOWNLOAD_SEGMENTS_UO_FULL = 1
+# parse the XML right from the downloaded archive instead of unzipping and cleaning it beforehand
+STREAM_FROM_ZIP_UO_FULL = True
+# save companies with set-based statements through the staging table instead of one by one
+STAGING_MERGE_UO_FULL = False
 
 LOCAL_FILE_NAME_UO_ADDRESS = ''
 LOCAL_FILE_NAME_UO_SIGNER = ''
@@ -140,10 +166,24 @@ LOCAL_FILE_NAME_UO_INFO = ''
 BUSINESS_UK_COMPANY_SOURCE = 'https://download.companieshouse.gov.uk/'
 BUSINESS_UK_COMPANY_SOURCE_PAGE = BUSINESS_UK_COMPANY_SOURCE + 'en_output.html'
 BUSINESS_UK_COMPANY_SOURCE_XPATH = '//*[@id="mainContent"]/div[2]/ul[1]/li/a/@href'
+CHUNK_SIZE_UK_COMPANY = 10000
+# number of worker processes saving byte ranges of the CSV, 1 means serial mode
+WORKERS_UK_COMPANY = 1
 
 BUSINESS_PEP_AUTH_USER = ''
 BUSINESS_PEP_AUTH_PASSWORD = ''
 BUSINESS_PEP_SOURCE_URL = 'https://pep.org.ua/opendata/persons/json'
+# number of threads requesting declarations from NACP API concurrently
+NACP_THREADS = 4
+# maximum number of requests to NACP API per second for all threads, 0 means no limit
+NACP_REQUESTS_PER_SECOND = 10
+# attempts of a request to NACP API and the delay in seconds before the first retry, doubled for every next one
+NACP_ATTEMPTS = 5
+NACP_RETRY_DELAY = 2
+# timeout of a request to NACP API in seconds
+NACP_TIMEOUT = 60
+# folder to keep raw declarations of NACP in for saving them again without downloading, empty means no archive
+NACP_ARCHIVE_FOLDER = ''
 
 # AWS S3 configuration and credentials
 AWS_S3_ACCESS_KEY_ID = ''
@@ -157,6 +197,8 @@ PEP_SOURCE_USE_SSH = False
 # ssh params
 PEP_TUNNEL_TIMEOUT = 5.0
 PEP_SSH_TIMEOUT = 5.0
+# seconds between keepalive packets of the SSH tunnel, 0.0 to disable
+PEP_SSH_KEEPALIVE = 30.0
 PEP_SSH_SERVER_IP = ''
 PEP_SSH_SERVER_PORT = 22
 PEP_SSH_USERNAME = ''
@@ -167,6 +209,19 @@ PEP_SOURCE_PORT = 5432
 PEP_SOURCE_DATABASE = ''
 PEP_SOURCE_USER = ''
 PEP_SOURCE_PASSWORD = ''
+# TCP keepalives of the PEP source connection: seconds of idle before the first probe, seconds between probes
+# and the number of lost probes before the connection is considered dead
+PEP_SOURCE_KEEPALIVES_IDLE = 60
+PEP_SOURCE_KEEPALIVES_INTERVAL = 10
+PEP_SOURCE_KEEPALIVES_COUNT = 6
+# number of rows got from the source DB with one fetch of the server-side cursor
+PEP_SOURCE_ITERSIZE = 2000
+# file with checksums of batches of PEP source rows for the delta sync, empty for the full sync on every run
+PEP_SYNC_STATE_FILE = ''
+# number of source ids in one checksum batch of the delta sync
+PEP_SYNC_BATCH_SIZE = 1000
+# days between full syncs of PEP data, only they delete records removed from the source
+PEP_FULL_SYNC_DAYS = 7
 # PEP_LOCAL_SOURCE_HOST = '0.0.0.0'
 # PEP_LOCAL_SOURCE_PORT = 8080
 
@@ -5,4 +5,4 @@ class DataOceanConfig(AppConfig):
     name = 'data_ocean'
 
     def ready(self):
-        from data_ocean import handlers
+        from data_ocean import handlers, lookups
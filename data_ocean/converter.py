@@ -1,36 +1,204 @@
 import codecs
+import datetime
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
+import queue
+import re
 import traceback
 import zipfile
-from collections import defaultdict
+import zlib
+from collections import defaultdict, deque
 
 import requests
 import xmltodict
 from django.apps import apps
+from django.db import connection, connections, router, transaction
+from django.utils import timezone
 from lxml import etree
+from simple_history.exceptions import NotHistoricalModelError
+from simple_history.utils import get_history_manager_for_model
 
+from data_ocean.dimension_cache import clear_dimension_caches, get_dimension_cache
 from data_ocean.utils import Timer
 from location_register.models.address_models import Country
 
 logger = logging.getLogger(__name__)
 
+# replacements of characters that break parsing or are not needed in the data of EDR source files
+UNREADABLE_CHARACTERS = (
+    ('&quot;', '"'),
+    ('&#3;', ''),
+    ('&#14;', ''),
+    ('&#16;', ''),
+    ('&#24;', ''),
+    ('&#30;', ''),
+    ('&#31;', ''),
+)
+
+
+class CleanXmlStream:
+    """
+    Binary file-like object for etree.iterparse, that reads an XML member of a zip archive and
+    re-encodes it to UTF-8 removing UNREADABLE_CHARACTERS on the fly, so the archive is neither
+    unzipped nor rewritten to a temp file. iterparse reads the member to the end, so zipfile checks
+    its CRC-32 in the same pass and raises BadZipFile if it is wrong.
+    """
+    XML_DECLARATION_ENCODING = re.compile(r'^(\s*<\?xml[^>]*?encoding=)(["\'])[^"\']*\2')
+    # the tail of the text is kept until the next read, so replacements split between reads are found
+    KEPT_TAIL_LENGTH = max(len(old) for old, _ in UNREADABLE_CHARACTERS) - 1
+
+    def __init__(self, zip_file_path, member_name, encoding='cp1251', read_size=1024 * 1024):
+        self.zip_file = zipfile.ZipFile(zip_file_path)
+        self.member = self.zip_file.open(member_name)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.read_size = read_size
+        self.tail = ''
+        self.buffer = b''
+        self.position = 0
+        self.is_start = True
+        self.eof = False
+
+    def read_text(self):
+        data = self.member.read(self.read_size)
+        text = self.tail + self.decoder.decode(data, final=not data)
+        if self.is_start:
+            if data and '?>' not in text and len(text) < 1024:
+                # the XML declaration is not read completely yet
+                self.tail = text
+                return b''
+            text = self.XML_DECLARATION_ENCODING.sub(r'\1\2UTF-8\2', text, count=1)
+            self.is_start = False
+        for old, new in UNREADABLE_CHARACTERS:
+            text = text.replace(old, new)
+        if data:
+            self.tail = text[-self.KEPT_TAIL_LENGTH:]
+            text = text[:-self.KEPT_TAIL_LENGTH]
+        else:
+            self.tail = ''
+            self.eof = True
+        return text.encode('utf-8')
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.position < size):
+            self.buffer = self.buffer[self.position:] + self.read_text()
+            self.position = 0
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.member.close()
+        self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordOffsetReader:
+    """
+    Binary file-like wrapper of the source for etree.iterparse, that finds byte offsets of the ends
+    of records while the parser reads them. It can start right after a record ending at start_offset,
+    then the part of the source before the first record (the XML declaration and the root tag)
+    is given to the parser first, so the rest of the source is parsed as a whole document.
+    """
+
+    def __init__(self, source, tag, start_offset=0, read_size=64 * 1024):
+        self.source = source
+        self.start_tag = f'<{tag}'.encode()
+        self.end_tag = f'</{tag}>'.encode()
+        self.read_size = read_size
+        self.offset = start_offset  # the offset in the source of the next byte to scan
+        self.scanned_tail = b''
+        self.record_end_offsets = deque()
+        self.header = b''
+        self.rest = b''
+        if start_offset:
+            self.skip_to(start_offset)
+
+    def find_first_record(self, data):
+        index = data.find(self.start_tag)
+        while index >= 0 and data[index + len(self.start_tag):index + len(self.start_tag) + 1] not in b'> \t\r\n/':
+            index = data.find(self.start_tag, index + 1)
+        return index
+
+    def skip_to(self, offset):
+        data = b''
+        index = -1
+        while index < 0 or index + len(self.start_tag) >= len(data):
+            block = self.source.read(self.read_size)
+            if not block:
+                raise ValueError(f'No <{self.start_tag[1:].decode()}> records in the source')
+            data += block
+            index = self.find_first_record(data)
+        self.header = data[:index]
+        if offset < len(data):
+            self.rest = data[offset:]
+        elif getattr(self.source, 'seekable', lambda: False)():
+            self.source.seek(offset)
+        else:
+            to_skip = offset - len(data)
+            while to_skip:
+                skipped = len(self.source.read(min(to_skip, self.read_size)))
+                if not skipped:
+                    raise ValueError(f'The source is shorter than {offset} bytes')
+                to_skip -= skipped
+
+    def scan(self, data):
+        text = self.scanned_tail + data
+        text_offset = self.offset - len(self.scanned_tail)
+        start = 0
+        index = text.find(self.end_tag)
+        while index >= 0:
+            start = index + len(self.end_tag)
+            self.record_end_offsets.append(text_offset + start)
+            index = text.find(self.end_tag, start)
+        self.scanned_tail = text[max(start, len(text) - len(self.end_tag) + 1):]
+        self.offset += len(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.read_size
+        if self.header:
+            data, self.header = self.header[:size], self.header[size:]
+            return data
+        if self.rest:
+            data, self.rest = self.rest[:size], self.rest[size:]
+        else:
+            data = self.source.read(size)
+        self.scan(data)
+        return data
+
 
 class Converter:
     UPDATE_FILE_NAME = "update.cfg"
     API_ADDRESS_FOR_DATASET = ""  # specified api address with dataset id
     LOCAL_FILE_NAME = None  # static short local filename
     LOCAL_FOLDER = "source_data/"  # local folder for unzipped source files
+    # archive in LOCAL_FOLDER to stream LOCAL_FILE_NAME from without unzipping, None means LOCAL_FILE_NAME is unzipped
+    SOURCE_ZIP_FILE_NAME = None
+    SOURCE_ENCODING = 'cp1251'  # encoding of LOCAL_FILE_NAME in the archive
     DOWNLOAD_FOLDER = "download/"  # folder to downloaded files
     URLS_DICT = {}  # control remote dataset files update
+    WORKERS = 1  # number of worker processes for saving records, 1 means serial mode
+    PARTITION_TAG = None  # tag with a stable key for spreading records between workers
     timing = False
     timer = None
+    report = None  # Report of the update to store checkpoints of process in
 
     def __init__(self):
-        self.all_countries_dict = self.put_objects_to_dict("name", "location_register", "Country")
+        self.countries = get_dimension_cache(Country, defaults={'name_uk': ''})
         if self.timing:
             self.timer = Timer()
+            connection.execute_wrappers.append(self.timer.count_query)
 
     def time_it(self, code_block_name):
         if self.timing:
@@ -41,12 +209,7 @@ class Converter:
             self.timer.print_result()
 
     def save_or_get_country(self, name):
-        name = name.lower()
-        if name not in self.all_countries_dict:
-            new_country = Country.objects.create(name=name)
-            self.all_countries_dict[name] = new_country
-            return new_country
-        return self.all_countries_dict[name]
+        return self.countries.get(name.lower())
 
     def load_json(self, json_file):
         with open(json_file) as file:
@@ -205,66 +368,303 @@ class Converter:
     def delete_outdated(self):
         """ delete some outdated records """
 
-    def process(self, start_index=0):
+    @staticmethod
+    def get_fingerprint(record):
+        """Returns the hash of the canonical XML of the record, the same data always gives the same hash"""
+        return hashlib.md5(etree.tostring(record, method='c14n', with_tail=False)).hexdigest()
+
+    def open_source(self):
+        """Returns a context manager with the source for etree.iterparse"""
+        if self.SOURCE_ZIP_FILE_NAME:
+            return CleanXmlStream(self.LOCAL_FOLDER + self.SOURCE_ZIP_FILE_NAME, self.LOCAL_FILE_NAME,
+                                  self.SOURCE_ENCODING)
+        return open(self.LOCAL_FOLDER + self.LOCAL_FILE_NAME, 'rb')
+
+    def clear_parsed_element(self, elem):
+        # http://lxml.de/parsing.html#modifying-the-tree
+        # Based on Liza Daly fast_iter
+        # http://www.ibm.com/developerworks/xml/library/x-hiperfparse/
+        # See also http://effbot.org/zone/element-iterparse.htm
+        #
+        # It safe to call clear() here because no descendants will be accessed
+        elem.clear()
+        # # Also eliminate now-empty references from the root node to elem
+        for ancestor in elem.xpath('ancestor-or-self::*'):
+            while ancestor.getprevious() is not None:
+                del ancestor.getparent()[0]
+
+    def save_checkpoint(self, index, offset):
+        """Stores the number of saved records and the byte offset of the end of the last one in the report"""
+        if not self.report:
+            return
+        self.report.checkpoint_index = index
+        self.report.checkpoint_offset = offset
+        self.report.save(update_fields=['checkpoint_index', 'checkpoint_offset', 'updated_at'])
+
+    def clear_caches(self):
+        """Process-wide caches are cleared when a run starts, so a run never sees data of the previous one"""
+        clear_dimension_caches()
+
+    def mark_seen(self, records):
+        """
+        Marks stored objects of the records as up to date without saving them, a resumed pass marks
+        records saved before the checkpoint with it, so delete_outdated can run after the pass
+        """
+        raise NotImplementedError
+
+    def mark_records_before_checkpoint(self, records_count):
+        """
+        Parses the first records_count records of the source again and marks them with mark_seen,
+        returns False if the converter can not mark records
+        """
+        with self.open_source() as source:
+            elements = etree.iterparse(
+                source=source,
+                tag=self.RECORD_TAG,
+                recover=False,
+            )
+            records = []
+            i = 0
+            try:
+                for _, elem in elements:
+                    if i >= records_count:
+                        break
+                    records.append(elem)
+                    i += 1
+                    if len(records) >= self.CHUNK_SIZE:
+                        self.mark_seen(records)
+                        records.clear()
+                        self.clear_parsed_element(elem)
+                if records:
+                    self.mark_seen(records)
+            except NotImplementedError:
+                logger.warning(f'{self.__class__.__name__}: records before the checkpoint can not be marked, '
+                               f'delete_outdated is skipped')
+                return False
+            del elements
+        return True
+
+    def process(self, start_index=0, resume=False):
+        """
+        Saves records of the source file chunk by chunk, records before start_index are parsed but not saved.
+        With resume, parsing continues right after the last chunk saved according to the checkpoint
+        of the report. delete_outdated needs all the records of the file, so it runs only for a full pass
+        or for a resumed one after records before the checkpoint are marked with mark_seen.
+        """
+        self.clear_caches()
+        if self.WORKERS > 1:
+            if resume and self.report and self.report.checkpoint_index:
+                raise ValueError('Resume from a checkpoint is not supported in parallel mode')
+            return self.process_in_parallel(self.WORKERS, start_index)
+        i = start_offset = 0
+        if resume and self.report and self.report.checkpoint_index:
+            i, start_offset = self.report.checkpoint_index, self.report.checkpoint_offset
+            logger.info(f'{self.__class__.__name__}: resume from record {i} at byte {start_offset}')
+        resumed_index = i
         records = []
-        elements = etree.iterparse(
-            source=self.LOCAL_FOLDER + self.LOCAL_FILE_NAME,
-            tag=self.RECORD_TAG,
-            recover=False,
-        )
+        with self.open_source() as source:
+            reader = RecordOffsetReader(source, self.RECORD_TAG, start_offset)
+            elements = etree.iterparse(
+                source=reader,
+                tag=self.RECORD_TAG,
+                recover=False,
+            )
+            chunk_start_index = i
+            for _, elem in elements:
+                record_end_offset = reader.record_end_offsets.popleft()
+                if not records:
+                    chunk_start_index = i
+                records.append(elem)
+                i += 1
+                if len(records) >= self.CHUNK_SIZE:
+                    try:
+                        if i > start_index:
+                            self.time_it('preparing chunk of records')
+                            self.save_to_db(records)
+                            self.save_checkpoint(i, record_end_offset)
+                        self.print_running_times()
+                        print(i - 1)
+                    except Exception as e:
+                        msg = f'!!! Save to db failed at index = {chunk_start_index}. Error: {str(e)}'
+                        logger.error(msg)
+                        traceback.print_exc()
+                        print(msg)
+                        return False
+                    records.clear()
+                    self.clear_parsed_element(elem)
+                    print('>>> Saved successfully')
+            if records:
+                self.save_to_db(records)
+                self.save_checkpoint(i, record_end_offset)
+            del elements
+        if start_index == 0 and (not start_offset or self.mark_records_before_checkpoint(resumed_index)):
+            self.delete_outdated()
+        print('All the records have been rewritten.')
+        return True
 
-        # for _ in range(start_index):
-        #     next(elements)
+    def get_partition_key(self, record):
+        """
+        returns a stable key of the record, so all versions of the same subject
+        are always saved by the same worker
+        """
+        if not self.PARTITION_TAG:
+            return ''
+        key_info = record.xpath(self.PARTITION_TAG)
+        if not key_info or not key_info[0].text:
+            return ''
+        return key_info[0].text
 
-        # i = start_index
-        i = 0
-        chunk_start_index = i
-        for _, elem in elements:
-            records_len = len(records)
+    def get_worker_index(self, record, workers):
+        return zlib.crc32(self.get_partition_key(record).encode()) % workers
 
-            if records_len == 0:
-                chunk_start_index = i
+    def get_worker_state(self):
+        """
+        returns picklable data collected by a worker, that the parent process
+        needs after all the records are saved (e.g. for delete_outdated)
+        """
+        return None
 
-            # for text in elem.iter():
-            #     print('\t%28s\t%s' % (text.tag, text.text))
+    def merge_worker_state(self, state):
+        """ merges the data collected by a worker into the parent converter """
 
-            records.append(elem)
-            records_len += 1
-            if records_len >= self.CHUNK_SIZE:
-                # print(f'>>> Start save to db records {chunk_start_index}-{i}')
+    def run_worker(self, index, chunks_queue, results_queue):
+        # every worker must have its own DB connection, never the one inherited from the parent
+        connections.close_all()
+        records_count = 0
+        start_time = timezone.now()
+        try:
+            while True:
+                chunk = chunks_queue.get()
+                if chunk is None:
+                    break
+                records = [etree.fromstring(record) for record in chunk]
+                self.save_to_db(records)
+                records_count += len(records)
+                self.print_running_times()
+            seconds = (timezone.now() - start_time).total_seconds()
+            rate = round(records_count / seconds, 2) if seconds else records_count
+            logger.info(f'{self.__class__.__name__}: worker {index} saved {records_count} records '
+                        f'at {rate} records/sec.')
+            results_queue.put((index, None, (records_count, rate, self.get_worker_state())))
+        except Exception as e:
+            traceback.print_exc()
+            results_queue.put((index, f'{e}, after {records_count} records', None))
+        finally:
+            connections.close_all()
+
+    def put_chunk(self, chunks_queue, worker, chunk):
+        while True:
+            try:
+                chunks_queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                if not worker.is_alive():
+                    raise Exception(f'Worker {worker.name} stopped unexpectedly')
+
+    def start_workers(self, target, workers_args):
+        """
+        Starts a forked worker process for every tuple of args, target is called with the index
+        of the worker, the args and the queue to put the (index, error, result) tuple to
+        """
+        context = multiprocessing.get_context('fork')
+        results_queue = context.Queue()
+        # the forked workers must not share the parent`s DB connection
+        connections.close_all()
+        processes = [
+            context.Process(
+                target=target,
+                args=(index, *args, results_queue),
+                name=f'{self.__class__.__name__}-{index}',
+            ) for index, args in enumerate(workers_args)
+        ]
+        for process in processes:
+            process.start()
+        return processes, results_queue
+
+    def get_worker_results(self, results_queue, processes):
+        """
+        yields (index, error, result) of the workers as they come and joins them after the last one,
+        a worker stopped without a result (e.g. killed by the OOM killer) is yielded as failed with its exit code
+        """
+        pending = set(range(len(processes)))
+        while pending:
+            try:
+                result = results_queue.get(timeout=1)
+            except queue.Empty:
+                stopped = [index for index in pending if not processes[index].is_alive()]
+                if not stopped:
+                    continue
+                # the result of a worker that has just stopped may still be in the pipe
                 try:
-                    if i >= start_index:
-                        self.time_it('preparing chunk of records')
-                        self.save_to_db(records)
-                    self.print_running_times()
-                    print(i)
-                except Exception as e:
-                    msg = f'!!! Save to db failed at index = {chunk_start_index}. Error: {str(e)}'
-                    logger.error(msg)
-                    traceback.print_exc()
-                    print(msg)
-                    return False
-                records.clear()
-
-                # http://lxml.de/parsing.html#modifying-the-tree
-                # Based on Liza Daly fast_iter
-                # http://www.ibm.com/developerworks/xml/library/x-hiperfparse/
-                # See also http://effbot.org/zone/element-iterparse.htm
-                #
-                # It safe to call clear() here because no descendants will be accessed
-                elem.clear()
-                # # Also eliminate now-empty references from the root node to elem
-                for ancestor in elem.xpath('ancestor-or-self::*'):
-                    while ancestor.getprevious() is not None:
-                        del ancestor.getparent()[0]
-
-                print('>>> Saved successfully')
-            i += 1
-        if records_len:
-            self.save_to_db(records)
+                    result = results_queue.get(timeout=1)
+                except queue.Empty:
+                    for index in stopped:
+                        pending.discard(index)
+                        yield index, f'stopped with exit code {processes[index].exitcode}', None
+                    continue
+            pending.discard(result[0])
+            yield result
+        for process in processes:
+            process.join()
+
+    def process_in_parallel(self, workers, start_index=0):
+        """
+        the parent process parses the source file and spreads chunks of records between
+        worker processes by the partition key, every worker runs save_to_db with its own DB connection,
+        records before start_index are parsed but not saved
+        """
+        context = multiprocessing.get_context('fork')
+        chunks_queues = [context.Queue(maxsize=2) for _ in range(workers)]
+        chunks = [[] for _ in range(workers)]
+        processes, results_queue = self.start_workers(
+            self.run_worker, [(chunks_queue,) for chunks_queue in chunks_queues]
+        )
+        with self.open_source() as source:
+            elements = etree.iterparse(
+                source=source,
+                tag=self.RECORD_TAG,
+                recover=False,
+            )
+            i = 0
+            try:
+                for _, elem in elements:
+                    if i < start_index:
+                        self.clear_parsed_element(elem)
+                        i += 1
+                        continue
+                    index = self.get_worker_index(elem, workers)
+                    chunks[index].append(etree.tostring(elem))
+                    self.clear_parsed_element(elem)
+                    if len(chunks[index]) >= self.CHUNK_SIZE:
+                        self.put_chunk(chunks_queues[index], processes[index], chunks[index])
+                        chunks[index] = []
+                    i += 1
+                for index in range(workers):
+                    if chunks[index]:
+                        self.put_chunk(chunks_queues[index], processes[index], chunks[index])
+                    self.put_chunk(chunks_queues[index], processes[index], None)
+            except Exception as e:
+                msg = f'!!! Parsing failed at index = {i}. Error: {str(e)}'
+                logger.error(msg)
+                traceback.print_exc()
+                for process in processes:
+                    process.terminate()
+                return False
+            del elements
+
+        failed = False
+        for index, error, result in self.get_worker_results(results_queue, processes):
+            if error:
+                failed = True
+                logger.error(f'!!! Worker {index} failed. Error: {error}')
+                continue
+            records_count, rate, state = result
+            print(f'Worker {index}: {records_count} records, {rate} records/sec')
+            self.merge_worker_state(state)
+        if failed:
+            return False
         if start_index == 0:
             self.delete_outdated()
-        del elements
         print('All the records have been rewritten.')
         return True
 
@@ -293,3 +693,294 @@ class BulkCreateManager(object):  # https://www.caktusgroup.com/blog/2019/01/09/
         model_class = type(obj)
         model_key = model_class._meta.label
         self.queues[model_key].append(obj)
+
+
+class TransactionBulkCreateManager(BulkCreateManager):
+    """
+    Unit of work: objects of several models are queued and created with commit_all in one transaction.
+    Models referred to by foreign keys of other queued models are created first, so parents get pks
+    from bulk_create (RETURNING on PostgreSQL) before their children are created.
+    Objects of models with history get '+' history rows, like when they are saved one by one.
+    """
+
+    def commit(self, model_class):
+        model_key = model_class._meta.label
+        relation_fields = [field for field in model_class._meta.concrete_fields if field.is_relation]
+        for obj in self.queues[model_key]:
+            # the related object could get its pk after it was set to obj
+            for field in relation_fields:
+                if getattr(obj, field.attname) is None and field.is_cached(obj):
+                    related_obj = getattr(obj, field.name)
+                    if related_obj is not None:
+                        if related_obj.pk is None:
+                            raise ValueError(f'{model_key}.{field.name} refers to a not saved '
+                                             f'{related_obj._meta.label}, it must be committed before')
+                        setattr(obj, field.attname, related_obj.pk)
+        super().commit(model_class)
+        try:
+            history_manager = get_history_manager_for_model(model_class)
+        except NotHistoricalModelError:
+            return
+        history_manager.bulk_history_create(self.queues[model_key])
+
+    def get_models_in_order(self):
+        """Returns models of not empty queues, every model goes after the queued models it refers to"""
+        models = [type(objs[0]) for objs in self.queues.values() if objs]
+        ordered_models = []
+        while models:
+            for model_class in models:
+                parents = {field.related_model for field in model_class._meta.concrete_fields
+                           if field.is_relation and field.related_model is not model_class}
+                if not parents.intersection(models):
+                    break
+            else:
+                raise ValueError(f'Foreign keys of queued models make a cycle: {models}')
+            models.remove(model_class)
+            ordered_models.append(model_class)
+        return ordered_models
+
+    def commit_all(self):
+        """Creates all queued objects, returns the number of them"""
+        objects_count = 0
+        with transaction.atomic():
+            for model_class in self.get_models_in_order():
+                self.commit(model_class)
+                objects_count += len(self.queues[model_class._meta.label])
+        self.queues.clear()
+        return objects_count
+
+
+class IdTracker:
+    """
+    Stored ids of a table and ids seen in the source for finding outdated objects in delete_outdated.
+    Ids are bits of two bitmaps, so 1.5M ids take hundreds of KB instead of hundreds of MB for lists
+    or dicts of instances, mark is O(1) and unseen ids are found with one operation on whole bitmaps.
+    Ids must be positive integers, e.g. auto primary keys.
+    """
+
+    def __init__(self, stored_ids=()):
+        self.stored = bytearray()
+        self.seen = bytearray()
+        for stored_id in stored_ids:
+            self.set_bit(self.stored, stored_id)
+
+    @staticmethod
+    def set_bit(bitmap, id_to_set):
+        index = id_to_set >> 3
+        if index >= len(bitmap):
+            # growing at least twice, like list does
+            bitmap.extend(bytes(max(index + 1, len(bitmap) * 2) - len(bitmap)))
+        bitmap[index] |= 1 << (id_to_set & 7)
+
+    @staticmethod
+    def to_int(bitmap):
+        return int.from_bytes(bitmap, 'little')
+
+    def mark(self, seen_id):
+        self.set_bit(self.seen, seen_id)
+
+    def is_stored(self, id_to_check):
+        index = id_to_check >> 3
+        return index < len(self.stored) and bool(self.stored[index] & 1 << (id_to_check & 7))
+
+    def merge(self, other):
+        """Adds ids seen by other tracker of the same table, e.g. in a worker process"""
+        size = max(len(self.seen), len(other.seen))
+        self.seen = bytearray((self.to_int(self.seen) | self.to_int(other.seen)).to_bytes(size, 'little'))
+
+    def get_unseen_ids(self):
+        size = len(self.stored)
+        unseen = (self.to_int(self.stored) & ~self.to_int(self.seen[:size])).to_bytes(size, 'little')
+        return [index * 8 + bit for index, byte in enumerate(unseen) if byte
+                for bit in range(8) if byte >> bit & 1]
+
+
+class ChildrenUpdater:
+    """
+    Updates children of many stored parents at once, e.g. founders of companies from a chunk of records.
+    Stored children of all parents are got with one query, children from records are matched with them
+    by key fields in memory, changed ones are saved with one bulk_update and their history, new ones are added
+    to the bulk manager of the converter and not matched ones are soft deleted with one UPDATE.
+    """
+
+    def __init__(self, model, parent_field, key_fields, update_fields, bulk_manager):
+        self.model = model
+        self.parent_field = model._meta.get_field(parent_field)
+        self.key_fields = [model._meta.get_field(field_name) for field_name in key_fields]
+        self.update_fields = [model._meta.get_field(field_name) for field_name in update_fields]
+        self.bulk_manager = bulk_manager
+        try:
+            self.history_manager = get_history_manager_for_model(model)
+        except NotHistoricalModelError:
+            self.history_manager = None
+        self.stored_children = defaultdict(list)
+        self.changed_children = {}
+        self.outdated_children_ids = set()
+
+    def prefetch(self, parent_ids):
+        """Gets stored children, including soft deleted ones, of all parents with one query"""
+        self.stored_children = defaultdict(list)
+        for child in self.model.include_deleted_objects.filter(
+                **{f'{self.parent_field.attname}__any': list(parent_ids)}
+        ).order_by('pk'):
+            self.stored_children[getattr(child, self.parent_field.attname)].append(child)
+
+    def get_value(self, child, field):
+        # values from records can be strings, e.g. dates, so they are converted like when loaded from DB
+        return field.to_python(getattr(child, field.attname))
+
+    def get_key(self, child):
+        return tuple(self.get_value(child, field) for field in self.key_fields)
+
+    def update(self, parent, children):
+        """
+        Compares children from the record with stored children of the parent,
+        the parent must be prefetched. The same parent can be updated several times in a chunk,
+        then every next version is compared with the children left by the previous one.
+        """
+        stored_by_key = defaultdict(list)
+        for stored_child in self.stored_children[parent.id]:
+            stored_by_key[self.get_key(stored_child)].append(stored_child)
+        current_children = []
+        for child in children:
+            same_children = stored_by_key.get(self.get_key(child))
+            if not same_children:
+                setattr(child, self.parent_field.attname, parent.id)
+                self.bulk_manager.add(child)
+                current_children.append(child)
+                continue
+            stored_child = same_children.pop(0)
+            current_children.append(stored_child)
+            self.outdated_children_ids.discard(stored_child.id)
+            is_changed = False
+            for field in self.update_fields:
+                value = self.get_value(child, field)
+                if getattr(stored_child, field.attname) != value:
+                    setattr(stored_child, field.attname, value)
+                    is_changed = True
+            if stored_child.deleted_at:
+                stored_child.deleted_at = None
+                is_changed = True
+            # a child added by the previous version is not created yet and is created with the new values
+            if is_changed and stored_child.id:
+                self.changed_children[stored_child.id] = stored_child
+        for outdated_children in stored_by_key.values():
+            for child in outdated_children:
+                if not child.id:
+                    self.bulk_manager.queues[self.model._meta.label].remove(child)
+                    continue
+                # deleted children are kept, so the next version of the parent can restore them
+                current_children.append(child)
+                if not child.deleted_at:
+                    self.outdated_children_ids.add(child.id)
+        self.stored_children[parent.id] = current_children
+
+    def commit(self):
+        """
+        Saves changed children with their history and deletes outdated children,
+        new children are saved by the bulk manager
+        """
+        if self.changed_children:
+            now = timezone.now()
+            changed_children = list(self.changed_children.values())
+            for child in changed_children:
+                child.updated_at = now
+            # soft deleted children are restored, so the manager must include them
+            self.model.include_deleted_objects.bulk_update(
+                changed_children,
+                [field.name for field in self.update_fields] + ['deleted_at', 'updated_at']
+            )
+            if self.history_manager:
+                self.history_manager.bulk_history_create(changed_children, update=True)
+            self.changed_children = {}
+        self.model.bulk_soft_delete(list(self.outdated_children_ids))
+        self.outdated_children_ids = set()
+        self.stored_children = defaultdict(list)
+
+
+class CopyBulkCreateManager(BulkCreateManager):
+    """
+    The same queues as BulkCreateManager, but objects are streamed into the table with
+    PostgreSQL COPY ... FROM STDIN instead of building INSERT statements.
+    COPY does not return generated keys, so primary keys are reserved from the table sequence
+    before copying and set to the objects, like bulk_create does on PostgreSQL.
+    """
+
+    def commit(self, model_class):
+        model_key = model_class._meta.label
+        objs = self.queues[model_key]
+        if not objs:
+            return
+        db = router.db_for_write(model_class)
+        connection = connections[db]
+        opts = model_class._meta
+        fields = [field for field in opts.concrete_fields if not field.primary_key]
+        with connection.cursor() as cursor:
+            if opts.auto_field and any(obj.pk is None for obj in objs):
+                objs_without_pk = [obj for obj in objs if obj.pk is None]
+                cursor.execute(
+                    'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                    [opts.db_table, opts.pk.column, len(objs_without_pk)]
+                )
+                for obj, (pk,) in zip(objs_without_pk, cursor.fetchall()):
+                    obj.pk = pk
+            fields.insert(0, opts.pk)
+            relation_fields = [field for field in fields if field.is_relation]
+            rows = []
+            for obj in objs:
+                # related object could get its pk after it was set to obj, e.g. company committed earlier
+                for field in relation_fields:
+                    if getattr(obj, field.attname) is None and field.is_cached(obj):
+                        related_obj = getattr(obj, field.name)
+                        if related_obj is not None:
+                            setattr(obj, field.attname, related_obj.pk)
+                rows.append([field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields])
+                obj._state.adding = False
+                obj._state.db = db
+            self.copy(cursor, opts.db_table, [field.column for field in fields], rows)
+
+    def commit_with_history(self, model_class):
+        """Commits the queue of the model and copies '+' history rows of the created objects the same way"""
+        objs = self.queues[model_class._meta.label]
+        self.commit(model_class)
+        history_model = get_history_manager_for_model(model_class).model
+        history_date = timezone.now()
+        history_key = history_model._meta.label
+        self.queues[history_key] = [
+            history_model(
+                history_date=history_date,
+                history_type='+',
+                history_change_reason='',
+                **{field.attname: getattr(obj, field.attname) for field in model_class._meta.fields
+                   if field.name not in history_model._history_excluded_fields}
+            ) for obj in objs
+        ]
+        self.commit(history_model)
+        self.queues[history_key] = []
+
+    @classmethod
+    def copy(cls, cursor, table, columns, rows):
+        """Streams rows of values prepared for DB into the table columns"""
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(cls.to_copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        quote_name = cursor.db.ops.quote_name
+        columns = ', '.join(quote_name(column) for column in columns)
+        # psycopg2 cursor is wrapped by Django cursor
+        cursor.cursor.copy_expert(f'COPY {quote_name(table)} ({columns}) FROM STDIN', buffer)
+
+    @staticmethod
+    def to_copy_value(value):
+        """Converts the value to the PostgreSQL COPY text format"""
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
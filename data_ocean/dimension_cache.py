@@ -0,0 +1,98 @@
+from django.db import connections, router
+from django.utils import timezone
+
+
+class DimensionCache:
+    """
+    Map of the unique key (usually the name) to id of a small dimension table like statuses or authorities.
+    One cache for each table is shared by all converters of the process (forked workers inherit it),
+    so the table is loaded once for a run instead of in every converter __init__.
+    Missing keys of the chunk are stored with one INSERT ... ON CONFLICT DO NOTHING RETURNING query,
+    that also survives the race between parallel workers storing the same key.
+    defaults are values of other not null fields of new rows.
+    """
+
+    def __init__(self, model, key_field='name', defaults=None):
+        self.model = model
+        self.key_field = key_field
+        self.defaults = defaults or {}
+        self.ids = None
+        # lightweight instances with the id for assigning to foreign keys, made only for used keys
+        self.objects = {}
+
+    def clear(self):
+        """Drops the loaded keys, the table is loaded again on the next use"""
+        self.ids = None
+        self.objects = {}
+
+    def load(self):
+        if self.ids is None:
+            self.ids = dict(self.model.include_deleted_objects.values_list(self.key_field, 'id'))
+        return self.ids
+
+    def resolve(self, keys):
+        """Stores all missing keys with one query"""
+        ids = self.load()
+        missing_keys = {key for key in keys if key and key not in ids}
+        if missing_keys:
+            ids.update(self.insert(missing_keys))
+
+    def insert(self, keys):
+        opts = self.model._meta
+        connection = connections[router.db_for_write(self.model)]
+        quote_name = connection.ops.quote_name
+        column = quote_name(opts.get_field(self.key_field).column)
+        now = timezone.now()
+        values = {'created_at': now, 'updated_at': now, **self.defaults}
+        columns = ''.join(f', {quote_name(opts.get_field(name).column)}' for name in values)
+        placeholders = ', %s' * len(values)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote_name(opts.db_table)} ({column}{columns}) '
+                f'SELECT key{placeholders} FROM unnest(%s::text[]) AS key '
+                f'ON CONFLICT ({column}) DO NOTHING RETURNING {column}, {quote_name(opts.pk.column)}',
+                [*values.values(), list(keys)]
+            )
+            new_ids = dict(cursor.fetchall())
+        conflicted_keys = [key for key in keys if key not in new_ids]
+        if conflicted_keys:
+            # stored by another process after the cache was loaded
+            new_ids.update(self.model.include_deleted_objects.filter(
+                **{f'{self.key_field}__in': conflicted_keys}
+            ).values_list(self.key_field, 'id'))
+        return new_ids
+
+    def get_id(self, key):
+        if not key:
+            return None
+        ids = self.load()
+        if key not in ids:
+            self.resolve([key])
+        return ids[key]
+
+    def get(self, key):
+        """Returns the instance with only the id and the key set or None for the empty key"""
+        if not key:
+            return None
+        obj = self.objects.get(key)
+        if obj is None:
+            obj = self.model(**{'id': self.get_id(key), self.key_field: key})
+            obj._state.adding = False
+            self.objects[key] = obj
+        return obj
+
+
+_caches = {}
+
+
+def get_dimension_cache(model, key_field='name', defaults=None):
+    cache_key = (model._meta.label, key_field)
+    if cache_key not in _caches:
+        _caches[cache_key] = DimensionCache(model, key_field, defaults)
+    return _caches[cache_key]
+
+
+def clear_dimension_caches():
+    """Converter.process calls it when a run starts, converters keep using their caches, which are reloaded"""
+    for cache in _caches.values():
+        cache.clear()
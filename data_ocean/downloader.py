@@ -1,10 +1,15 @@
+import base64
 import codecs
+import hashlib
 import logging
 import os
+import re
 import subprocess
 import tempfile
+import time
 import zipfile
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from django.apps import apps
@@ -12,6 +17,7 @@ from django.conf import settings
 from django.db import connections
 from django.utils import timezone
 
+from data_ocean.converter import UNREADABLE_CHARACTERS
 from data_ocean.models import Report, Register
 from business_register.models.company_models import Company
 
@@ -19,6 +25,10 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+class RangeNotSupported(requests.exceptions.RequestException):
+    pass
+
+
 class Downloader(ABC):
     auth = None
     url = None
@@ -27,14 +37,23 @@ class Downloader(ABC):
     local_path = settings.LOCAL_FOLDER
     chunk_size = 16 * 1024
     stream = True
+    # the number of byte ranges fetched concurrently, 1 means one stream resumed with Range header after errors
+    segments = 1
+    download_attempts = 5
+    retry_delay = 10
+    timeout = 60
     reg_name = ''
     file_name = ''
     file_path = ''
     file_size = 0
+    file_md5 = ''
     check_by_length = False
     zip_required_file_sign = ''
     unzip_required_file_sign = ''
     unzip_after_download = False
+    # the converter reads the required file right from the downloaded archive instead of unzipping it
+    stream_from_zip = False
+    zip_member_name = ''
     report = None
     start_time = None
     source_dataset_url = ''
@@ -112,9 +131,34 @@ class Downloader(ABC):
                     return
         self.no_req_sign()
 
-    def file_size_is_correct(self):
-        if os.path.isfile(self.file_path):
-            return os.path.getsize(self.file_path) == self.file_size
+    def find_zip_member(self):
+        self.is_zip_file()
+        for i in self.get_zip_filelist():
+            if self.unzip_required_file_sign in i:
+                self.zip_member_name = i
+                self.report.unzip_file_name = i
+                self.report.save()
+                return
+        self.no_req_sign()
+
+    def set_converter_source(self, converter):
+        """Points the converter to the downloaded file or to the required file in the downloaded archive"""
+        if self.stream_from_zip:
+            converter.SOURCE_ZIP_FILE_NAME = self.file_name
+            converter.LOCAL_FILE_NAME = self.zip_member_name
+        else:
+            converter.LOCAL_FILE_NAME = self.file_name
+
+    def file_is_correct(self):
+        if not os.path.isfile(self.file_path) or os.path.getsize(self.file_path) != self.file_size:
+            return False
+        if self.file_md5:
+            md5 = hashlib.md5()
+            with open(self.file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    md5.update(chunk)
+            return md5.hexdigest() == self.file_md5
+        return True
 
     def remove_file(self):
         if os.path.isfile(self.file_path):
@@ -123,6 +167,49 @@ class Downloader(ABC):
     def report_init(self):
         self.report = Report.objects.create(registry_name=self.reg_name)
 
+    def resume_report(self):
+        """
+        Takes the report of the last update of the register, if it failed after the converter
+        saved a checkpoint and the source file is still on disk, so the update can continue
+        from the checkpoint instead of starting over with a new download
+        """
+        report = Report.objects.filter(registry_name=self.reg_name).order_by('-id').first()
+        if not report or report.update_status or not report.checkpoint_index or not report.unzip_file_name:
+            return False
+        if self.stream_from_zip:
+            file_path = report.download_file_name
+        else:
+            file_path = self.local_path + report.unzip_file_name
+        if not file_path or not os.path.isfile(file_path):
+            return False
+        if not self.is_source_file_current(report):
+            logger.info(f'{self.reg_name}: A new source file is published since report {report.id}, '
+                        f'update starts over.')
+            return False
+        self.report = report
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        self.zip_member_name = report.unzip_file_name
+        logger.info(f'{self.reg_name}: Resume update of report {report.id} '
+                    f'from record {report.checkpoint_index} of {file_path}.')
+        return True
+
+    def is_source_file_current(self, report):
+        """Checks that the file downloaded for the report has the name and the size of the one published now"""
+        if report.download_file_name != self.file_path:
+            return False
+        try:
+            try:
+                r = self.request_range(0, 0)
+            except RangeNotSupported:
+                # only the headers are read, the body is not downloaded
+                r = self.request_range()
+            with r:
+                return self.get_total_size(r) == report.download_file_length
+        except requests.exceptions.RequestException as e:
+            logger.warning(f'{self.reg_name}: Size of the source file is unknown: {e}')
+            return False
+
     def get_source_file_url(self):
         assert self.url
         return self.url
@@ -144,35 +231,120 @@ class Downloader(ABC):
                 c.execute('%s %s' % (query, table))
                 logger.info(f'{self.reg_name}: {query} {table} at {timezone.now() - start_time}')
 
+    def request_range(self, start=0, end=''):
+        headers = dict(self.get_headers())
+        if start or end != '':
+            headers['Range'] = f'bytes={start}-{end}'
+        r = requests.get(self.url, data=self.data, stream=self.stream, auth=self.auth,
+                         headers=headers, timeout=self.timeout)
+        r.raise_for_status()
+        if r.status_code != 206 and (start or end != ''):
+            r.close()
+            raise RangeNotSupported(f'Server ignored Range header for {self.url}')
+        return r
+
+    @staticmethod
+    def get_total_size(r):
+        if r.status_code == 206:
+            # Content-Range: bytes 0-0/1234
+            return int(re.search(r'/(\d+)$', r.headers['Content-Range']).group(1))
+        return int(r.headers['Content-Length'])
+
+    def retry(self, func, *args):
+        """Calls func again after network errors, func must continue from where the previous call stopped"""
+        for attempt in range(1, self.download_attempts + 1):
+            try:
+                return func(*args)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == self.download_attempts:
+                    raise
+                logger.warning(f'{self.reg_name}: {e}, attempt {attempt} of {self.download_attempts} failed, '
+                               f'retry in {self.retry_delay * attempt} s ...')
+                time.sleep(self.retry_delay * attempt)
+
+    def download_stream(self):
+        """Downloads the rest of the file in one stream"""
+        downloaded = os.path.getsize(self.file_path) if os.path.isfile(self.file_path) else 0
+        if self.file_size and downloaded == self.file_size:
+            return
+        try:
+            r = self.request_range(downloaded)
+        except RangeNotSupported:
+            logger.warning(f'{self.reg_name}: Server does not support ranges, download starts from zero.')
+            downloaded = 0
+            r = self.request_range()
+        with r:
+            if not self.file_size:
+                self.file_size = self.get_total_size(r)
+                if not downloaded and r.headers.get('Content-MD5'):
+                    self.file_md5 = base64.b64decode(r.headers['Content-MD5']).hex()
+            with open(self.file_path, 'ab' if downloaded else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+
+    def download_segment(self, segment):
+        """Downloads the rest of the byte range into its place of the preallocated file"""
+        start, end = segment['position'], segment['end']
+        if start > end:
+            return
+        with self.request_range(start, end) as r, open(self.file_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                f.write(chunk)
+                segment['position'] += len(chunk)
+
+    def download_segments(self):
+        """
+        Fetches self.segments byte ranges concurrently into the preallocated file,
+        falls back to one stream when the server does not support ranges
+        """
+        try:
+            with self.request_range(0, 0) as r:
+                self.file_size = self.get_total_size(r)
+        except RangeNotSupported:
+            logger.warning(f'{self.reg_name}: Server does not support ranges, download in one stream.')
+            self.retry(self.download_stream)
+            return
+        with open(self.file_path, 'wb') as f:
+            f.truncate(self.file_size)
+        segment_size = -(-self.file_size // self.segments)
+        segments = [
+            {'position': start, 'end': min(start + segment_size, self.file_size) - 1}
+            for start in range(0, self.file_size, segment_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            futures = [executor.submit(self.retry, self.download_segment, segment) for segment in segments]
+            for future in futures:
+                future.result()
+
     def download(self):
         assert self.url
         assert self.file_path
 
         start_time = timezone.now()
         try:
-            with requests.get(self.url, data=self.data, stream=self.stream,
-                              auth=self.auth, headers=self.get_headers()) as r:
-                r.raise_for_status()
-
-                self.file_size = int(r.headers['Content-Length'])
-                logger.info(f"{self.reg_name}: Start downloading: {self.file_path}, size: {self.file_size} ...")
-                self.remove_file()
-                with open(self.file_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=self.chunk_size):
-                        f.write(chunk)
-                    f.flush()
-
-                if not self.file_size_is_correct():
-                    raise requests.exceptions.RequestException('Error! Bad file size after download.')
-
-                logger.info(
-                    f"{self.reg_name}: {self.file_path} downloaded successfully at {timezone.now() - start_time}.")
-
-                self.report.download_finish = timezone.now()
-                self.report.download_status = True
-                self.report.download_file_name = self.file_path
-                self.report.download_file_length = self.file_size
-                self.report.save()
+            logger.info(f"{self.reg_name}: Start downloading: {self.file_path} in {self.segments} segment(s) ...")
+            self.remove_file()
+            self.file_size = 0
+            self.file_md5 = ''
+            if self.segments > 1:
+                self.download_segments()
+            else:
+                self.retry(self.download_stream)
+
+            if not self.file_is_correct():
+                raise requests.exceptions.RequestException('Error! Bad file size or checksum after download.')
+
+            logger.info(
+                f"{self.reg_name}: {self.file_path} ({self.file_size} bytes) downloaded successfully "
+                f"at {timezone.now() - start_time}.")
+
+            self.report.download_finish = timezone.now()
+            self.report.download_status = True
+            self.report.download_file_name = self.file_path
+            self.report.download_file_length = self.file_size
+            self.report.save()
 
         except requests.exceptions.RequestException as e:
 
@@ -183,7 +355,9 @@ class Downloader(ABC):
             logger.exception(f'{self.reg_name}: {e}')
             raise Exception('Error!', e)
 
-        if self.unzip_after_download:
+        if self.stream_from_zip:
+            self.find_zip_member()
+        elif self.unzip_after_download:
             self.unzip_source_file()
 
     def update_register_field(self, register_api_list, field_name, new_field_value):
@@ -225,14 +399,9 @@ class Downloader(ABC):
         tmp = tempfile.mkstemp()
         with codecs.open(file, 'r', 'Windows-1251') as fd1, codecs.open(tmp[1], 'w', 'UTF-8') as fd2:
             for line in fd1:
-                line = line.replace('&quot;', '"')\
-                    .replace('windows-1251', 'UTF-8')\
-                    .replace('&#3;', '')\
-                    .replace('&#14;', '')\
-                    .replace('&#16;', '')\
-                    .replace('&#24;', '')\
-                    .replace('&#30;', '')\
-                    .replace('&#31;', '')
+                line = line.replace('windows-1251', 'UTF-8')
+                for old, new in UNREADABLE_CHARACTERS:
+                    line = line.replace(old, new)
                 fd2.write(line)
         os.rename(tmp[1], file)
         logger.info(f'{self.reg_name}: remove_unreadable_characters finished.')
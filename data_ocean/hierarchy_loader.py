@@ -0,0 +1,140 @@
+import logging
+from array import array
+
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class HierarchyLevel:
+    """
+    Nodes of one level of a tree of places, e.g. districts of regions, collected from the whole source.
+    A node is found by a key made of indexes of its parent nodes and its own values, parents are kept
+    as indexes of nodes of the upper levels in arrays, so the tree holds neither model instances
+    nor composed string codes. key_value(node) returns the value of key_field the node is stored with,
+    by default it is the value of key_field from the source. fields and update_fields are attnames,
+    stored nodes are updated only by update_fields.
+    """
+
+    def __init__(self, model, key_field, parents=None, fields=(), update_fields=(), key_value=None):
+        self.model = model
+        self.key_field = key_field
+        # name of the foreign key -> the upper level
+        self.parents = parents or {}
+        self.fields = fields
+        self.update_fields = update_fields
+        self.key_value = key_value or (lambda node: self.get_value(node, key_field))
+        self.nodes = {}
+        self.parent_nodes = {field: array('l') for field in self.parents}
+        self.values = {field: [] for field in fields}
+        # ids of nodes in DB by the index of the node, known after save
+        self.ids = array('q')
+        self.outdated_ids = []
+
+    def add(self, key, parents=None, **values):
+        """Returns the index of the node with the key, a new node gets the parents and the values"""
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = len(self.nodes)
+            parents = parents or {}
+            for field, parent_nodes in self.parent_nodes.items():
+                parent = parents.get(field)
+                parent_nodes.append(-1 if parent is None else parent)
+            for field, field_values in self.values.items():
+                field_values.append(values.get(field))
+        return node
+
+    def get(self, key):
+        return self.nodes.get(key)
+
+    def get_value(self, node, field):
+        return self.values[field][node]
+
+    def get_parent(self, node, field):
+        parent = self.parent_nodes[field][node]
+        return None if parent < 0 else parent
+
+    def get_row(self, node):
+        """Returns values of the node by attnames with ids of saved parents"""
+        row = {field: field_values[node] for field, field_values in self.values.items()}
+        for field, level in self.parents.items():
+            parent = self.get_parent(node, field)
+            row[f'{field}_id'] = None if parent is None else level.ids[parent]
+        return row
+
+    def save(self, batch_size=None):
+        """
+        Creates new nodes with bulk_create and updates changed stored ones with bulk_update, soft deleted
+        ones are restored. Upper levels must be saved before. Stored nodes missing in the tree
+        are kept in outdated_ids.
+        """
+        stored = {}
+        for key_value, stored_id, deleted_at, *values in self.model.include_deleted_objects.values_list(
+                self.key_field, 'id', 'deleted_at', *self.update_fields
+        ).order_by('id').iterator():
+            stored.setdefault(key_value, (stored_id, deleted_at, values))
+        self.ids = array('q', bytes(8 * len(self.nodes)))
+        # nodes with the same stored key refer to the same object
+        new_nodes = {}
+        changed_objects = []
+        seen_ids = set()
+        now = timezone.now()
+        for node in range(len(self.nodes)):
+            key_value = self.key_value(node)
+            if key_value in new_nodes:
+                new_nodes[key_value][1].append(node)
+                continue
+            row = self.get_row(node)
+            if key_value not in stored:
+                row[self.key_field] = key_value
+                new_nodes[key_value] = (self.model(**row), [node])
+                continue
+            stored_id, deleted_at, values = stored[key_value]
+            self.ids[node] = stored_id
+            if stored_id in seen_ids:
+                continue
+            seen_ids.add(stored_id)
+            if deleted_at or any(row[field] != value for field, value in zip(self.update_fields, values)):
+                changed_object = self.model(id=stored_id, deleted_at=None, updated_at=now)
+                for field in self.update_fields:
+                    setattr(changed_object, field, row[field])
+                changed_objects.append(changed_object)
+        new_objects = [new_object for new_object, _ in new_nodes.values()]
+        self.model.include_deleted_objects.bulk_create(new_objects, batch_size=batch_size)
+        for new_object, nodes in new_nodes.values():
+            for node in nodes:
+                self.ids[node] = new_object.id
+        if changed_objects:
+            self.model.include_deleted_objects.bulk_update(
+                changed_objects, list(self.update_fields) + ['deleted_at', 'updated_at'], batch_size=batch_size
+            )
+        self.outdated_ids = [stored_id for stored_id, deleted_at, _ in stored.values()
+                             if stored_id not in seen_ids and not deleted_at]
+        logger.info(f'{self.model.__name__}: {len(new_objects)} created, {len(changed_objects)} updated')
+
+    def delete_outdated(self):
+        self.model.bulk_soft_delete(self.outdated_ids)
+        self.outdated_ids = []
+
+
+class HierarchyLoader:
+    """
+    Tree of places of the whole source, e.g. regions, districts, cities and streets, collected in memory
+    and then saved level by level from the top one with a few bulk statements for each level.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.levels = []
+
+    def add_level(self, *args, **kwargs):
+        level = HierarchyLevel(*args, **kwargs)
+        self.levels.append(level)
+        return level
+
+    def save(self):
+        with transaction.atomic():
+            for level in self.levels:
+                level.save(self.batch_size)
@@ -0,0 +1,20 @@
+from django.db.models import Field, ForeignObject, Lookup
+
+
+class AnyLookup(Lookup):
+    """
+    field__any=[...] gives `field = ANY(%s)` with the list as one array parameter,
+    so a big list does not make a big query text like `field IN (%s, %s, ...)`
+    """
+    lookup_name = 'any'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} = ANY({rhs})', lhs_params + rhs_params
+
+
+Field.register_lookup(AnyLookup)
+# lookups of related fields are not inherited from Field
+ForeignObject.register_lookup(AnyLookup)
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from business_register.models.company_models import Company, Founder
+from data_ocean.converter import BulkCreateManager, CopyBulkCreateManager
+
+
+class Command(BaseCommand):
+    help = 'compares saving of founders with bulk_create and with COPY, all changes are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', nargs='?', type=int, default=100000)
+        parser.add_argument('chunk_size', nargs='?', type=int, default=200)
+
+    def save(self, bulk_manager, company, count, chunk_size):
+        start_time = time.time()
+        for index in range(count):
+            bulk_manager.add(Founder(
+                company=company,
+                info=f'Benchmark founder {index}, 01001, м.Київ, вул. Хрещатик, 1',
+                name=f'Benchmark founder {index}',
+                edrpou=str(index),
+                equity=index / 100,
+                address='01001, м.Київ, вул. Хрещатик, 1',
+                is_founder=True,
+            ))
+            if len(bulk_manager.queues['business_register.Founder']) == chunk_size:
+                bulk_manager.commit(Founder)
+                bulk_manager.queues['business_register.Founder'] = []
+        bulk_manager.commit(Founder)
+        bulk_manager.queues['business_register.Founder'] = []
+        return time.time() - start_time
+
+    def handle(self, *args, **options):
+        count = options['count']
+        chunk_size = options['chunk_size']
+        with transaction.atomic():
+            company = Company.objects.create(name='Benchmark company', code='benchmark')
+            for name, bulk_manager in (
+                ('bulk_create', BulkCreateManager()),
+                ('COPY', CopyBulkCreateManager()),
+            ):
+                seconds = self.save(bulk_manager, company, count, chunk_size)
+                self.stdout.write(f'{name}: {count} founders in {seconds:.2f} s, '
+                                  f'{count / seconds:.0f} records/s')
+            transaction.set_rollback(True)
@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand
+from lxml import etree
+
+from business_register.converter.company_converters.ukr_company import UkrCompanyConverter
+
+
+class Command(BaseCommand):
+    help = 'compares extraction of EDR records with xpath calls and with a compiled record schema'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', nargs='?', type=int, default=100000)
+
+    def get_records(self, count):
+        return [etree.fromstring(
+            f'<RECORD><NAME>ТОВАРИСТВО З ОБМЕЖЕНОЮ ВІДПОВІДАЛЬНІСТЮ "БЕНЧМАРК {index}"</NAME>'
+            f'<SHORT_NAME>ТОВ "БЕНЧМАРК {index}"</SHORT_NAME><EDRPOU>{index:08}</EDRPOU>'
+            f'<ADDRESS>01001, м.Київ, вул. Хрещатик, {index}</ADDRESS><BOSS>ІВАНОВ ІВАН</BOSS>'
+            f'<KVED>62.01 Комп\'ютерне програмування</KVED><STAN>зареєстровано</STAN>'
+            f'<FOUNDERS><FOUNDER>ІВАНОВ ІВАН, розмір частки - 1000,00</FOUNDER>'
+            f'<FOUNDER>ПЕТРОВ ПЕТРО, розмір частки - 2000,00</FOUNDER></FOUNDERS>'
+            f'<BENEFICIARIES><BENEFICIARY>ІВАНОВ ІВАН, Україна</BENEFICIARY></BENEFICIARIES></RECORD>'
+        ) for index in range(count)]
+
+    def extract_with_xpath(self, record):
+        name = record.xpath('NAME')[0].text
+        edrpou = record.xpath('EDRPOU')[0].text
+        if not name or not edrpou:
+            return None
+        short_name = record.xpath('SHORT_NAME')[0].text
+        boss = record.xpath('BOSS')[0].text
+        return {
+            'name': name.lower(),
+            'short_name': short_name.lower() if short_name else short_name,
+            'edrpou': edrpou,
+            'address': record.xpath('ADDRESS')[0].text,
+            'status': record.xpath('STAN')[0].text,
+            'boss': boss.lower() if boss else boss,
+            'kved': record.xpath('KVED')[0].text,
+            'founders': [item.text for item in record.xpath('FOUNDERS')[0]],
+            'beneficiaries': [item.text for item in record.xpath('BENEFICIARIES')[0]],
+        }
+
+    def handle(self, *args, **options):
+        count = options['count']
+        records = self.get_records(count)
+        schema = UkrCompanyConverter.RECORD_SCHEMA
+        assert self.extract_with_xpath(records[0]) == schema.extract(records[0])
+        for name, extract in (
+            ('xpath', self.extract_with_xpath),
+            ('RecordSchema', schema.extract),
+        ):
+            start_time = time.time()
+            for record in records:
+                extract(record)
+            seconds = time.time() - start_time
+            self.stdout.write(f'{name}: {count} records in {seconds:.2f} s, '
+                              f'{count / seconds:.0f} records/s')
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.12 on 2021-07-05 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_ocean', '0028_register_name_in_daily_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='records_skipped',
+            field=models.IntegerField(blank=True, default=0),
+        ),
+    ]
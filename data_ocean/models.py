@@ -5,7 +5,14 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
-class DataOceanManager(models.Manager):
+class DataOceanQuerySet(models.QuerySet):
+    def soft_delete(self):
+        """Marks all objects of the queryset as deleted with one UPDATE, returns the number of them"""
+        now = timezone.now()
+        return self.filter(deleted_at__isnull=True).update(deleted_at=now, updated_at=now)
+
+
+class DataOceanManager(models.Manager.from_queryset(DataOceanQuerySet)):
     # exclude soft-deleted objects from queryset
     def get_queryset(self):
         return super().get_queryset().exclude(deleted_at__isnull=False)
@@ -34,6 +41,22 @@ class DataOceanModel(models.Model):
             self.deleted_at = timezone.now()
             self.save(update_fields=['deleted_at', 'updated_at'])
 
+    @classmethod
+    def bulk_soft_delete(cls, ids, children=()):
+        """
+        Marks objects with the ids and objects of children models that refer to them as deleted
+        with one `UPDATE ... WHERE ... = ANY(...)` statement for each table.
+        Returns the number of deleted objects.
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        for child_model in children:
+            foreign_key = next(field for field in child_model._meta.concrete_fields
+                               if field.is_relation and field.related_model is cls)
+            child_model.objects.filter(**{f'{foreign_key.name}__any': ids}).soft_delete()
+        return cls.objects.filter(id__any=ids).soft_delete()
+
     @classmethod
     def truncate(cls):
         with connection.cursor() as c:
@@ -134,8 +157,13 @@ class Report(DataOceanModel):
     records_added = models.IntegerField(blank=True, default=0)
     records_changed = models.IntegerField(blank=True, default=0)
     records_deleted = models.IntegerField(blank=True, default=0)
+    records_skipped = models.IntegerField(blank=True, default=0)
     invalid_data = models.IntegerField(blank=True, default=0)
 
+    # the number of records saved by the converter and the byte offset of the end of the last one in the source
+    checkpoint_index = models.PositiveIntegerField(blank=True, default=0)
+    checkpoint_offset = models.BigIntegerField(blank=True, default=0)
+
     @staticmethod
     def collect_last_day_reports():
         day_ago = timezone.now() - timezone.timedelta(hours=24)
@@ -0,0 +1,62 @@
+class RecordField:
+    """
+    Child tag of the record and the key of its value in the extracted dict.
+    transform is applied to not empty text only, a record with an empty required field is invalid.
+    With schema the value is the dict extracted from the child, with many it is the list of values
+    of all children of the child, e.g. texts of FOUNDERS/FOUNDER or dicts of ACTIVITY_KINDS/ACTIVITY_KIND.
+    """
+    __slots__ = ('tag', 'name', 'transform', 'required', 'schema', 'many')
+
+    def __init__(self, tag, name, transform=None, required=False, schema=None, many=False):
+        self.tag = tag
+        self.name = name
+        self.transform = transform
+        self.required = required
+        self.schema = schema
+        self.many = many
+
+    def get_text(self, element):
+        text = element.text
+        if text and self.transform:
+            return self.transform(text)
+        return text
+
+    def get_value(self, element):
+        if self.schema:
+            if self.many:
+                items = (self.schema.extract(child) for child in element)
+                return [item for item in items if item is not None]
+            return self.schema.extract(element) if len(element) else None
+        if self.many:
+            return [self.get_text(child) for child in element]
+        return self.get_text(element)
+
+
+class RecordSchema:
+    """
+    Declarative description of a record, compiled into a one-pass extractor.
+    extract walks the children of the element once, instead of compiling and evaluating
+    an XPath expression for every field, and returns a plain dict with a value for every field
+    (None or an empty list for missing tags) or None if a required field is empty.
+    Tags of the fields must be unique among the children of the element.
+    """
+
+    def __init__(self, *fields):
+        self.fields = {field.tag: field for field in fields}
+        self.defaults = {field.name: None for field in fields}
+        self.list_names = [field.name for field in fields if field.many]
+        self.required = [field.name for field in fields if field.required]
+
+    def extract(self, element):
+        data = self.defaults.copy()
+        for name in self.list_names:
+            data[name] = []
+        fields = self.fields
+        for child in element:
+            field = fields.get(child.tag)
+            if field is not None:
+                data[field.name] = field.get_value(child)
+        for name in self.required:
+            if not data[name]:
+                return None
+        return data
@@ -1,7 +1,26 @@
+import base64
+import datetime
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
 from django.test import SimpleTestCase
+from lxml import etree
 
+from data_ocean.converter import (CleanXmlStream, Converter, CopyBulkCreateManager, IdTracker,
+                                  TransactionBulkCreateManager)
+from data_ocean.dimension_cache import DimensionCache, get_dimension_cache
+from data_ocean.downloader import Downloader
+from data_ocean.models import Status
+from data_ocean.record_schema import RecordField, RecordSchema
 from data_ocean.transliteration.utils import transliterate, translate_company_type_in_string,\
     translate_country_in_string, translate_last_position_in_string
+from location_register.models.ratu_models import RatuDistrict, RatuRegion
 
 
 class TransliterateTestCase(SimpleTestCase):
@@ -150,3 +169,387 @@ class TransliterateTestCase(SimpleTestCase):
         )
         for tested, expected in variants:
             self.assertEqual(transliterate(translate_last_position_in_string(tested)), expected)
+
+
+class ParallelTestConverter(Converter):
+    RECORD_TAG = 'RECORD'
+    PARTITION_TAG = 'KEY'
+    CHUNK_SIZE = 3
+
+    def __init__(self):
+        # the base __init__ reads countries from DB, parallel mode does not need them
+        self.saved = []
+
+    def save_to_db(self, records):
+        for record in records:
+            self.saved.append((record.xpath('KEY')[0].text, record.xpath('VALUE')[0].text))
+
+    def get_worker_state(self):
+        return self.saved
+
+    def merge_worker_state(self, state):
+        self.saved.extend(state)
+
+
+class KilledWorkerTestConverter(ParallelTestConverter):
+    def save_to_db(self, records):
+        # a worker killed by the OS posts no result
+        os._exit(1)
+
+
+class ConverterProcessInParallelTestCase(SimpleTestCase):
+    def test_process_in_parallel(self):
+        converter = ParallelTestConverter()
+        self.assertTrue(self.process_in_parallel(converter))
+        self.assertEqual(sorted(int(value) for _, value in converter.saved), list(range(50)))
+        # records with the same key keep their order, because only one worker saves them
+        for key in range(7):
+            values = [int(value) for saved_key, value in converter.saved if saved_key == str(key)]
+            self.assertEqual(values, sorted(values))
+
+    def process_in_parallel(self, converter, start_index=0):
+        records = ''.join(
+            f'<RECORD><KEY>{i % 7}</KEY><VALUE>{i}</VALUE></RECORD>' for i in range(50)
+        )
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'source.xml'), 'w') as file:
+                file.write(f'<DATA>{records}</DATA>')
+            converter.LOCAL_FOLDER = folder + '/'
+            converter.LOCAL_FILE_NAME = 'source.xml'
+            return converter.process_in_parallel(3, start_index)
+
+    def test_start_index(self):
+        converter = ParallelTestConverter()
+        self.assertTrue(self.process_in_parallel(converter, start_index=20))
+        self.assertEqual(sorted(int(value) for _, value in converter.saved), list(range(20, 50)))
+
+    def test_killed_worker(self):
+        converter = KilledWorkerTestConverter()
+        self.assertFalse(self.process_in_parallel(converter))
+
+
+class CopyValueTestCase(SimpleTestCase):
+    def test_to_copy_value(self):
+        to_copy_value = CopyBulkCreateManager.to_copy_value
+        self.assertEqual(to_copy_value(None), '\\N')
+        self.assertEqual(to_copy_value(''), '')
+        self.assertEqual(to_copy_value(True), 't')
+        self.assertEqual(to_copy_value(2.5), '2.5')
+        self.assertEqual(to_copy_value(datetime.date(2021, 7, 1)), '2021-07-01')
+        self.assertEqual(to_copy_value('a\tb\nc\\N'), 'a\\tb\\nc\\\\N')
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves server.content supporting Range header, the first server.broken_responses responses are cut"""
+
+    def do_GET(self):
+        content = self.server.content
+        start, end = 0, len(content) - 1
+        requested_range = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if requested_range and self.server.ranges:
+            start = int(requested_range.group(1))
+            if requested_range.group(2):
+                end = min(int(requested_range.group(2)), end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+        else:
+            self.send_response(200)
+            self.send_header('Content-MD5', base64.b64encode(hashlib.md5(content).digest()).decode())
+        body = content[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with self.server.lock:
+            is_broken = self.server.broken_responses > 0 and len(body) > 1
+            if is_broken:
+                self.server.broken_responses -= 1
+        self.wfile.write(body[:len(body) // 2] if is_broken else body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloader(Downloader):
+    reg_name = 'test'
+    file_name = 'source.zip'
+    chunk_size = 1024
+    retry_delay = 0
+
+    def __init__(self, url, local_path, segments):
+        self.url = url
+        self.local_path = local_path
+        self.segments = segments
+        super().__init__()
+        self.report = mock.Mock()
+
+
+class DownloaderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.content = os.urandom(100 * 1024 + 7)
+        self.server.broken_responses = 0
+        self.server.ranges = True
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def download(self, segments, broken_responses=0, ranges=True):
+        self.server.broken_responses = broken_responses
+        self.server.ranges = ranges
+        downloader = TestDownloader(
+            f'http://127.0.0.1:{self.server.server_port}/source.zip', self.folder.name + '/', segments
+        )
+        downloader.download()
+        with open(downloader.file_path, 'rb') as file:
+            self.assertEqual(file.read(), self.server.content)
+        self.assertEqual(downloader.report.download_file_length, len(self.server.content))
+        return downloader
+
+    def test_download_resumes_after_broken_response(self):
+        downloader = self.download(segments=1, broken_responses=2)
+        self.assertTrue(downloader.file_md5)
+
+    def test_download_segments(self):
+        self.download(segments=4)
+        self.download(segments=4, broken_responses=3)
+
+    def test_download_without_ranges(self):
+        self.download(segments=4, ranges=False)
+
+    def test_source_file_current(self):
+        downloader = self.download(segments=1)
+        report = mock.Mock(download_file_name=downloader.file_path, download_file_length=len(self.server.content))
+        self.assertTrue(downloader.is_source_file_current(report))
+        self.server.ranges = False
+        self.assertTrue(downloader.is_source_file_current(report))
+        # a new file is published under the same name
+        self.server.content += b'new'
+        self.assertFalse(downloader.is_source_file_current(report))
+        report.download_file_name = downloader.file_path + '.old'
+        self.assertFalse(downloader.is_source_file_current(report))
+
+
+class CleanXmlStreamTestCase(SimpleTestCase):
+    xml = (
+        '<?xml version="1.0" encoding="windows-1251"?>'
+        '<DATA><RECORD><NAME>ТОВ &quot;Ромашка&#30;&quot;</NAME></RECORD>'
+        '<RECORD><NAME>Фермерське&#3; господарство</NAME></RECORD></DATA>'
+    )
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.folder.name, 'source.zip')
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr('source.xml', self.xml.encode('cp1251'))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def parse(self):
+        # a tiny read size splits the XML declaration and the replaced entities between reads
+        with CleanXmlStream(self.zip_path, 'source.xml', read_size=5) as source:
+            return [elem.findtext('NAME') for _, elem in etree.iterparse(source, tag='RECORD')]
+
+    def test_parse(self):
+        self.assertEqual(self.parse(), ['ТОВ "Ромашка"', 'Фермерське господарство'])
+
+    def test_bad_crc(self):
+        with open(self.zip_path, 'rb') as file:
+            data = file.read()
+        with open(self.zip_path, 'wb') as file:
+            file.write(data.replace('Ромашка'.encode('cp1251'), 'Ромашки'.encode('cp1251')))
+        with self.assertRaises(zipfile.BadZipFile):
+            self.parse()
+
+
+class ResumedTestConverter(Converter):
+    RECORD_TAG = 'RECORD'
+    CHUNK_SIZE = 3
+
+    def __init__(self, fail_at_chunk=None):
+        self.saved = []
+        self.marked = []
+        self.chunks = 0
+        self.fail_at_chunk = fail_at_chunk
+        self.outdated_deleted = False
+
+    def save_to_db(self, records):
+        self.chunks += 1
+        if self.chunks == self.fail_at_chunk:
+            raise Exception('DB is gone')
+        self.saved.extend(int(record.findtext('VALUE')) for record in records)
+
+    def mark_seen(self, records):
+        self.marked.extend(int(record.findtext('VALUE')) for record in records)
+
+    def delete_outdated(self):
+        self.outdated_deleted = True
+
+
+class ConverterResumeTestCase(SimpleTestCase):
+    xml = '<?xml version="1.0" encoding="windows-1251"?>\n<DATA>\n{}\n</DATA>'.format(
+        '\n'.join(f'<RECORD><VALUE>{i}</VALUE><NAME>Запис {i}</NAME></RECORD>' for i in range(20))
+    )
+
+    def get_converter(self, folder, report, zip_file_name=None, fail_at_chunk=None):
+        converter = ResumedTestConverter(fail_at_chunk)
+        converter.LOCAL_FOLDER = folder + '/'
+        converter.LOCAL_FILE_NAME = 'source.xml'
+        converter.SOURCE_ZIP_FILE_NAME = zip_file_name
+        converter.report = report
+        return converter
+
+    def process_with_failure(self, folder, zip_file_name=None):
+        report = mock.Mock(checkpoint_index=0, checkpoint_offset=0)
+        converter = self.get_converter(folder, report, zip_file_name, fail_at_chunk=4)
+        self.assertFalse(converter.process(resume=True))
+        self.assertEqual(converter.saved, list(range(9)))
+        self.assertEqual(report.checkpoint_index, 9)
+
+        resumed = self.get_converter(folder, report, zip_file_name)
+        self.assertTrue(resumed.process(resume=True))
+        self.assertEqual(resumed.saved, list(range(9, 20)))
+        self.assertEqual(report.checkpoint_index, 20)
+        # records saved before the failure are marked, so outdated ones can be deleted
+        self.assertEqual(resumed.marked, list(range(9)))
+        self.assertTrue(resumed.outdated_deleted)
+
+    def test_resume_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'source.xml'), 'wb') as file:
+                file.write(self.xml.encode('cp1251'))
+            self.process_with_failure(folder)
+
+    def test_resume_zip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with zipfile.ZipFile(os.path.join(folder, 'source.zip'), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr('source.xml', self.xml.encode('cp1251'))
+            self.process_with_failure(folder, 'source.zip')
+
+    def test_resume_without_mark_seen(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'source.xml'), 'wb') as file:
+                file.write(self.xml.encode('cp1251'))
+            report = mock.Mock(checkpoint_index=9, checkpoint_offset=self.xml.index('<RECORD><VALUE>9<'))
+            converter = self.get_converter(folder, report)
+            with mock.patch.object(converter, 'mark_seen', side_effect=NotImplementedError):
+                self.assertTrue(converter.process(resume=True))
+        self.assertEqual(converter.saved, list(range(9, 20)))
+        self.assertFalse(converter.outdated_deleted)
+
+    def test_resume_in_parallel(self):
+        converter = self.get_converter('', mock.Mock(checkpoint_index=9, checkpoint_offset=100))
+        converter.WORKERS = 2
+        with self.assertRaises(ValueError):
+            converter.process(resume=True)
+
+
+class RecordSchemaTestCase(SimpleTestCase):
+    schema = RecordSchema(
+        RecordField('NAME', 'name', str.lower, required=True),
+        RecordField('CAPITAL', 'capital', float),
+        RecordField('FOUNDERS', 'founders', many=True),
+        RecordField('ACTIVITY_KINDS', 'kveds', many=True, schema=RecordSchema(
+            RecordField('CODE', 'code', required=True),
+            RecordField('PRIMARY', 'is_primary', lambda value: value == 'так'),
+        )),
+        RecordField('TERMINATION_STARTED_INFO', 'termination', schema=RecordSchema(
+            RecordField('OP_DATE', 'op_date'),
+        )),
+    )
+
+    def test_extract(self):
+        record = etree.fromstring(
+            '<RECORD><NAME>ТОВ РОМАШКА</NAME><CAPITAL>100.5</CAPITAL><EXTRA>1</EXTRA>'
+            '<FOUNDERS><FOUNDER>Іванов</FOUNDER><FOUNDER>Петров</FOUNDER></FOUNDERS>'
+            '<ACTIVITY_KINDS><ACTIVITY_KIND><CODE>01.11</CODE><PRIMARY>так</PRIMARY></ACTIVITY_KIND>'
+            '<ACTIVITY_KIND><CODE/><PRIMARY>ні</PRIMARY></ACTIVITY_KIND></ACTIVITY_KINDS>'
+            '<TERMINATION_STARTED_INFO/></RECORD>'
+        )
+        self.assertEqual(self.schema.extract(record), {
+            'name': 'тов ромашка',
+            'capital': 100.5,
+            'founders': ['Іванов', 'Петров'],
+            'kveds': [{'code': '01.11', 'is_primary': True}],
+            'termination': None,
+        })
+
+    def test_missing_and_required(self):
+        self.assertEqual(self.schema.extract(etree.fromstring('<RECORD><NAME>Ромашка</NAME></RECORD>')), {
+            'name': 'ромашка', 'capital': None, 'founders': [], 'kveds': [], 'termination': None,
+        })
+        self.assertIsNone(self.schema.extract(etree.fromstring('<RECORD><NAME/></RECORD>')))
+
+
+class DimensionCacheTestCase(SimpleTestCase):
+    def test_resolve(self):
+        cache = DimensionCache(Status)
+        cache.ids = {'зареєстровано': 1}
+        with mock.patch.object(cache, 'insert', return_value={'припинено': 2, 'скасовано': 3}) as insert:
+            cache.resolve(['зареєстровано', 'припинено', 'скасовано', 'припинено', None])
+            status = cache.get('припинено')
+        insert.assert_called_once_with({'припинено', 'скасовано'})
+        self.assertEqual((status.id, status.name), (2, 'припинено'))
+        self.assertIs(cache.get('припинено'), status)
+        self.assertEqual(cache.get_id('зареєстровано'), 1)
+        self.assertIsNone(cache.get(None))
+
+    def test_clear_for_new_run(self):
+        cache = get_dimension_cache(Status)
+        cache.ids = {'зареєстровано': 1}
+        cache.get('зареєстровано')
+        ResumedTestConverter().clear_caches()
+        # converters keep the same cache, it is loaded again on the next use
+        self.assertIs(get_dimension_cache(Status), cache)
+        self.assertIsNone(cache.ids)
+        self.assertEqual(cache.objects, {})
+
+
+class IdTrackerTestCase(SimpleTestCase):
+    def test_unseen_ids(self):
+        tracker = IdTracker([1, 7, 8, 100, 1500000])
+        tracker.mark(7)
+        tracker.mark(100)
+        # ids stored during the update are not outdated
+        tracker.mark(2000000)
+        worker_tracker = IdTracker()
+        worker_tracker.mark(8)
+        tracker.merge(worker_tracker)
+        self.assertEqual(tracker.get_unseen_ids(), [1, 1500000])
+        self.assertTrue(tracker.is_stored(1500000))
+        self.assertFalse(tracker.is_stored(2000000))
+        self.assertLess(len(tracker.stored) + len(tracker.seen), 1000000)
+
+
+class TransactionBulkCreateManagerTestCase(SimpleTestCase):
+    def test_commit_all(self):
+        bulk_manager = TransactionBulkCreateManager()
+        region = RatuRegion(name='київська')
+        # the child is queued before its parent
+        bulk_manager.add(RatuDistrict(region=region, name='бучанський', code='київськабучанський'))
+        bulk_manager.add(region)
+        self.assertEqual(bulk_manager.get_models_in_order(), [RatuRegion, RatuDistrict])
+        created = []
+
+        def bulk_create(objs):
+            for i, obj in enumerate(objs):
+                obj.id = 100 + i
+                created.append((type(obj), obj.id, getattr(obj, 'region_id', None)))
+
+        with mock.patch.object(RatuRegion, 'objects') as regions, \
+                mock.patch.object(RatuDistrict, 'objects') as districts, \
+                mock.patch('data_ocean.converter.transaction'):
+            regions.bulk_create.side_effect = districts.bulk_create.side_effect = bulk_create
+            self.assertEqual(bulk_manager.commit_all(), 2)
+        self.assertEqual(created, [(RatuRegion, 100, None), (RatuDistrict, 100, 100)])
+        self.assertFalse(bulk_manager.queues)
+
+    def test_not_saved_parent(self):
+        bulk_manager = TransactionBulkCreateManager()
+        bulk_manager.add(RatuDistrict(region=RatuRegion(name='київська'), name='бучанський'))
+        with self.assertRaises(ValueError):
+            bulk_manager.commit(RatuDistrict)
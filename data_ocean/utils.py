@@ -7,6 +7,7 @@ import datetime
 import os
 import re
 import sys
+from collections import defaultdict
 
 # changing to lowercase, deleting 'р.', 'м.', 'с.', 'смт.', 'смт', 'сщ.', 'с/рада.', 'сщ/рада.', /
 # 'вул.' from a string
@@ -114,6 +115,13 @@ class Timer():
         self.previous = datetime.datetime.now()
         self.times_dict = {}
         self.times_dict['total\t\t\t'] = datetime.timedelta()
+        self.queries_dict = defaultdict(int)
+        self.queries = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        """DB execute wrapper, counts queries made in the period"""
+        self.queries += 1
+        return execute(sql, params, many, context)
 
     def time_it(self, period_name: str):
         now = datetime.datetime.now()
@@ -122,6 +130,9 @@ class Timer():
         else:
             self.times_dict[period_name] = now - self.previous
         self.times_dict['total\t\t\t'] += now - self.previous
+        self.queries_dict[period_name] += self.queries
+        self.queries_dict['total\t\t\t'] += self.queries
+        self.queries = 0
         self.previous = now
 
     def print_result(self):
@@ -130,7 +141,8 @@ class Timer():
         print('----------------------------------------------------------------------------------')
         for period_name, value in self.times_dict.items():
             print(period_name, '\t', str(value).split(".")[0], '\t',
-                  round(value / self.times_dict['total\t\t\t'] * 100, 2), '%')
+                  round(value / self.times_dict['total\t\t\t'] * 100, 2), '%', '\t',
+                  self.queries_dict[period_name], 'queries')
         print('----------------------------------------------------------------------------------')
 
 
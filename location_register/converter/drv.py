@@ -2,13 +2,20 @@
 
 import logging
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from zeep import Client, Settings
+from zeep.exceptions import TransportError
 from zeep.helpers import serialize_object
 
-from data_ocean.converter import Converter
+from data_ocean.converter import Converter, IdTracker
 from data_ocean.downloader import Downloader
 from data_ocean.utils import clean_name, change_to_full_name
 from location_register.models.drv_models import (DrvAto, DrvBuilding,
@@ -19,47 +26,104 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-class DrvConverter(Converter):
-    WSDL_URL = settings.LOCATION_DRV_WSDL_URL
-    # WSDL_URL = 'https://www.drv.gov.ua/ords/svc/personal/API/Opendata'
-    SETTINGS = Settings(strict=settings.LOCATION_DRV_STRICT, xml_huge_tree=settings.LOCATION_DRV_XML_HUGE_TREE)
+class DrvHarvester:
+    """
+    Gets data from the SOAP services of DRV.
+    The WSDL is parsed once for the process and every service is bound once, requests are retried
+    after network errors with the doubled delay. fetch_all spreads requests over the pool of threads.
+    """
+    # parsed WSDLs and bound services, shared by all harvesters of the process
+    clients = {}
+    services = {}
+    lock = threading.Lock()
+
+    def __init__(self, wsdl_url=settings.LOCATION_DRV_WSDL_URL, threads=settings.LOCATION_DRV_THREADS,
+                 attempts=settings.LOCATION_DRV_ATTEMPTS, retry_delay=settings.LOCATION_DRV_RETRY_DELAY):
+        self.wsdl_url = wsdl_url
+        self.threads = threads
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.settings = Settings(strict=settings.LOCATION_DRV_STRICT,
+                                 xml_huge_tree=settings.LOCATION_DRV_XML_HUGE_TREE)
+
+    def get_service(self, service_name):
+        key = (self.wsdl_url, service_name)
+        with self.lock:
+            if key not in self.services:
+                if self.wsdl_url not in self.clients:
+                    self.clients[self.wsdl_url] = Client(self.wsdl_url, settings=self.settings)
+                self.services[key] = self.clients[self.wsdl_url].bind(service_name)
+            return self.services[key]
+
+    def call(self, service_name, operation, **params):
+        """Returns the response converted to Python ordered dictionary"""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                response = getattr(self.get_service(service_name), operation)(**params)
+                return serialize_object(response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, TransportError) as e:
+                if attempt == self.attempts:
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(f'location_drv: {operation}{params}: {e}, attempt {attempt} of {self.attempts} '
+                               f'failed, retry in {delay} s ...')
+                time.sleep(delay)
+
+    def get_regions(self):
+        return self.call('GetRegionsService', 'GetRegions')['Region']
+
+    def get_atos(self, region_code):
+        return self.call('GetATUUService', 'ATUUQuery', ATOParams=region_code)['ATO']
+
+    def get_streets(self, ato_code):
+        return self.call('GetAdrRegService', 'AdrRegQuery', AdrRegParams=ato_code)['GEONIM']
 
-    # SETTINGS = Settings(strict=False, xml_huge_tree=True)
+    def fetch_all(self, executor, fetch, items):
+        """
+        Yields pairs of items and results of fetch(item) in the order of items.
+        Up to twice as many requests as threads are in progress or done and not yet yielded,
+        so the pool is busy while the caller saves the results, but responses don't pile up.
+        """
+        futures = deque()
+        for item in items:
+            futures.append((item, executor.submit(fetch, item)))
+            if len(futures) >= self.threads * 2:
+                item, future = futures.popleft()
+                yield item, future.result()
+        while futures:
+            item, future = futures.popleft()
+            yield item, future.result()
+
+
+class DrvConverter(Converter):
+    BUILDINGS_BATCH_SIZE = 5000
 
     def __init__(self):
         """
         declaring as class fields and initialising dictionaries for storing all objects from DB
 
         """
+        self.harvester = DrvHarvester()
         self.invalid_data_counter = 0
         self.regions_dict = self.put_objects_to_dict('name', 'location_register', 'DrvRegion')
         self.districts_dict = self.put_objects_to_dict('code', 'location_register', 'DrvDistrict')
-        self.outdated_districts_dict = self.put_objects_to_dict('code',
-                                                                'location_register',
-                                                                'DrvDistrict')
+        self.districts_tracker = IdTracker(district.id for district in self.districts_dict.values())
         self.councils_dict = self.put_objects_to_dict('code', 'location_register', 'DrvCouncil')
-        self.outdated_councils_dict = self.put_objects_to_dict('code', 'location_register', 'DrvCouncil')
+        self.councils_tracker = IdTracker(council.id for council in self.councils_dict.values())
         self.atos_dict = self.put_objects_to_dict('code', 'location_register', 'DrvAto')
-        self.outdated_atos_dict = self.put_objects_to_dict('code', 'location_register', 'DrvAto')
+        self.atos_tracker = IdTracker(ato.id for ato in self.atos_dict.values())
         self.streets_dict = self.put_objects_to_dict('code', 'location_register', 'DrvStreet')
-        self.outdated_streets_dict = self.put_objects_to_dict('code', 'location_register', 'DrvStreet')
+        self.streets_tracker = IdTracker(street.id for street in self.streets_dict.values())
         self.zipcodes_dict = self.put_objects_to_dict('code', 'location_register', 'ZipCode')
-        self.outdated_zipcodes_dict = self.put_objects_to_dict('code', 'location_register', 'ZipCode')
-        self.outdated_buildings_list = list(DrvBuilding.objects.values_list('id', flat=True))
+        self.zipcodes_tracker = IdTracker(zipcode.id for zipcode in self.zipcodes_dict.values())
+        self.buildings_tracker = IdTracker(DrvBuilding.objects.values_list('id', flat=True).iterator())
 
         super().__init__()
 
-    def parse_regions_data(self):
-        client = Client(self.WSDL_URL, service_name='GetRegionsService', settings=self.SETTINGS)
-        response = client.service.GetRegions()
-        # converting zeep object to Python ordered dictionary
-        response_to_dict = serialize_object(response)
-        # accessing a nested list with regions data as dictionaries
-        return response_to_dict['Region']
-
     # Regions can be renamed only via constitutional amendments, so we use name as unique identifier
     # and updating only codes, numbers and short_names)
     def save_region_data(self, regions_data_list):
+        regions = []
         for dictionary in regions_data_list:
             code = str(dictionary['Region_Id'])
             number = dictionary['Region_Num']
@@ -92,18 +156,12 @@ class DrvConverter(Converter):
                     capital=capital
                 )
                 self.regions_dict[name] = region
-            atos_data_list = self.parse_atos_data(region)
-            self.save_ato_data(atos_data_list, region)
-
-    def parse_atos_data(self, region):
-        client = Client(self.WSDL_URL, service_name='GetATUUService', settings=self.SETTINGS)
-        response = client.service.ATUUQuery(ATOParams=region.code)
-        # converting zeep object to Python ordered dictionary
-        response_to_dict = serialize_object(response)
-        # accessing a nested list with ATO data as dictionaries
-        return response_to_dict['ATO']
+            regions.append(region)
+        return regions
 
     def save_ato_data(self, atos_data_list, region):
+        """Returns saved ATOs with their districts and councils"""
+        atos = []
         for dictionary in atos_data_list:
             district_name = dictionary['ATO_Raj']
             district_name = change_to_full_name(district_name)
@@ -116,8 +174,7 @@ class DrvConverter(Converter):
             ato_code = str(dictionary['ATO_Id'])
             district = self.districts_dict.get(district_code)
             if district:
-                if self.outdated_districts_dict.get(district_code):
-                    del self.outdated_districts_dict[district_code]
+                self.districts_tracker.mark(district.id)
             else:
                 district = DrvDistrict.objects.create(
                     region=region,
@@ -127,8 +184,7 @@ class DrvConverter(Converter):
                 self.districts_dict[district_code] = district
             council = self.councils_dict.get(council_code)
             if council:
-                if self.outdated_councils_dict.get(council_code):
-                    del self.outdated_councils_dict[council_code]
+                self.councils_tracker.mark(council.id)
             else:
                 council = DrvCouncil.objects.create(
                     region=region,
@@ -154,8 +210,7 @@ class DrvConverter(Converter):
                 if update_fields:
                     update_fields.append('updated_at')
                     ato.save(update_fields=update_fields)
-                if self.outdated_atos_dict.get(ato_code):
-                    del self.outdated_atos_dict[ato_code]
+                self.atos_tracker.mark(ato.id)
             else:
                 ato = DrvAto.objects.create(
                     region=region,
@@ -164,18 +219,11 @@ class DrvConverter(Converter):
                     name=ato_name,
                     code=ato_code)
                 self.atos_dict[ato_code] = ato
-            streets_data_list = self.parse_streets_data(ato)
-            self.save_street_data(streets_data_list, region, district, council, ato)
-
-    def parse_streets_data(self, ato):
-        client = Client(self.WSDL_URL, service_name='GetAdrRegService', settings=self.SETTINGS)
-        response = client.service.AdrRegQuery(AdrRegParams=ato.code)
-        # converting zeep object to Python ordered dictionary
-        response_to_dict = serialize_object(response)
-        # accessing a nested list with ATO data as dictionaries
-        return response_to_dict['GEONIM']
+            atos.append((ato, district, council))
+        return atos
 
     def save_street_data(self, streets_data_list, region, district, council, ato):
+        buildings_data_list = []
         for dictionary in streets_data_list:
             code = str(dictionary['Geon_Id'])
             name = dictionary['Geon_Name']
@@ -185,10 +233,10 @@ class DrvConverter(Converter):
                 previous_name = change_to_full_name(previous_name)
             buildings_info = dictionary['BUILDS']
             number_of_buildings = None
-            buildings_data_list = None
+            street_buildings_data_list = None
             if buildings_info:
                 number_of_buildings = dictionary['BUILDS']['BUILDS_COUNT']
-                buildings_data_list = dictionary['BUILDS']['BUILD']
+                street_buildings_data_list = dictionary['BUILDS']['BUILD']
             street = self.streets_dict.get(code)
             if street:
                 update_fields = []
@@ -216,8 +264,7 @@ class DrvConverter(Converter):
                 if update_fields:
                     update_fields.append('updated_at')
                     street.save(update_fields=update_fields)
-                if self.outdated_streets_dict.get(code):
-                    del self.outdated_streets_dict[code]
+                self.streets_tracker.mark(street.id)
             else:
                 street = DrvStreet.objects.create(
                     region=region,
@@ -230,11 +277,52 @@ class DrvConverter(Converter):
                     number_of_buildings=number_of_buildings
                 )
                 self.streets_dict[code] = street
-            if buildings_data_list:
-                self.save_building_data(buildings_data_list, region, district, council, ato, street)
+            if street_buildings_data_list:
+                buildings_data_list.extend((building_data, street) for building_data in street_buildings_data_list)
+        if buildings_data_list:
+            self.save_building_data(buildings_data_list, region, district, council, ato)
 
-    def save_building_data(self, buildings_data_list, region, district, council, ato, street):
-        for dictionary in buildings_data_list:
+    def save_zip_codes(self, zip_codes_values, region, district, council, ato):
+        """
+        Stores new zip codes of the ATO and moves changed ones to it with one
+        INSERT ... ON CONFLICT DO UPDATE statement, soft deleted zip codes are restored
+        """
+        values_to_save = []
+        for value in zip_codes_values:
+            zip_code = self.zipcodes_dict.get(value)
+            if (not zip_code or (zip_code.region_id, zip_code.district_id, zip_code.council_id, zip_code.ato_id)
+                    != (region.id, district.id, council.id, ato.id)):
+                values_to_save.append(value)
+            else:
+                self.zipcodes_tracker.mark(zip_code.id)
+        if not values_to_save:
+            return
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {ZipCode._meta.db_table} '
+                f'(code, region_id, district_id, council_id, ato_id, created_at, updated_at) '
+                f'SELECT code, %s, %s, %s, %s, %s, %s FROM unnest(%s::text[]) AS code '
+                f'ON CONFLICT (code) DO UPDATE SET region_id = EXCLUDED.region_id, '
+                f'district_id = EXCLUDED.district_id, council_id = EXCLUDED.council_id, '
+                f'ato_id = EXCLUDED.ato_id, updated_at = EXCLUDED.updated_at, deleted_at = NULL '
+                f'RETURNING id, code',
+                [region.id, district.id, council.id, ato.id, now, now, values_to_save]
+            )
+            for zip_code_id, value in cursor.fetchall():
+                self.zipcodes_dict[value] = ZipCode(id=zip_code_id, code=value, region_id=region.id,
+                                                    district_id=district.id, council_id=council.id,
+                                                    ato_id=ato.id)
+                self.zipcodes_tracker.mark(zip_code_id)
+
+    def save_building_data(self, buildings_data_list, region, district, council, ato):
+        """
+        Saves buildings of all streets of the ATO, buildings_data_list is a list of pairs of dictionaries
+        with the data of the building and its street. Stored buildings of every batch are got with one query,
+        new ones are created and changed ones are updated with bulk statements.
+        """
+        buildings = []
+        for dictionary, street in buildings_data_list:
             code = str(dictionary['Bld_ID'])
             number = dictionary['Bld_Num']
             if not number:
@@ -246,97 +334,81 @@ class DrvConverter(Converter):
                 # uniting the building`s number and corps with '\'
                 number = number + '/' + corps
             zip_code_value = dictionary['Bld_Ind']
-            zip_code = self.zipcodes_dict.get(zip_code_value)
-            if zip_code:
-                update_fields = []
-                if zip_code.region_id != region.id:
-                    zip_code.region_id = region.id
-                    update_fields.append('region')
-                if zip_code.district_id != district.id:
-                    zip_code.district_id = district.id
-                    update_fields.append('district')
-                if zip_code.council_id != council.id:
-                    zip_code.council_id = council.id
-                    update_fields.append('council')
-                if zip_code.ato_id != ato.id:
-                    zip_code.ato_id = ato.id
-                    update_fields.append('ato')
-                if update_fields:
-                    update_fields.append('updated_at')
-                    zip_code.save(update_fields=update_fields)
-                if self.outdated_zipcodes_dict.get(zip_code_value):
-                    del self.outdated_zipcodes_dict[zip_code_value]
-            else:
-                zip_code = ZipCode.objects.create(
-                    region=region,
-                    district=district,
-                    council=council,
-                    ato=ato,
-                    code=zip_code_value)
-                self.zipcodes_dict[zip_code_value] = zip_code
-            building = DrvBuilding.objects.filter(code=code).first()
-            if building:
-                update_fields = []
-                if building.region_id != region.id:
-                    building.region_id = region.id
-                    update_fields.append('region')
-                if building.district_id != district.id:
-                    building.district_id = district.id
-                    update_fields.append('district')
-                if building.council_id != council.id:
-                    building.council_id = council.id
-                    update_fields.append('council')
-                if building.ato_id != ato.id:
-                    building.ato_id = ato.id
-                    update_fields.append('ato')
-                if building.street_id != street.id:
-                    building.street_id = street.id
-                    update_fields.append('street')
-                if building.zip_code_id != zip_code.id:
-                    building.zip_code_id = zip_code.id
-                    update_fields.append('zip_code')
-                if building.number != number:
-                    building.number = number
-                    update_fields.append('number')
-                if update_fields:
-                    update_fields.append('updated_at')
-                    building.save(update_fields=update_fields)
-                self.outdated_buildings_list.remove(building.id)
-            else:
-                building = DrvBuilding.objects.create(
-                    region=region,
-                    district=district,
-                    council=council,
-                    ato=ato,
-                    street=street,
-                    zip_code=zip_code,
-                    code=code,
-                    number=number
-                )
+            if not zip_code_value:
+                self.invalid_data_counter += 1
+                continue
+            buildings.append((code, number, zip_code_value, street))
+        self.save_zip_codes({zip_code_value for _, _, zip_code_value, _ in buildings},
+                            region, district, council, ato)
+        for i in range(0, len(buildings), self.BUILDINGS_BATCH_SIZE):
+            self.save_buildings_batch(buildings[i:i + self.BUILDINGS_BATCH_SIZE], region, district, council, ato)
+
+    def save_buildings_batch(self, buildings, region, district, council, ato):
+        stored_buildings = {building.code: building for building in DrvBuilding.include_deleted_objects.filter(
+            code__any=[code for code, _, _, _ in buildings]
+        )}
+        new_buildings = {}
+        changed_buildings = {}
+        for code, number, zip_code_value, street in buildings:
+            values = {
+                'region_id': region.id,
+                'district_id': district.id,
+                'council_id': council.id,
+                'ato_id': ato.id,
+                'street_id': street.id,
+                'zip_code_id': self.zipcodes_dict[zip_code_value].id,
+                'number': number,
+            }
+            building = stored_buildings.get(code) or new_buildings.get(code)
+            if not building:
+                new_buildings[code] = DrvBuilding(code=code, **values)
+                continue
+            is_changed = bool(building.deleted_at)
+            building.deleted_at = None
+            for field_name, value in values.items():
+                if getattr(building, field_name) != value:
+                    setattr(building, field_name, value)
+                    is_changed = True
+            if building.id:
+                self.buildings_tracker.mark(building.id)
+                if is_changed:
+                    changed_buildings[code] = building
+        if new_buildings:
+            DrvBuilding.objects.bulk_create(new_buildings.values())
+        if changed_buildings:
+            now = timezone.now()
+            for building in changed_buildings.values():
+                building.updated_at = now
+            DrvBuilding.include_deleted_objects.bulk_update(
+                changed_buildings.values(),
+                ['region', 'district', 'council', 'ato', 'street', 'zip_code', 'number', 'deleted_at', 'updated_at']
+            )
 
     def delete_outdated(self):
-        if self.outdated_districts_dict:
-            for district in self.outdated_districts_dict.values():
-                district.soft_delete()
-        if self.outdated_councils_dict:
-            for council in self.outdated_councils_dict.values():
-                council.soft_delete()
-        if self.outdated_atos_dict:
-            for ato in self.outdated_atos_dict.values():
-                ato.soft_delete()
-        if self.outdated_streets_dict:
-            for street in self.outdated_streets_dict.values():
-                street.soft_delete()
-        if self.outdated_zipcodes_dict:
-            for zipcode in self.outdated_zipcodes_dict.values():
-                zipcode.soft_delete()
-        if self.outdated_buildings_list:
-            for building_id in self.outdated_buildings_list:
-                DrvBuilding.objects.get(id=building_id).soft_delete()
+        DrvDistrict.bulk_soft_delete(self.districts_tracker.get_unseen_ids())
+        DrvCouncil.bulk_soft_delete(self.councils_tracker.get_unseen_ids())
+        DrvAto.bulk_soft_delete(self.atos_tracker.get_unseen_ids())
+        DrvStreet.bulk_soft_delete(self.streets_tracker.get_unseen_ids())
+        ZipCode.bulk_soft_delete(self.zipcodes_tracker.get_unseen_ids())
+        DrvBuilding.bulk_soft_delete(self.buildings_tracker.get_unseen_ids())
 
     def process(self):
-        regions_data = self.parse_regions_data()
-        self.save_region_data(regions_data)
+        """
+        Streets of ATOs and ATOs of regions are requested by the pool of threads,
+        while this thread saves the received data in the order of requests
+        """
+        regions = self.save_region_data(self.harvester.get_regions())
+        with ThreadPoolExecutor(max_workers=self.harvester.threads) as executor:
+            regions_atos = self.harvester.fetch_all(
+                executor, lambda region: self.harvester.get_atos(region.code), regions
+            )
+            for region, atos_data_list in regions_atos:
+                atos = self.save_ato_data(atos_data_list, region)
+                atos_streets = self.harvester.fetch_all(
+                    executor, lambda ato: self.harvester.get_streets(ato[0].code), atos
+                )
+                for (ato, district, council), streets_data_list in atos_streets:
+                    self.save_street_data(streets_data_list, region, district, council, ato)
         self.delete_outdated()
 
 
@@ -7,6 +7,7 @@ from django.utils import timezone
 
 from data_ocean.converter import Converter
 from data_ocean.downloader import Downloader
+from data_ocean.hierarchy_loader import HierarchyLoader
 from data_ocean.utils import clean_name, change_to_full_name, get_lowercase_substring_before_slash
 from location_register.models.koatuu_models import (KoatuuFirstLevel, KoatuuSecondLevel, KoatuuThirdLevel,
                                                     KoatuuFourthLevel, KoatuuCategory)
@@ -264,17 +265,32 @@ class KoatuuConverter(Converter):
 
 
 class NewKoatuuConverter(Converter):
+    """
+    Places of the whole file are collected into the tree of four levels, that is saved level by level
+    with bulk statements.
+    """
 
     def __init__(self):
         self.LOCAL_FILE_NAME = settings.LOCATION_KOATUU_LOCAL_FILE_NAME
-        self.all_first_level_places = self.put_objects_to_dict('code', 'location_register',
-                                                                   'KoatuuFirstLevel')
-        self.all_second_level_places = self.put_objects_to_dict('code', 'location_register',
-                                                                    'KoatuuSecondLevel')
-        self.all_third_level_places = self.put_objects_to_dict('code', 'location_register',
-                                                                   'KoatuuThirdLevel')
-        self.all_fourth_level_places = self.put_objects_to_dict('code', 'location_register',
-                                                                    'KoatuuFourthLevel')
+        self.places = HierarchyLoader(batch_size=settings.BATCH_SIZE_KOATUU)
+        self.first_levels = self.places.add_level(KoatuuFirstLevel, 'code', fields=('code', 'name'))
+        self.second_levels = self.places.add_level(
+            KoatuuSecondLevel, 'code', parents={'first_level': self.first_levels},
+            fields=('code', 'name', 'category_id'),
+            update_fields=('first_level_id', 'category_id', 'name')
+        )
+        self.third_levels = self.places.add_level(
+            KoatuuThirdLevel, 'code', parents={'first_level': self.first_levels, 'second_level': self.second_levels},
+            fields=('code', 'name', 'category_id'),
+            update_fields=('first_level_id', 'second_level_id', 'category_id', 'name')
+        )
+        self.fourth_levels = self.places.add_level(
+            KoatuuFourthLevel, 'code',
+            parents={'first_level': self.first_levels, 'second_level': self.second_levels,
+                     'third_level': self.third_levels},
+            fields=('code', 'name', 'category_id'),
+            update_fields=('first_level_id', 'second_level_id', 'third_level_id', 'category_id', 'name')
+        )
         self.all_categories = self.put_objects_to_dict('code', 'location_register',
                                                            'KoatuuCategory')
         # a dictionary for storing all abbreviations and full forms of KOATUU categories
@@ -305,103 +321,24 @@ class NewKoatuuConverter(Converter):
             self.all_categories[category_code] = category
         return self.all_categories[category_code]
 
-    def save_or_update_first_level(self, name, first_level_code):
-        if first_level_code not in self.all_first_level_places:
-            first_level = KoatuuFirstLevel.objects.create(name=name, code=first_level_code)
-            self.all_first_level_places[first_level_code] = first_level
-            logger.warning(f'Збережено новий регіон у КОАТУУ із назвою: {name}')
-        else:
-            first_level = self.all_first_level_places[first_level_code]
-            if first_level.name != name:
-                logger.warning(f'Не збігаються код або назва регіону у КОАТУУ: {first_level}')
-
-    def save_or_update_second_level(self, first_level_code, category, name, second_level_code):
-        first_level = self.all_first_level_places[first_level_code]
-        if second_level_code not in self.all_second_level_places:
-            second_level = KoatuuSecondLevel.objects.create(first_level=first_level,
-                                                            category=category,
-                                                            name=name,
-                                                            code=second_level_code)
-            self.all_second_level_places[second_level_code] = second_level
-        else:
-            second_level = self.all_second_level_places[second_level_code]
-            update_fields = []
-            if second_level.first_level != first_level:
-                second_level.first_level = first_level
-                update_fields.append('first_level')
-            if second_level.category != category:
-                second_level.category = category
-                update_fields.append('category')
-            if second_level.name != name:
-                second_level.name = name
-                update_fields.append('name')
-            if len(update_fields):
-                update_fields.append('updated_at')
-                second_level.save(update_fields=update_fields)
-
-    def save_or_update_third_level(self, first_level_code, second_level_code, category, name,
-                                   third_level_code):
-        first_level = self.all_first_level_places[first_level_code]
-        second_level = self.all_second_level_places[second_level_code]
-        if third_level_code not in self.all_third_level_places:
-            third_level = KoatuuThirdLevel.objects.create(first_level=first_level,
-                                                          second_level=second_level,
-                                                          category=category,
-                                                          name=name,
-                                                          code=third_level_code)
-            self.all_third_level_places[third_level_code] = third_level
-        else:
-            third_level = self.all_third_level_places[third_level_code]
-            update_fields = []
-            if third_level.first_level != first_level:
-                third_level.first_level = first_level
-                update_fields.append('first_level')
-            if third_level.second_level != second_level:
-                third_level.second_level = second_level
-                update_fields.append('second_level')
-            if third_level.category != category:
-                third_level.category = category
-                update_fields.append('category')
-            if third_level.name != name:
-                third_level.name = name
-                update_fields.append('name')
-            if len(update_fields):
-                update_fields.append('updated_at')
-                third_level.save(update_fields=update_fields)
-
-    def save_or_update_fourth_level(self, first_level_code, second_level_code, third_level_code,
-                                    category, name, fourth_level_code):
-        first_level = self.all_first_level_places[first_level_code]
-        second_level = self.all_second_level_places[second_level_code]
-        third_level = self.all_third_level_places[third_level_code]
-        if fourth_level_code not in self.all_fourth_level_places:
-            fourth_level = KoatuuFourthLevel.objects.create(first_level=first_level,
-                                                            second_level=second_level,
-                                                            third_level=third_level,
-                                                            category=category,
-                                                            name=name, code=fourth_level_code)
-            self.all_fourth_level_places[fourth_level_code] = fourth_level
-        else:
-            fourth_level = self.all_fourth_level_places[fourth_level_code]
-            update_fields = []
-            if fourth_level.first_level != first_level:
-                fourth_level.first_level = first_level
-                update_fields.append('first_level')
-            if fourth_level.second_level != second_level:
-                fourth_level.second_level = second_level
-                update_fields.append('second_level')
-            if fourth_level.third_level != third_level:
-                fourth_level.third_level = third_level
-                update_fields.append('third_level')
-            if fourth_level.category != category:
-                fourth_level.category = category
-                update_fields.append('category')
-            if fourth_level.name != name:
-                fourth_level.name = name
-                update_fields.append('name')
-            if len(update_fields):
-                update_fields.append('updated_at')
-                fourth_level.save(update_fields=update_fields)
+    def get_parents(self, object_koatuu, **codes):
+        """Returns nodes of upper levels by codes or None if some of them is not in the file"""
+        parents = {}
+        for field, code in codes.items():
+            parents[field] = getattr(self, f'{field}s').get(code)
+            if parents[field] is None:
+                logger.warning(f'Код {code} не існує в json: {object_koatuu}')
+                return None
+        return parents
+
+    def check_first_levels(self):
+        stored_names = dict(KoatuuFirstLevel.objects.values_list('code', 'name'))
+        for first_level_code, node in self.first_levels.nodes.items():
+            name = self.first_levels.get_value(node, 'name')
+            if first_level_code not in stored_names:
+                logger.warning(f'Збережено новий регіон у КОАТУУ із назвою: {name}')
+            elif stored_names[first_level_code] != name:
+                logger.warning(f'Не збігаються код або назва регіону у КОАТУУ: {first_level_code} {name}')
 
     def save_to_db(self, json_file):
         data = self.load_json(json_file)
@@ -420,23 +357,25 @@ class NewKoatuuConverter(Converter):
             if not isinstance(fourth_level_code, str):
                 fourth_level_code = str(fourth_level_code)
             category_code = object_koatuu['Категорія']
-            category = None
+            category_id = None
             if category_code:
-                category = self.save_or_get_category(category_code)
+                category_id = self.save_or_get_category(category_code).id
             name = object_koatuu["Назва об'єкта українською мовою"]
             if first_level_code and not second_level_code:
                 name = clean_name(
                     get_lowercase_substring_before_slash(name)
                 )
-                self.save_or_update_first_level(name, first_level_code)
+                self.first_levels.add(first_level_code, code=first_level_code, name=name)
                 continue
             if first_level_code and second_level_code and not third_level_code:
                 name = change_to_full_name(
                     clean_name(
                         get_lowercase_substring_before_slash(name))
                 )
-                self.save_or_update_second_level(first_level_code, category, name,
-                                                 second_level_code)
+                parents = self.get_parents(object_koatuu, first_level=first_level_code)
+                if parents:
+                    self.second_levels.add(second_level_code, parents, code=second_level_code, name=name,
+                                           category_id=category_id)
                 continue
             if (first_level_code and second_level_code and third_level_code and
                     not fourth_level_code):
@@ -444,8 +383,11 @@ class NewKoatuuConverter(Converter):
                     clean_name(
                         get_lowercase_substring_before_slash(name))
                 )
-                self.save_or_update_third_level(first_level_code, second_level_code, category,
-                                                name, third_level_code)
+                parents = self.get_parents(object_koatuu, first_level=first_level_code,
+                                           second_level=second_level_code)
+                if parents:
+                    self.third_levels.add(third_level_code, parents, code=third_level_code, name=name,
+                                          category_id=category_id)
                 continue
             if (first_level_code and second_level_code and third_level_code and
                     fourth_level_code):
@@ -455,9 +397,13 @@ class NewKoatuuConverter(Converter):
                     logger.warning(f'Код третього рівня не існує в json: {object_koatuu}')
                     continue
                 name = name.lower()
-                self.save_or_update_fourth_level(first_level_code, second_level_code,
-                                                 third_level_code, category, name,
-                                                 fourth_level_code)
+                parents = self.get_parents(object_koatuu, first_level=first_level_code,
+                                           second_level=second_level_code, third_level=third_level_code)
+                if parents:
+                    self.fourth_levels.add(fourth_level_code, parents, code=fourth_level_code, name=name,
+                                           category_id=category_id)
+        self.check_first_levels()
+        self.places.save()
 
 
 class KoatuuDownloader(Downloader):
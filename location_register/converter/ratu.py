@@ -4,9 +4,11 @@ import requests
 from django.conf import settings
 from django.utils import timezone
 
-from data_ocean.converter import Converter, BulkCreateManager
+from data_ocean.converter import Converter
 from data_ocean.downloader import Downloader
+from data_ocean.hierarchy_loader import HierarchyLoader
 from data_ocean.models import Register
+from data_ocean.record_schema import RecordField, RecordSchema
 from data_ocean.utils import clean_name, change_to_full_name
 from location_register.models.ratu_models import RatuRegion, RatuDistrict, RatuCity, RatuCityDistrict, RatuStreet
 
@@ -14,8 +16,19 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-# ToDo: define how to mark outdated records
 class RatuConverter(Converter):
+    """
+    save_to_db collects places of all records into the tree of regions, districts, cities, districts
+    of cities and streets, it is saved level by level with bulk statements after the last chunk.
+    """
+    RECORD_SCHEMA = RecordSchema(
+        RecordField('OBL_NAME', 'region', required=True),
+        RecordField('REGION_NAME', 'district'),
+        RecordField('CITY_NAME', 'city'),
+        RecordField('CITY_REGION_NAME', 'citydistrict'),
+        RecordField('STREET_NAME', 'street'),
+    )
+
     def __init__(self):
         self.API_ADDRESS_FOR_DATASET = Register.objects.get(
             source_register_id=settings.LOCATION_RATU_SOURCE_REGISTER_ID
@@ -24,25 +37,29 @@ class RatuConverter(Converter):
         self.LOCAL_FILE_NAME = settings.LOCAL_FILE_NAME_RATU
         self.CHUNK_SIZE = settings.CHUNK_SIZE_RATU
         self.RECORD_TAG = 'RECORD'
-        self.bulk_manager = BulkCreateManager()
-        self.all_regions_dict = self.put_objects_to_dict('name', 'location_register',
-                                                         'RatuRegion')
-        self.all_districts_dict = self.put_objects_to_dict('code', 'location_register',
-                                                           'RatuDistrict')
-        self.all_cities_dict = self.put_objects_to_dict('code', 'location_register',
-                                                        'RatuCity')
-        self.all_citydistricts_dict = self.put_objects_to_dict('code', 'location_register',
-                                                               'RatuCityDistrict')
-        self.all_streets_dict = self.put_objects_to_dict('code', 'location_register',
-                                                         'RatuStreet')
-        self.outdated_districts_dict = self.put_objects_to_dict('code', 'location_register',
-                                                                'RatuDistrict')
-        self.outdated_cities_dict = self.put_objects_to_dict('code', 'location_register',
-                                                             'RatuCity')
-        self.outdated_citydistricts_dict = self.put_objects_to_dict('code', 'location_register',
-                                                                    'RatuCityDistrict')
-        self.outdated_streets_dict = self.put_objects_to_dict('code', 'location_register',
-                                                              'RatuStreet')
+        self.places = HierarchyLoader(batch_size=settings.BATCH_SIZE_RATU)
+        self.regions = self.places.add_level(RatuRegion, 'name', fields=('name',))
+        self.districts = self.places.add_level(
+            RatuDistrict, 'code', parents={'region': self.regions}, fields=('name',),
+            key_value=self.get_district_code
+        )
+        self.cities = self.places.add_level(
+            RatuCity, 'code', parents={'region': self.regions, 'district': self.districts}, fields=('name',),
+            key_value=self.get_city_code
+        )
+        self.citydistricts = self.places.add_level(
+            RatuCityDistrict, 'code',
+            parents={'region': self.regions, 'district': self.districts, 'city': self.cities}, fields=('name',),
+            key_value=self.get_citydistrict_code
+        )
+        self.streets = self.places.add_level(
+            RatuStreet, 'code',
+            parents={'region': self.regions, 'district': self.districts, 'city': self.cities,
+                     'citydistrict': self.citydistricts},
+            fields=('name',),
+            key_value=self.get_street_code
+        )
+        self.is_full_pass = False
         super().__init__()
 
     def rename_file(self, file):
@@ -51,118 +68,99 @@ class RatuConverter(Converter):
             new_filename = 'ratu.xml'
         return new_filename
 
-    def save_or_get_region(self, name):
+    @staticmethod
+    def get_name(level, node):
+        return 'EMPTY' if node is None else level.get_value(node, 'name')
+
+    # codes of places in DB are made of names of the place and its parents
+    def get_district_code(self, node):
+        region = self.districts.get_parent(node, 'region')
+        return self.get_name(self.regions, region) + self.get_name(self.districts, node)
+
+    def get_city_code(self, node):
+        region = self.cities.get_parent(node, 'region')
+        district = self.cities.get_parent(node, 'district')
+        return (self.get_name(self.regions, region) + self.get_name(self.districts, district)
+                + self.get_name(self.cities, node))
+
+    def get_citydistrict_code(self, node):
+        region = self.citydistricts.get_parent(node, 'region')
+        city = self.citydistricts.get_parent(node, 'city')
+        return (self.get_name(self.regions, region) + self.get_name(self.cities, city)
+                + self.get_name(self.citydistricts, node))
+
+    def get_street_code(self, node):
+        region = self.streets.get_parent(node, 'region')
+        district = self.streets.get_parent(node, 'district')
+        city = self.streets.get_parent(node, 'city')
+        citydistrict = self.streets.get_parent(node, 'citydistrict')
+        return (self.get_name(self.regions, region) + self.get_name(self.districts, district)
+                + self.get_name(self.cities, city) + self.get_name(self.citydistricts, citydistrict)
+                + self.get_name(self.streets, node))
+
+    def add_region(self, name):
         region_name = clean_name(name)
         region_name = change_to_full_name(region_name)
-        if region_name not in self.all_regions_dict:
-            region = RatuRegion.objects.create(
-                name=region_name
-            )
-            self.all_regions_dict[region_name] = region
-            return region
-        return self.all_regions_dict[region_name]
-
-    def save_or_get_district(self, name, region):
+        return self.regions.add(region_name, name=region_name)
+
+    def add_district(self, name, region):
         district_name = clean_name(name)
         district_name = change_to_full_name(district_name)
-        district_code = region.name + district_name
-        if district_code not in self.all_districts_dict:
-            district = RatuDistrict.objects.create(
-                region=region,
-                name=district_name,
-                code=district_code
-            )
-            self.all_districts_dict[district_code] = district
-            return district
-        else:
-            if self.outdated_districts_dict.get(district_code):
-                del self.outdated_districts_dict[district_code]
-        return self.all_districts_dict[district_code]
-
-    def save_or_get_city(self, name, region, district):
+        return self.districts.add((region, district_name), {'region': region}, name=district_name)
+
+    def add_city(self, name, region, district):
         city_name = clean_name(name)
-        district_name = 'EMPTY' if not district else district.name
-        city_code = region.name + district_name + city_name
-        if city_code not in self.all_cities_dict:
-            city = RatuCity.objects.create(
-                region=region,
-                district=district,
-                name=city_name,
-                code=city_code
-            )
-            self.all_cities_dict[city_code] = city
-            return city
-        else:
-            if self.outdated_cities_dict.get(city_code):
-                del self.outdated_cities_dict[city_code]
-        return self.all_cities_dict[city_code]
-
-    def save_or_get_citydistrict(self, name, region, district, city):
+        return self.cities.add((region, district, city_name), {'region': region, 'district': district},
+                               name=city_name)
+
+    def add_citydistrict(self, name, region, district, city):
         citydistrict_name = clean_name(name)
-        citydistrict_code = region.name + city.name + citydistrict_name
-        if citydistrict_code not in self.all_citydistricts_dict:
-            citydistrict = RatuCityDistrict.objects.create(
-                region=region,
-                district=district,
-                city=city,
-                name=citydistrict_name,
-                code=citydistrict_code
-            )
-            self.all_citydistricts_dict[citydistrict_code] = citydistrict
-            return citydistrict
-        else:
-            if self.outdated_citydistricts_dict.get(citydistrict_code):
-                del self.outdated_citydistricts_dict[citydistrict_code]
-        return self.all_citydistricts_dict[citydistrict_code]
-
-    def save_street(self, name, region, district, city, citydistrict):
+        # like the code, the key has the name of the city, not the city itself
+        return self.citydistricts.add(
+            (region, self.cities.get_value(city, 'name'), citydistrict_name),
+            {'region': region, 'district': district, 'city': city},
+            name=citydistrict_name
+        )
+
+    def add_street(self, name, region, district, city, citydistrict):
         street_name = change_to_full_name(name)
         # Saving streets that are located in Kyiv and Sevastopol that are regions
-        if not city:
-            city = self.save_or_get_city(region.name, region, district)
-        district_name = 'EMPTY' if not district else district.name
-        citydistrict_name = 'EMPTY' if not citydistrict else citydistrict.name
-        street_code = region.name + district_name + city.name + citydistrict_name + street_name
-        if street_code not in self.all_streets_dict:
-            street = RatuStreet.objects.create(
-                region=region,
-                district=district,
-                city=city,
-                citydistrict=citydistrict,
-                name=street_name,
-                code=street_code
-            )
-        else:
-            if self.outdated_streets_dict.get(street_code):
-                del self.outdated_streets_dict[street_code]
+        if city is None:
+            city = self.add_city(self.regions.get_value(region, 'name'), region, district)
+        return self.streets.add(
+            (city, citydistrict, street_name),
+            {'region': region, 'district': district, 'city': city, 'citydistrict': citydistrict},
+            name=street_name
+        )
 
     def save_to_db(self, records):
-        for record in records:
-            region = self.save_or_get_region(record.xpath('OBL_NAME')[0].text)
-            district = (self.save_or_get_district(record.xpath('REGION_NAME')[0].text, region)
-                        if record.xpath('REGION_NAME')[0].text else None)
-            city = (self.save_or_get_city(record.xpath('CITY_NAME')[0].text, region, district)
-                    if record.xpath('CITY_NAME')[0].text else None)
-            citydistrict = (self.save_or_get_citydistrict(record.xpath('CITY_REGION_NAME')[0].text,
-                                                          region, district, city)
-                            if record.xpath('CITY_REGION_NAME')[0].text else None)
-            if record.xpath('STREET_NAME')[0].text:
-                self.save_street(record.xpath('STREET_NAME')[0].text, region, district,
-                                 city, citydistrict)
+        for data in map(self.RECORD_SCHEMA.extract, records):
+            if not data:
+                continue
+            region = self.add_region(data['region'])
+            district = self.add_district(data['district'], region) if data['district'] else None
+            city = self.add_city(data['city'], region, district) if data['city'] else None
+            citydistrict = (self.add_citydistrict(data['citydistrict'], region, district, city)
+                            if data['citydistrict'] and city is not None else None)
+            if data['street']:
+                self.add_street(data['street'], region, district, city, citydistrict)
+
+    def save_checkpoint(self, index, offset):
+        # places are saved only after the last record, so there is no chunk to resume from
+        pass
+
+    def process(self, start_index=0, resume=False):
+        if not super().process(start_index, resume):
+            return False
+        self.places.save()
+        if self.is_full_pass:
+            for level in (self.streets, self.citydistricts, self.cities, self.districts):
+                level.delete_outdated()
+        return True
 
     def delete_outdated(self):
-        if self.outdated_districts_dict:
-            for district in self.outdated_districts_dict.values():
-                district.soft_delete()
-        if self.outdated_cities_dict:
-            for city in self.outdated_cities_dict.values():
-                city.soft_delete()
-        if self.outdated_citydistricts_dict:
-            for city_district in self.outdated_citydistricts_dict.values():
-                city_district.soft_delete()
-        if self.outdated_streets_dict:
-            for street in self.outdated_streets_dict.values():
-                street.soft_delete()
+        # process calls it after all records of a full pass are collected, they are not saved yet
+        self.is_full_pass = True
 
     print(
         'RatuConverter already imported.',
@@ -176,6 +174,7 @@ class RatuDownloader(Downloader):
     zip_required_file_sign = 'xml_atu'
     unzip_required_file_sign = 'xml_atu'
     unzip_after_download = True
+    stream_from_zip = settings.STREAM_FROM_ZIP_RATU
     source_dataset_url = settings.LOCATION_RATU_SOURCE_PACKAGE
 
     def get_source_file_url(self):
@@ -204,7 +203,7 @@ class RatuDownloader(Downloader):
 
         logger.info(f'{self.reg_name}: process() with {self.file_path} started ...')
         ratu = RatuConverter()
-        ratu.LOCAL_FILE_NAME = self.file_name
+        self.set_converter_source(ratu)
         ratu.process()
         logger.info(f'{self.reg_name}: process() with {self.file_path} finished successfully.')
 
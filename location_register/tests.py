@@ -1,3 +1,191 @@
-from django.test import TestCase
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from data_ocean.hierarchy_loader import HierarchyLoader
+from location_register.converter.drv import DrvHarvester
+from location_register.models.ratu_models import RatuDistrict, RatuRegion
+
+DRV_WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://drv.test/"
+             targetNamespace="http://drv.test/">
+  <types>
+    <xsd:schema targetNamespace="http://drv.test/" elementFormDefault="qualified">
+      <xsd:element name="GetRegions"><xsd:complexType><xsd:sequence/></xsd:complexType></xsd:element>
+      <xsd:element name="GetRegionsResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="Region" minOccurs="0" maxOccurs="unbounded"><xsd:complexType><xsd:sequence>
+          <xsd:element name="Region_Id" type="xsd:int"/>
+          <xsd:element name="Region_Name" type="xsd:string"/>
+        </xsd:sequence></xsd:complexType></xsd:element>
+        <xsd:element name="Count" type="xsd:int" minOccurs="0"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="ATUUQuery"><xsd:complexType><xsd:sequence>
+        <xsd:element name="ATOParams" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="ATUUQueryResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="ATO" minOccurs="0" maxOccurs="unbounded"><xsd:complexType><xsd:sequence>
+          <xsd:element name="ATO_Id" type="xsd:int"/>
+          <xsd:element name="ATO_Name" type="xsd:string"/>
+        </xsd:sequence></xsd:complexType></xsd:element>
+        <xsd:element name="Count" type="xsd:int" minOccurs="0"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+    </xsd:schema>
+  </types>
+  <message name="GetRegionsInput"><part name="parameters" element="tns:GetRegions"/></message>
+  <message name="GetRegionsOutput"><part name="parameters" element="tns:GetRegionsResponse"/></message>
+  <message name="ATUUQueryInput"><part name="parameters" element="tns:ATUUQuery"/></message>
+  <message name="ATUUQueryOutput"><part name="parameters" element="tns:ATUUQueryResponse"/></message>
+  <portType name="GetRegionsPortType">
+    <operation name="GetRegions">
+      <input message="tns:GetRegionsInput"/><output message="tns:GetRegionsOutput"/>
+    </operation>
+  </portType>
+  <portType name="GetATUUPortType">
+    <operation name="ATUUQuery">
+      <input message="tns:ATUUQueryInput"/><output message="tns:ATUUQueryOutput"/>
+    </operation>
+  </portType>
+  <binding name="GetRegionsBinding" type="tns:GetRegionsPortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="GetRegions">
+      <soap:operation soapAction="GetRegions"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <binding name="GetATUUBinding" type="tns:GetATUUPortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="ATUUQuery">
+      <soap:operation soapAction="ATUUQuery"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="GetRegionsService">
+    <port name="GetRegionsPort" binding="tns:GetRegionsBinding"><soap:address location="{url}"/></port>
+  </service>
+  <service name="GetATUUService">
+    <port name="GetATUUPort" binding="tns:GetATUUBinding"><soap:address location="{url}"/></port>
+  </service>
+</definitions>'''
+
+SOAP_RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>'
+                 '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+                 '<soap:Body>{}</soap:Body></soap:Envelope>')
+
+
+class DrvRequestHandler(BaseHTTPRequestHandler):
+    """Stand-in for the DRV SOAP services, fails_left requests fail with 503"""
+    fails_left = 0
+    wsdl_requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=''):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        with self.lock:
+            DrvRequestHandler.wsdl_requests += 1
+        self.respond(200, DRV_WSDL.replace('{url}', f'http://127.0.0.1:{self.server.server_port}/'))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        with self.lock:
+            if DrvRequestHandler.fails_left:
+                DrvRequestHandler.fails_left -= 1
+                self.respond(503)
+                return
+        region_code = re.search(r'ATOParams>(\d+)<', body)
+        if region_code:
+            code = int(region_code.group(1))
+            atos = ''.join(f'<ATO><ATO_Id>{code * 10 + i}</ATO_Id><ATO_Name>АТО {i}</ATO_Name></ATO>'
+                           for i in range(2))
+            self.respond(200, SOAP_RESPONSE.format(f'<ATUUQueryResponse xmlns="http://drv.test/">{atos}'
+                                                   f'</ATUUQueryResponse>'))
+        else:
+            self.respond(200, SOAP_RESPONSE.format(
+                '<GetRegionsResponse xmlns="http://drv.test/"><Region><Region_Id>1</Region_Id>'
+                '<Region_Name>Київ</Region_Name></Region></GetRegionsResponse>'
+            ))
+
+
+class DrvHarvesterTestCase(SimpleTestCase):
+    def setUp(self):
+        DrvRequestHandler.fails_left = 0
+        DrvRequestHandler.wsdl_requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DrvRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.harvester = DrvHarvester(f'http://127.0.0.1:{self.server.server_port}/wsdl',
+                                      threads=3, attempts=3, retry_delay=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_all(self):
+        self.assertEqual(self.harvester.get_regions()[0]['Region_Name'], 'Київ')
+        DrvRequestHandler.fails_left = 2
+        with ThreadPoolExecutor(max_workers=self.harvester.threads) as executor:
+            results = list(self.harvester.fetch_all(executor, self.harvester.get_atos, range(1, 21)))
+        self.assertEqual([code for code, _ in results], list(range(1, 21)))
+        self.assertEqual([ato['ATO_Id'] for ato in results[4][1]], [50, 51])
+        # the WSDL is parsed once for all services and threads
+        self.assertEqual(DrvRequestHandler.wsdl_requests, 1)
+
+
+class HierarchyLoaderTestCase(SimpleTestCase):
+    def test_save(self):
+        places = HierarchyLoader()
+        regions = places.add_level(RatuRegion, 'name', fields=('name',))
+        districts = places.add_level(
+            RatuDistrict, 'code', parents={'region': regions}, fields=('name',), update_fields=('region_id',),
+            key_value=lambda node: (regions.get_value(districts.get_parent(node, 'region'), 'name')
+                                    + districts.get_value(node, 'name'))
+        )
+        for region_name, district_name in [('київська', 'бучанський'), ('львівська', 'стрийський'),
+                                           ('київська', 'бучанський'), ('київська', 'обухівський')]:
+            region = regions.add(region_name, name=region_name)
+            districts.add((region, district_name), {'region': region}, name=district_name)
+        self.assertEqual(len(districts.nodes), 3)
+
+        def bulk_create(objs, batch_size=None):
+            for i, obj in enumerate(objs):
+                obj.id = 100 + i
+
+        stored_rows = {
+            RatuRegion: [('київська', 1, None), ('одеська', 2, None)],
+            # the district moved to the new region, the outdated one is deleted only once
+            RatuDistrict: [('львівськастрийський', 10, None, 1), ('київськабучанський', 11, None, 1),
+                           ('одеськаізмаїльський', 12, None, 2), ('одеськаізмаїльський', 13, None, 2)],
+        }
+        managers = {}
+        for model in (RatuRegion, RatuDistrict):
+            manager = managers[model] = mock.MagicMock()
+            manager.values_list.return_value.order_by.return_value.iterator.return_value = stored_rows[model]
+            manager.bulk_create.side_effect = bulk_create
+        with mock.patch.object(RatuRegion, 'include_deleted_objects', managers[RatuRegion]), \
+                mock.patch.object(RatuDistrict, 'include_deleted_objects', managers[RatuDistrict]), \
+                mock.patch('data_ocean.hierarchy_loader.transaction'):
+            places.save()
+        new_regions = managers[RatuRegion].bulk_create.call_args[0][0]
+        self.assertEqual([region.name for region in new_regions], ['львівська'])
+        self.assertEqual(list(regions.ids), [1, 100])
+        new_districts = managers[RatuDistrict].bulk_create.call_args[0][0]
+        self.assertEqual([(district.code, district.region_id) for district in new_districts],
+                         [('київськаобухівський', 1)])
+        self.assertEqual(list(districts.ids), [11, 10, 100])
+        changed_districts = managers[RatuDistrict].bulk_update.call_args[0][0]
+        self.assertEqual([(district.id, district.region_id) for district in changed_districts], [(10, 100)])
+        self.assertEqual(regions.outdated_ids, [2])
+        self.assertEqual(districts.outdated_ids, [12])